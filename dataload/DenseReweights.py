@@ -14,6 +14,9 @@ from numpy import ndarray
 from scipy.stats import gaussian_kde
 import mlflow
 
+from dataload.compression import multiplicity_kde, pair_multiplicities, sample_multiplicities
+from dataload.dtype_policy import as_policy
+
 
 class DenseJointReweights:
     """
@@ -39,6 +42,8 @@ class DenseJointReweights:
                  alpha: float = .9,
                  bw: float = .9,
                  min_norm_weight: Optional[float] = None,
+                 multiplicity: Optional[ndarray] = None,
+                 weights: Optional[ndarray] = None,
                  debug: bool = False) -> None:
         """
         Create a synthetic regression dataset.
@@ -51,6 +56,10 @@ class DenseJointReweights:
         :param n_test: Number of testing instances.
         :param n_features: Number of input features.
         :param alpha: reweighing coefficient
+        :param multiplicity: Optional multiplicities of the rows of a collapsed set (see dataload.compression).
+                             The joint weights are then those of the uncompressed set times the pair multiplicities.
+        :param weights: Optional weights of the rows of a coreset (see dataload.coreset), used like multiplicities
+                        except that a row stands for distinct rows, so it has no pairs of copies.
         """
 
         self.yb = None
@@ -66,9 +75,20 @@ class DenseJointReweights:
         self.min_y = np.min(self.y_train)
         self.max_y = np.max(self.y_train)
 
-        self.kde = gaussian_kde(self.y_train, bw_method=bw)
+        if multiplicity is not None and weights is not None:
+            raise ValueError("Pass multiplicity or weights, not both")
+        # whether the rows stand for copies of themselves (multiplicity) or for distinct rows (coreset weights)
+        self.copies = multiplicity is not None
+        multiplicity = multiplicity if multiplicity is not None else weights
+        self.multiplicity = multiplicity
+        if multiplicity is None:
+            self.kde = gaussian_kde(self.y_train, bw_method=bw)
+        else:
+            self.kde = multiplicity_kde(self.y_train, multiplicity, bw_method=bw)
         # self.adjust_bandwidth(self.kde, bw_factor)
         self.jreweights, self.jindices = self.preprocess_jreweighting(self.y_train)  # for pairs of labels
+        # pair weights stored in the policy dtype (computed in float64)
+        self.jreweights = as_policy(self.jreweights)
 
         if self.debug:
             print('X_train: ', self.X_train[:12])
@@ -116,14 +136,29 @@ class DenseJointReweights:
         self.ya = np.array(self.ya)
         self.yb = np.array(self.yb)
 
+        # Pairs of the uncompressed set: each pair of unique rows stands for m_i * m_j pairs, and the pairs of
+        # copies of a same row are part of the density range and of the average (not of the training pairs).
+        # The rows of a coreset stand for distinct rows, they have no pairs of copies.
+        stat_ya, stat_yb, pair_counts = self.ya, self.yb, None
+        if self.multiplicity is not None:
+            m = np.asarray(self.multiplicity, dtype=np.float64)
+            pair_counts = m[i] * m[j]
+            if self.copies:
+                repeated = m >= 2
+                stat_ya = np.concatenate([self.ya, y[repeated]])
+                stat_yb = np.concatenate([self.yb, y[repeated]])
+                pair_counts = np.concatenate([pair_counts, m[repeated] * (m[repeated] - 1) / 2])
+
         # Step 2: Find min and max joint PDF values and store them
-        self.find_min_max_jpdf(self.ya, self.yb)
+        self.find_min_max_jpdf(stat_ya, stat_yb)
 
         # Step 3: Find average joint reweighting factor
-        self.find_avg_jreweight(self.ya, self.yb, self.alpha)
+        self.find_avg_jreweight(stat_ya, stat_yb, self.alpha, pair_counts=pair_counts)
 
         # Step 4: Calculate normalized joint reweighting factors
         normalized_joint_factors = self.normalized_jreweight(self.ya, self.yb, self.alpha)
+        if self.multiplicity is not None:
+            normalized_joint_factors = normalized_joint_factors * pair_multiplicities(self.multiplicity)
         # Create a list of index pairs corresponding to ya and yb
         index_pairs = list(zip(i, j))
 
@@ -147,17 +182,23 @@ class DenseJointReweights:
 
         return normalized_joint_factor
 
-    def find_avg_jreweight(self, ya: ndarray, yb: ndarray, alpha: float, epsilon: float = 1e-7) -> float:
+    def find_avg_jreweight(self, ya: ndarray, yb: ndarray, alpha: float, epsilon: float = 1e-7,
+                           pair_counts: Optional[ndarray] = None) -> float:
         """
         Find the average reweighting factor for joint labels ya and yb.
         :param ya, yb: labels.
         :param alpha: Parameter to adjust the reweighting.
         :param epsilon: A small constant to avoid zero reweighting.
+        :param pair_counts: Optional number of pairs each (ya, yb) stands for.
         :return: The average reweighting factor.
         """
 
-        total_jreweight = np.sum(self.jreweight(ya, yb, alpha, epsilon))
-        count = len(ya)
+        if pair_counts is None:
+            total_jreweight = np.sum(self.jreweight(ya, yb, alpha, epsilon))
+            count = len(ya)
+        else:
+            total_jreweight = np.sum(pair_counts * self.jreweight(ya, yb, alpha, epsilon))
+            count = np.sum(pair_counts)
 
         self.avg_jreweight = total_jreweight / count if count > 0 else 0
 
@@ -301,6 +342,8 @@ class DenseReweights:
                  bw: float = .9,
                  min_norm_weight: Optional[float] = None,
                  tag: Optional[str] = None,
+                 multiplicity: Optional[ndarray] = None,
+                 weights: Optional[ndarray] = None,
                  debug: bool = False) -> None:
         """
         Create a synthetic regression dataset.
@@ -313,6 +356,9 @@ class DenseReweights:
         :param n_test: Number of testing instances.
         :param n_features: Number of input features.
         :param alpha: rewweighing coefficient
+        :param multiplicity: Optional multiplicities of the rows of a collapsed set (see dataload.compression).
+                             The weights are then those of the uncompressed set times the sample multiplicities.
+        :param weights: Optional weights of the rows of a coreset (see dataload.coreset), used like multiplicities.
         """
 
         self.yb = None
@@ -329,9 +375,18 @@ class DenseReweights:
         self.min_y = np.min(self.y_train)
         self.max_y = np.max(self.y_train)
 
-        self.kde = gaussian_kde(self.y_train, bw_method=bw)
+        if multiplicity is not None and weights is not None:
+            raise ValueError("Pass multiplicity or weights, not both")
+        # whether the rows stand for copies of themselves (multiplicity) or for distinct rows (coreset weights)
+        self.copies = multiplicity is not None
+        multiplicity = multiplicity if multiplicity is not None else weights
+        self.multiplicity = multiplicity
+        if multiplicity is None:
+            self.kde = gaussian_kde(self.y_train, bw_method=bw)
+        else:
+            self.kde = multiplicity_kde(self.y_train, multiplicity, bw_method=bw)
         # self.adjust_bandwidth(self.kde, bw_factor)
-        self.reweights = self.preprocess_reweighting(self.y_train)  # for labels, order maintained
+        self.reweights = as_policy(self.preprocess_reweighting(self.y_train))  # for labels, order maintained
 
         if self.debug:
             print('X_train: ', self.X_train[:12])
@@ -582,17 +637,23 @@ class DenseReweights:
 
         return reweighting_factor
 
-    def find_avg_reweight(self, y: ndarray, alpha: float, epsilon: float = 1e-7) -> float:
+    def find_avg_reweight(self, y: ndarray, alpha: float, epsilon: float = 1e-7,
+                          counts: Optional[ndarray] = None) -> float:
         """
         Find the average reweighting factor for y
         :param y: labels.
         :param alpha: Parameter to adjust the reweighting.
         :param epsilon: A small constant to avoid zero reweighting.
+        :param counts: Optional number of samples each label stands for.
         :return: The average reweighting factor.
         """
 
-        total_reweight = np.sum(self.reweight(y, alpha, epsilon))
-        count = len(y)
+        if counts is None:
+            total_reweight = np.sum(self.reweight(y, alpha, epsilon))
+            count = len(y)
+        else:
+            total_reweight = np.sum(counts * self.reweight(y, alpha, epsilon))
+            count = np.sum(counts)
 
         self.avg_reweight = total_reweight / count if count > 0 else 0
 
@@ -626,9 +687,11 @@ class DenseReweights:
         self.find_min_max_pdf(y)
 
         # Step 2: Find average reweighting factor
-        self.find_avg_reweight(y, self.alpha)
+        self.find_avg_reweight(y, self.alpha, counts=self.multiplicity)
 
         # Step 3: Calculate normalized reweighting factors for the dataset y
         normalized_factors = self.normalized_reweight(y, self.alpha)
+        if self.multiplicity is not None:
+            normalized_factors = normalized_factors * sample_multiplicities(self.multiplicity)
 
         return normalized_factors
@@ -0,0 +1,85 @@
+##############################################################################################################
+# Description: training set compression. Rows duplicated in both features and label (frequent among the
+# background events, the features are quantized) are collapsed into unique rows with integer multiplicities,
+# which are fed to the losses as sample weights and pair multiplicities, so an epoch costs the number of unique
+# rows while the full batch objective is unchanged.
+##############################################################################################################
+
+# types for type hinting
+from typing import Tuple, Union
+
+# imports
+import numpy as np
+from numpy import ndarray
+from scipy.stats import gaussian_kde
+
+
+def collapse_duplicates(X: ndarray, y: ndarray) -> Tuple[ndarray, ndarray, ndarray]:
+    """
+    Collapse the exact duplicate (X, y) rows into unique rows, kept in the order of their first occurrence
+    (so a shuffled set stays shuffled).
+
+    :param X: The features, shape of [n, d].
+    :param y: The labels, shape of [n].
+    :return: The unique features, the unique labels and the multiplicity of each unique row.
+    """
+    y = np.asarray(y)
+    rows = np.column_stack([y.reshape(len(y), -1), np.asarray(X).reshape(len(y), -1)])
+    _, first, counts = np.unique(rows, axis=0, return_index=True, return_counts=True)
+    order = np.argsort(first)
+    first, counts = first[order], counts[order]
+    print(f"Collapsed {len(y)} rows into {len(first)} unique rows")
+    return X[first], y[first], counts
+
+
+def sample_multiplicities(multiplicity: ndarray) -> ndarray:
+    """
+    Sample weights of the unique rows: the multiplicities scaled to a mean of 1, so a full batch mean loss
+    over the unique rows equals the mean loss over all the rows.
+    """
+    multiplicity = np.asarray(multiplicity, dtype=np.float64)
+    return multiplicity * len(multiplicity) / multiplicity.sum()
+
+
+def pair_multiplicities(multiplicity: ndarray) -> ndarray:
+    """
+    Pair weights of the unique rows, in np.triu_indices order: the number of pairs of rows each pair of unique
+    rows stands for, scaled so that a full batch mean pair loss over the unique rows equals the mean pair loss
+    over all the rows (pairs of copies of the same row have a zero representation error).
+    """
+    multiplicity = np.asarray(multiplicity, dtype=np.float64)
+    u, n = len(multiplicity), multiplicity.sum()
+    i, j = np.triu_indices(u, k=1)
+    return multiplicity[i] * multiplicity[j] * (u * (u - 1)) / (n * (n - 1))
+
+
+def multiplicity_kde(y: ndarray, multiplicity: ndarray, bw_method: Union[str, float] = 'scott') -> gaussian_kde:
+    """
+    KDE of the unique labels weighted by their multiplicities, with the bandwidth of the KDE of all the rows
+    (a weighted KDE would use the effective sample size and the weighted covariance), so its density is the
+    density of the uncompressed labels.
+
+    :param y: The unique labels.
+    :param multiplicity: The multiplicity of each unique label.
+    :param bw_method: The bandwidth method of the KDE of all the rows ('scott', 'silverman' or a factor).
+    :return: The KDE.
+    """
+    y = np.asarray(y, dtype=np.float64).reshape(-1)
+    multiplicity = np.asarray(multiplicity, dtype=np.float64)
+    n = multiplicity.sum()
+    kde = gaussian_kde(y, weights=multiplicity)
+
+    # factor and variance of the KDE of all the rows
+    if bw_method == 'scott':
+        factor = n ** (-1. / 5)
+    elif bw_method == 'silverman':
+        factor = (n * 3. / 4) ** (-1. / 5)
+    else:
+        factor = float(bw_method)
+    mean = np.average(y, weights=multiplicity)
+    variance = np.sum(multiplicity * (y - mean) ** 2) / (n - 1)
+
+    # covariance = data covariance * factor ** 2
+    data_variance = kde.covariance[0, 0] / kde.factor ** 2
+    kde.set_bandwidth(bw_method=factor * np.sqrt(variance / data_variance))
+    return kde
@@ -0,0 +1,155 @@
+##############################################################################################################
+# Description: weighted coresets of the training set. All the SEP and elevated events are kept and the
+# background events, which dominate the catalog, are replaced by a weighted subset (importance sampling or
+# k-center in feature space), so an epoch costs the size of the coreset. The weights are sample weights
+# (Keras fit) and pair weights (custom loops), through DenseReweights / DenseJointReweights(weights=weights),
+# or directly through sample_multiplicities / pair_multiplicities of dataload.compression. They are not
+# multiplicities: a coreset row stands for distinct background rows, not for copies of itself.
+##############################################################################################################
+
+# types for type hinting
+from typing import Optional, Tuple
+
+# imports
+import numpy as np
+from numpy import ndarray
+
+
+def background_mask(y: ndarray, elevated_threshold: Optional[float] = None) -> ndarray:
+    """
+    Background events: labels at most the elevated threshold (ln(10 / e^2) by default, as in label_classes).
+    """
+    if elevated_threshold is None:
+        elevated_threshold = np.log(10.0 / np.exp(2))
+    return np.asarray(y).reshape(-1) <= elevated_threshold
+
+
+def standardized(X: ndarray) -> ndarray:
+    """
+    Features scaled to zero mean and unit variance (float64).
+    """
+    X = np.asarray(X, dtype=np.float64).reshape(len(X), -1)
+    std = X.std(axis=0)
+    return (X - X.mean(axis=0)) / np.where(std > 0, std, 1.)
+
+
+def importance_sample(X: ndarray, size: int, rng: np.random.Generator) -> Tuple[ndarray, ndarray]:
+    """
+    Importance sampling of the rows: each row is kept independently with a probability proportional to its
+    sensitivity (half uniform, half squared distance to the mean in feature space) and capped at 1, with a weight
+    of 1 / probability, so any weighted sum (and pair sum) over the sample is an unbiased estimate of the sum
+    over all the rows.
+
+    :param X: The features of the rows.
+    :param size: The expected number of kept rows.
+    :param rng: Random generator.
+    :return: The indices of the kept rows and their weights.
+    """
+    n = len(X)
+    distances = np.sum(standardized(X) ** 2, axis=1)
+    sensitivity = .5 / n + .5 * distances / max(distances.sum(), 1e-12)
+
+    # inclusion probabilities min(1, c * sensitivity) summing to size
+    probabilities = np.minimum(1., size * sensitivity)
+    for _ in range(100):
+        capped = probabilities >= 1.
+        free = sensitivity[~capped].sum()
+        if free <= 0:
+            break
+        scale = (size - capped.sum()) / free
+        updated = np.minimum(1., scale * sensitivity)
+        if np.allclose(updated, probabilities):
+            break
+        probabilities = updated
+
+    kept = np.nonzero(rng.random(n) < probabilities)[0]
+    return kept, 1. / probabilities[kept]
+
+
+def k_center(X: ndarray, size: int, rng: np.random.Generator,
+             block_size: int = 65536) -> Tuple[ndarray, ndarray]:
+    """
+    Greedy k-center selection of the rows (farthest point first) in feature space. Each center is weighted by the
+    number of rows it is the nearest center of, so it stands for its cell.
+
+    :param X: The features of the rows.
+    :param size: The number of centers.
+    :param rng: Random generator of the first center.
+    :param block_size: Number of rows updated at a time.
+    :return: The indices of the centers and their weights.
+    """
+    Z = standardized(X)
+    n = len(Z)
+    size = min(size, n)
+    centers = np.empty(size, dtype=np.int64)
+    nearest_distance = np.full(n, np.inf)
+    nearest_center = np.zeros(n, dtype=np.int64)
+
+    centers[0] = rng.integers(n)
+    for k in range(size):
+        if k > 0:
+            centers[k] = np.argmax(nearest_distance)
+        center = Z[centers[k]]
+        for start in range(0, n, block_size):
+            block = slice(start, start + block_size)
+            distance = np.sum((Z[block] - center) ** 2, axis=1)
+            closer = distance < nearest_distance[block]
+            nearest_distance[block] = np.where(closer, distance, nearest_distance[block])
+            nearest_center[block] = np.where(closer, k, nearest_center[block])
+
+    weights = np.bincount(nearest_center, minlength=size).astype(np.float64)
+    order = np.argsort(centers)
+    return centers[order], weights[order]
+
+
+def build_coreset(X: ndarray, y: ndarray,
+                  size: Optional[int] = None,
+                  fraction: float = .1,
+                  method: str = 'importance',
+                  elevated_threshold: Optional[float] = None,
+                  seed: Optional[int] = None) -> Tuple[ndarray, ndarray]:
+    """
+    Coreset of a training set: all the SEP and elevated events with a weight of 1, and a weighted subset of the
+    background events.
+
+    :param X: The features.
+    :param y: The labels.
+    :param size: The (expected) number of background events kept. Default is fraction of the background events.
+    :param fraction: The fraction of background events kept when size is not given.
+    :param method: 'importance' (unbiased weights) or 'kcenter' (cell size weights).
+    :param elevated_threshold: The threshold of the background events (ln(10 / e^2) by default).
+    :param seed: Seed of the selection.
+    :return: The indices of the coreset (in the order of the set, so a shuffled set stays shuffled) and their
+             weights.
+    """
+    rng = np.random.default_rng(seed)
+    background = np.nonzero(background_mask(y, elevated_threshold))[0]
+    events = np.nonzero(~background_mask(y, elevated_threshold))[0]
+    if size is None:
+        size = int(np.ceil(fraction * len(background)))
+
+    if size >= len(background):
+        selected, selected_weights = np.arange(len(background)), np.ones(len(background))
+    elif method == 'importance':
+        selected, selected_weights = importance_sample(np.asarray(X)[background], size, rng)
+    elif method == 'kcenter':
+        selected, selected_weights = k_center(np.asarray(X)[background], size, rng)
+    else:
+        raise ValueError(f"Unknown coreset method: {method}.")
+
+    indices = np.concatenate([events, background[selected]])
+    weights = np.concatenate([np.ones(len(events)), selected_weights])
+    order = np.argsort(indices)
+    print(f"Coreset of {len(indices)} samples: {len(events)} SEP and elevated events and {len(selected)} of "
+          f"{len(background)} background events ({method})")
+    return indices[order], weights[order]
+
+
+def coreset_subset(X: ndarray, y: ndarray, **kwargs) -> Tuple[ndarray, ndarray, ndarray]:
+    """
+    The rows of the coreset of a training set (see build_coreset for the arguments).
+
+    :return: The features, the labels and the weights of the coreset.
+    """
+    indices, weights = build_coreset(X, y, **kwargs)
+    return X[indices], y[indices], weights
@@ -0,0 +1,135 @@
+##############################################################################################################
+# Description: zero-copy views of the splits of a fold. The subtraining, validation and test sets are stored
+# once in one backing array, so the combined training set (subtraining + validation) is a slice of it rather
+# than a concatenated copy, and the pair weights of a split are addressed in the pair weights of the combined
+# set by offset arithmetic.
+##############################################################################################################
+
+# types for type hinting
+from typing import Dict, List, Tuple, Union
+
+# imports
+import numpy as np
+from numpy import ndarray
+
+
+def triu_offset(i: Union[int, ndarray], j: Union[int, ndarray], n: int) -> Union[int, ndarray]:
+    """
+    Position of the pair (i, j), i < j, in the pairs of n samples in np.triu_indices(n, k=1) order
+    (the order of the joint weights of DenseJointReweights).
+
+    :param i: Index of the first sample of the pair.
+    :param j: Index of the second sample of the pair.
+    :param n: Number of samples.
+    :return: The position of the pair.
+    """
+    return i * (2 * n - i - 1) // 2 + (j - i - 1)
+
+
+def triu_block_positions(start: int, stop: int, n: int) -> ndarray:
+    """
+    Positions of the pairs of the samples [start, stop) in the pairs of n samples (np.triu_indices(n, k=1) order).
+    Row i of the block is a contiguous run of stop - i - 1 pairs, so the positions are built by offsets only.
+
+    :param start: First sample of the block.
+    :param stop: End of the block (exclusive).
+    :param n: Number of samples.
+    :return: The positions, in np.triu_indices(stop - start, k=1) order of the block.
+    """
+    rows = np.arange(start, stop - 1, dtype=np.int64)
+    lengths = stop - rows - 1
+    run_starts = triu_offset(rows, rows + 1, n)
+    # position within the run of each pair of the block
+    within = np.arange(lengths.sum(), dtype=np.int64) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return np.repeat(run_starts, lengths) + within
+
+
+def pair_block(joint_weights: ndarray, start: int, stop: int, n: int) -> Tuple[ndarray, List[Tuple[int, int]]]:
+    """
+    Joint weights of the pairs of the samples [start, stop) out of the joint weights of all the pairs of n samples.
+
+    :param joint_weights: The joint weights of the n samples, in np.triu_indices(n, k=1) order.
+    :param start: First sample of the block.
+    :param stop: End of the block (exclusive).
+    :param n: Number of samples.
+    :return: The joint weights of the block and their index pairs, relative to start.
+    """
+    weights = np.asarray(joint_weights)[triu_block_positions(start, stop, n)]
+    i, j = np.triu_indices(stop - start, k=1)
+    return weights, list(zip(i, j))
+
+
+class DatasetView:
+    """
+    Subtraining, validation, training (subtraining + validation) and test sets of a fold as views of one backing
+    array of features and one of labels. The sets are numpy slices, so they can be passed to DenseReweights,
+    the ModelBuilder training loops and the Evaluator without copying the data.
+    """
+
+    def __init__(self, X: ndarray, y: ndarray, len_subtrain: int, len_val: int) -> None:
+        """
+        :param X: The backing features, the subtraining, validation and test sets in this order.
+        :param y: The backing labels, in the same order.
+        :param len_subtrain: The size of the subtraining set.
+        :param len_val: The size of the validation set.
+        """
+        self.X = X
+        self.y = y
+        len_train = len_subtrain + len_val
+        self.slices: Dict[str, slice] = {
+            'subtrain': slice(0, len_subtrain),
+            'val': slice(len_subtrain, len_train),
+            'train': slice(0, len_train),
+            'test': slice(len_train, len(y)),
+        }
+
+    @classmethod
+    def from_splits(cls,
+                    train_x: ndarray, train_y: ndarray,
+                    val_x: ndarray, val_y: ndarray,
+                    test_x: ndarray, test_y: ndarray) -> 'DatasetView':
+        """
+        View of the splits loaded by SEPLoader (the only copy of the data is made here).
+
+        :param train_x, train_y: The subtraining set.
+        :param val_x, val_y: The validation set.
+        :param test_x, test_y: The test set.
+        :return: The dataset view.
+        """
+        X = np.concatenate([train_x, val_x, test_x], axis=0)
+        y = np.concatenate([train_y, val_y, test_y], axis=0)
+        return cls(X, y, len(train_y), len(val_y))
+
+    def __len__(self) -> int:
+        return len(self.y)
+
+    def __getitem__(self, name: str) -> Tuple[ndarray, ndarray]:
+        """
+        Features and labels of a set ('subtrain', 'val', 'train' or 'test'), as views of the backing arrays.
+        """
+        segment = self.slices[name]
+        return self.X[segment], self.y[segment]
+
+    def sizes(self) -> Dict[str, int]:
+        """
+        Size of each set.
+        """
+        return {name: segment.stop - segment.start for name, segment in self.slices.items()}
+
+    def pair_block(self, name: str, joint_weights: ndarray,
+                   within: str = 'train') -> Tuple[ndarray, List[Tuple[int, int]]]:
+        """
+        Joint weights of the pairs of a set, taken from the joint weights of an enclosing set (e.g. the
+        subtraining and validation pair weights out of the weights of the combined training set).
+
+        :param name: The set of the pairs, e.g. 'subtrain' or 'val'.
+        :param joint_weights: The joint weights of the enclosing set, in np.triu_indices order
+                              (DenseJointReweights.jreweights).
+        :param within: The enclosing set the weights were computed on.
+        :return: The joint weights of the set and their index pairs, relative to the set.
+        """
+        block, outer = self.slices[name], self.slices[within]
+        if block.start < outer.start or block.stop > outer.stop:
+            raise ValueError(f"The {name} set is not within the {within} set")
+        return pair_block(joint_weights, block.start - outer.start, block.stop - outer.start,
+                          outer.stop - outer.start)
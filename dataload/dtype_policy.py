@@ -0,0 +1,50 @@
+##############################################################################################################
+# Description: floating point dtype policy of the data, float32 by default (the DTYPE_POLICY environment
+# variable or set_dtype_policy to change it). The loaders, the reweighting and the pair weights store their
+# arrays in the policy dtype, so the batches reach the model without conversion; accumulators (metrics,
+# pair error sums) stay in float64.
+##############################################################################################################
+import os
+import sys
+# types for type hinting
+from typing import Optional, Union
+
+# imports
+import numpy as np
+from numpy import ndarray
+
+DTYPE_POLICY = np.dtype(os.environ.get('DTYPE_POLICY', 'float32'))
+
+
+def policy_dtype() -> np.dtype:
+    """
+    The dtype of the data arrays.
+    """
+    return DTYPE_POLICY
+
+
+def set_dtype_policy(dtype: Union[str, type, np.dtype]) -> None:
+    """
+    Set the dtype of the data arrays, and the Keras float type to match if TensorFlow is loaded
+    (set it before building the models).
+
+    :param dtype: 'float32' or 'float64'.
+    """
+    global DTYPE_POLICY
+    DTYPE_POLICY = np.dtype(dtype)
+    if 'tensorflow' in sys.modules:
+        sys.modules['tensorflow'].keras.backend.set_floatx(DTYPE_POLICY.name)
+
+
+def as_policy(values: Optional[ndarray]) -> Optional[ndarray]:
+    """
+    The values in the policy dtype (no copy if they already are).
+    """
+    if values is None:
+        return None
+    return np.asarray(values, dtype=DTYPE_POLICY)
+
+
+# the policy of the environment reaches Keras like set_dtype_policy (when TensorFlow is not loaded yet,
+# models.modeling applies it once it is)
+set_dtype_policy(DTYPE_POLICY)
@@ -1,62 +1,211 @@
 import os
+import re
 import pandas as pd
 import numpy as np
-from sklearn.utils import shuffle
-from typing import Tuple, Dict, Any, Optional
+from typing import Tuple, Dict, Any, Optional, List
+
+from dataload.dtype_policy import policy_dtype, as_policy
+
+
+# directory of the binary sidecar cache, next to the CSV files
+CACHE_DIR = '.npy_cache'
+# canonical copy of the sorted data, and the index files of the splits and of their shuffles
+CANONICAL_X = 'canonical_x.npy'
+CANONICAL_Y = 'canonical_y.npy'
+SPLIT_INDICES = 'split_indices.npz'
+SPLITS = ('train', 'val', 'test')
+
+
+def default_rng() -> np.random.Generator:
+    """
+    Random generator seeded from the global numpy random state (so np.random.seed keeps the splits reproducible).
+    """
+    return np.random.default_rng(np.random.randint(0, 2 ** 31 - 1))
+
+
+def group_choice(n: int, group_size: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    Pick one random position in every group of group_size consecutive positions (the last group may be smaller).
+
+    :param n: Number of positions.
+    :param group_size: Size of the groups.
+    :param rng: Random generator.
+    :return: Boolean mask of the picked positions, of length n.
+    """
+    mask = np.zeros(n, dtype=bool)
+    if n == 0:
+        return mask
+    num_groups = -(-n // group_size)
+    starts = np.arange(num_groups) * group_size
+    sizes = np.minimum(group_size, n - starts)
+    mask[starts + (rng.random(num_groups) * sizes).astype(np.int64)] = True
+    return mask
+
+
+def split_indices(n: int, rng: np.random.Generator) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Index arrays of the split of n sorted samples: one random sample of every 3 consecutive samples goes to the
+    test set, then one random sample of every 4 consecutive remaining samples goes to the validation set.
+
+    :param n: Number of samples.
+    :param rng: Random generator of the selection.
+    :return: train_indices, val_indices, test_indices
+    """
+    test_mask = group_choice(n, 3, rng)
+    remaining = np.nonzero(~test_mask)[0]
+    val_mask = group_choice(len(remaining), 4, rng)
+    return remaining[~val_mask], remaining[val_mask], np.nonzero(test_mask)[0]
+
+
+def shuffle_permutations(sizes: Dict[str, int], num_shuffles: int = 1,
+                         seed: Optional[int] = None) -> Dict[str, np.ndarray]:
+    """
+    Permutations of the sets shuffled num_shuffles times, derived from a seed. Shuffles are composed on the
+    indices, so the data itself is moved once when the permutation is applied.
+
+    :param sizes: Size of each set, name -> size.
+    :param num_shuffles: Number of times to shuffle each set.
+    :param seed: Seed of the shuffles.
+    :return: The permutation of each set, name -> indices.
+    """
+    rng = np.random.default_rng(seed)
+    permutations = {}
+    for name, size in sizes.items():
+        permutation = np.arange(size)
+        for _ in range(num_shuffles):
+            permutation = permutation[rng.permutation(size)]
+        permutations[name] = permutation
+    return permutations
+
+
+def save_npy(path: str, values: np.ndarray) -> None:
+    """
+    Save an array to a .npy file with an atomic rename, so concurrent readers never see a partial file.
+    """
+    tmp_path = f"{path[:-len('.npy')]}.{os.getpid()}.tmp.npy"
+    np.save(tmp_path, np.ascontiguousarray(values))
+    os.replace(tmp_path, path)
+
+
+def save_npz(path: str, **arrays: np.ndarray) -> None:
+    """
+    Save arrays to a .npz file with an atomic rename.
+    """
+    tmp_path = f"{path[:-len('.npz')]}.{os.getpid()}.tmp.npz"
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+
+
+def fold_indices(n: int, num_folds: int,
+                 rng: np.random.Generator) -> List[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    Index arrays of the K folds of n sorted samples: the test set of fold k is every K-th sample starting at k,
+    and one random sample of every 4 consecutive remaining samples goes to the validation set.
+
+    :param n: Number of samples.
+    :param num_folds: The number of folds.
+    :param rng: Random generator of the validation selection.
+    :return: (train_indices, val_indices, test_indices) of each fold.
+    """
+    positions = np.arange(n)
+    folds = []
+    for fold in range(num_folds):
+        test_mask = positions % num_folds == fold
+        remaining = positions[~test_mask]
+        val_mask = group_choice(len(remaining), 4, rng)
+        folds.append((remaining[~val_mask], remaining[val_mask], positions[test_mask]))
+    return folds
 
 
 class SEPLoader:
-    def __init__(self):
-        pass
+    def __init__(self, use_cache: bool = True, mmap_mode: Optional[str] = 'c'):
+        """
+        :param use_cache: Whether to read the shuffled CSV files through the binary sidecar cache (.npy files
+                          memory-mapped on read, rebuilt when the CSV file changes).
+        :param mmap_mode: Memory-map mode of the cached arrays ('c': copy-on-write, so the arrays can be modified
+                          in place without touching the cache; 'r': read-only; None: load in memory).
+        """
+        self.use_cache = use_cache
+        self.mmap_mode = mmap_mode
 
     def load(self, file_path: str, num_folds: Optional[int] = None, num_shuffles: int = 3, SEED: int = 42,
-             output_dir: str = 'data'):
+             output_dir: str = 'data', write_csv: bool = False):
         """
-        Load the data from a CSV file, split it, shuffle it, and save the shuffled sets to CSV files.
+        Load the data from a CSV file, split it and shuffle it. The sorted data is saved once (canonical .npy
+        files in output_dir) and each split directory only stores the index arrays of its sets and of their
+        shuffle (split_indices.npz, a few kilobytes), which load_from_dir applies on load.
 
         :param file_path: Path to the CSV file to load.
         :param num_folds: The number of folds to split the data into. If None, the data is not split into folds.
         :param num_shuffles: Number of times to shuffle each set.
         :param SEED: Optional random seed for reproducibility.
-        :param output_dir: Directory to save the output CSV files.
+        :param output_dir: Directory to save the output files.
+        :param write_csv: Whether to also write the shuffled sets to CSV files.
         :return: None
         """
 
         # Set random seed for reproducibility
         np.random.seed(SEED)
+        rng = np.random.default_rng(SEED)
 
-        # Get the split data
-        data_splits = self.read_data(file_path, num_folds)
+        # Save the canonical copy of the sorted data
+        features, target = self.sorted_arrays(pd.read_csv(file_path))
+        os.makedirs(output_dir, exist_ok=True)
+        save_npy(os.path.join(output_dir, CANONICAL_X), features)
+        save_npy(os.path.join(output_dir, CANONICAL_Y), target)
 
+        # Get the split indices
         if num_folds is None:
-            # Shuffle and save the single set of splits
-            shuffled_data = self.shuffle_sets(data_splits[0], data_splits[1],
-                                              data_splits[2], data_splits[3],
-                                              data_splits[4], data_splits[5],
-                                              num_shuffles, SEED)
-            self.save_shuffled_data_to_csv(*shuffled_data, dir_name=output_dir)
+            splits = {output_dir: split_indices(len(target), rng)}
         else:
-            # Iterate over each fold
-            for fold, data in data_splits.items():
-                # Create directory for the fold if it doesn't exist
-                fold_dir = os.path.join(output_dir, fold)
-                os.makedirs(fold_dir, exist_ok=True)
-                # Shuffle each fold's datasets the specified number of times
-                shuffled_data = self.shuffle_sets(data['train_x'], data['train_y'],
-                                                  data['val_x'], data['val_y'],
-                                                  data['test_x'], data['test_y'],
-                                                  num_shuffles, SEED)
-
-                # Save the shuffled data to CSV files inside the fold directory
-                self.save_shuffled_data_to_csv(*shuffled_data, dir_name=fold_dir)
+            splits = {os.path.join(output_dir, f"fold_{fold + 1}"): indices
+                      for fold, indices in enumerate(fold_indices(len(target), num_folds, rng))}
+
+        for split_dir, indices in splits.items():
+            # Create directory for the fold if it doesn't exist
+            os.makedirs(split_dir, exist_ok=True)
+            indices = dict(zip(SPLITS, indices))
+            # Shuffle each set the specified number of times, on the indices
+            permutations = shuffle_permutations({name: len(idx) for name, idx in indices.items()},
+                                                num_shuffles, SEED)
+            shuffled = {name: idx[permutations[name]] for name, idx in indices.items()}
+            save_npz(os.path.join(split_dir, SPLIT_INDICES),
+                     canonical=np.array(os.path.relpath(output_dir, split_dir)), **shuffled)
+
+            if write_csv:
+                self.save_shuffled_data_to_csv(*self.apply_indices(features, target, shuffled), dir_name=split_dir)
+
+    def add_shuffle(self, dir_path: str, seed: int, num_shuffles: int = 1) -> str:
+        """
+        Save a new shuffle variant of the sets of a split directory (index arrays only).
 
-    def load_from_dir(self, dir_path: str):
+        :param dir_path: The split directory (containing split_indices.npz).
+        :param seed: Seed of the shuffle, it names the variant.
+        :param num_shuffles: Number of times to shuffle each set.
+        :return: The path of the variant, loaded with load_from_dir(dir_path, shuffle_seed=seed).
         """
-        Load the shuffled data sets from CSV files in a specified directory.
+        with np.load(os.path.join(dir_path, SPLIT_INDICES)) as split:
+            canonical = split['canonical']
+            indices = {name: split[name] for name in SPLITS}
+        permutations = shuffle_permutations({name: len(idx) for name, idx in indices.items()}, num_shuffles, seed)
+        path = os.path.join(dir_path, f"split_indices_{seed}.npz")
+        save_npz(path, canonical=canonical, **{name: idx[permutations[name]] for name, idx in indices.items()})
+        return path
+
+    def load_from_dir(self, dir_path: str, shuffle_seed: Optional[int] = None):
+        """
+        Load the shuffled data sets of a specified directory: from the index files if the data was saved by load,
+        else from the shuffled CSV files.
 
-        :param dir_path: Directory path containing the shuffled CSV files.
+        :param dir_path: Directory path containing the split indices or the shuffled CSV files.
+        :param shuffle_seed: The seed of a shuffle variant saved by add_shuffle (default: the shuffle of load).
         :return: data = (train_x, train_y, val_x, val_y, test_x, test_y)
         """
+        name = SPLIT_INDICES if shuffle_seed is None else f"split_indices_{shuffle_seed}.npz"
+        indices_file = os.path.join(dir_path, name)
+        if os.path.exists(indices_file):
+            return self.read_indexed_data(indices_file)
+
         train_file = os.path.join(dir_path, 'shuffled_train.csv')
         val_file = os.path.join(dir_path, 'shuffled_val.csv')
         test_file = os.path.join(dir_path, 'shuffled_test.csv')
@@ -65,21 +214,39 @@ class SEPLoader:
 
         return data
 
-    def load_fold_from_dir(self, dir_path: str, fold_id: int):
+    def load_fold_from_dir(self, dir_path: str, fold_id: int, shuffle_seed: Optional[int] = None):
         """
-        Load the shuffled data sets from CSV files in a specified directory.
+        Load the shuffled data sets of a fold in a specified directory.
 
         :param fold_id: the fold to load data from
-        :param dir_path: Directory path containing the shuffled CSV files.
+        :param dir_path: Directory path containing the fold directories.
+        :param shuffle_seed: The seed of a shuffle variant saved by add_shuffle (default: the shuffle of load).
         :return: fold(train_x, train_y, val_x, val_y, test_x, test_y)
         """
-        train_file = os.path.join(dir_path + f'/fold_{fold_id}', 'shuffled_train.csv')
-        val_file = os.path.join(dir_path + f'/fold_{fold_id}', 'shuffled_val.csv')
-        test_file = os.path.join(dir_path + f'/fold_{fold_id}', 'shuffled_test.csv')
+        return self.load_from_dir(dir_path + f'/fold_{fold_id}', shuffle_seed)
 
-        fold_data = self.read_shuffled_data_from_csv(train_file, val_file, test_file)
+    def read_indexed_data(self, indices_file: str):
+        """
+        Read the data sets of a split from the canonical data and the index arrays of the sets.
+
+        :param indices_file: Path to the split indices (.npz).
+        :return: train_x, train_y, val_x, val_y, test_x, test_y
+        """
+        with np.load(indices_file) as split:
+            canonical_dir = os.path.join(os.path.dirname(indices_file), str(split['canonical']))
+            indices = {name: split[name] for name in SPLITS}
+        # the canonical data is memory-mapped, only the rows of the sets are read
+        features = np.load(os.path.join(canonical_dir, CANONICAL_X), mmap_mode=self.mmap_mode)
+        target = np.load(os.path.join(canonical_dir, CANONICAL_Y), mmap_mode=self.mmap_mode)
+        return tuple(as_policy(values) for values in self.apply_indices(features, target, indices))
+
+    def apply_indices(self, features: np.ndarray, target: np.ndarray, indices: Dict[str, np.ndarray]):
+        """
+        The sets selected by their index arrays.
 
-        return fold_data
+        :return: train_x, train_y, val_x, val_y, test_x, test_y
+        """
+        return tuple(values for name in SPLITS for values in (features[indices[name]], target[indices[name]]))
 
     def combine(self, *data: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
         """
@@ -97,113 +264,75 @@ class SEPLoader:
 
         return combined_x, combined_y
 
-    def read_data(self, file_path: str, num_folds=None):
+    def read_data(self, file_path: str, num_folds=None, rng: Optional[np.random.Generator] = None):
         """
         Read data from a CSV file and split it into training, validation, and test sets.
 
         :param file_path: Path to the CSV file.
+        :param num_folds: The number of folds to split the data into. If None, the data is not split into folds.
+        :param rng: Random generator of the split (default: seeded from the global numpy seed).
         :return: Shuffled versions of train_x, train_y, val_x, val_y, test_x, test_y
         """
         # Read the CSV file
         df = pd.read_csv(file_path)
         if num_folds is None:
             # Split the data into training, validation, and test sets
-            return self.split_data(df)
+            return self.split_data(df, rng)
         else:
-            return self.split_data_folds(df, num_folds)
+            return self.split_data_folds(df, num_folds, rng)
 
-    def split_data(self, df):
+    def sorted_arrays(self, df: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Features and target of the data sorted by 'log_peak_intensity' in descending order.
+
+        :param df: DataFrame containing the data. Assumes 'log_peak_intensity' is the target column.
+        :return: features, target
         """
-        Splits the data into training, validation, and test sets according to the specified rules.
+        target = df['log_peak_intensity'].to_numpy(dtype=policy_dtype())
+        features = df.drop(columns=['log_peak_intensity']).to_numpy(dtype=policy_dtype())
+        order = np.argsort(-target, kind='stable')
+        return features[order], target[order]
+
+    def split_data(self, df, rng: Optional[np.random.Generator] = None):
+        """
+        Splits the data into training, validation, and test sets according to the specified rules:
+        one random sample of every 3 consecutive (sorted) samples goes to the test set, then one random sample
+        of every 4 consecutive remaining samples goes to the validation set.
 
         :param:
         - df: DataFrame containing the data. Assumes 'log_peak_intensity' is the target column.
+        - rng: Random generator of the split (default: seeded from the global numpy seed).
 
         :return:
         - train_x, train_y, val_x, val_y, test_x, test_y: Numpy arrays containing the split data
         """
-        # Sort the DataFrame by 'log_peak_intensity' in descending order
-        df_sorted = df.sort_values(by='log_peak_intensity', ascending=False).reset_index(drop=True)
-
-        # Initialize empty lists to store indices for training, validation, and test sets
-        train_indices = []
-        val_indices = []
-        test_indices = []
-
-        # Group every 3 rows for test set selection
-        for i in range(0, len(df_sorted), 3):
-            group = list(range(i, min(i + 3, len(df_sorted))))
-            test_idx = np.random.choice(group, 1)[0]
-            train_indices.extend([idx for idx in group if idx != test_idx])
-            test_indices.append(test_idx)
-
-        # Group every 4 rows for validation set selection from the training set
-        for i in range(0, len(train_indices), 4):
-            group = train_indices[i: i + 4]
-            if len(group) == 0:
-                continue
-            val_idx = np.random.choice(group, 1)[0]
-            val_indices.append(val_idx)
-            train_indices = [idx for idx in train_indices if idx != val_idx]
-
-        # Extract the feature and target sets based on selected indices
-        features = df_sorted.drop(columns=['log_peak_intensity']).to_numpy()
-        target = df_sorted['log_peak_intensity'].to_numpy()
-
-        train_x = features[train_indices]
-        train_y = target[train_indices]
-        val_x = features[val_indices]
-        val_y = target[val_indices]
-        test_x = features[test_indices]
-        test_y = target[test_indices]
+        rng = rng if rng is not None else default_rng()
+        features, target = self.sorted_arrays(df)
 
-        return train_x, train_y, val_x, val_y, test_x, test_y
+        train_indices, val_indices, test_indices = split_indices(len(target), rng)
 
-    def split_data_folds(self, df: pd.DataFrame, num_folds: int = 3) -> Dict[str, Any]:
+        return (features[train_indices], target[train_indices],
+                features[val_indices], target[val_indices],
+                features[test_indices], target[test_indices])
+
+    def split_data_folds(self, df: pd.DataFrame, num_folds: int = 3,
+                         rng: Optional[np.random.Generator] = None) -> Dict[str, Any]:
         """
         Splits the data into training, validation, and test sets according to the specified number of folds.
         Each fold's test set is picked sequentially rather than at random.
 
         :param df: DataFrame containing the data. Assumes 'log_peak_intensity' is the target column.
         :param num_folds: The number of folds to use for splitting the data.
+        :param rng: Random generator of the validation selection (default: seeded from the global numpy seed).
 
         :return: A dictionary containing the split data for each fold.
         """
-        # Sort the DataFrame by 'log_peak_intensity' in descending order
-        df_sorted = df.sort_values(by='log_peak_intensity', ascending=False).reset_index(drop=True)
+        rng = rng if rng is not None else default_rng()
+        features, target = self.sorted_arrays(df)
 
-        # Initialize the dictionary to hold the splits for each fold
         fold_splits = {}
-
-        # Perform the split for each fold
-        for fold in range(num_folds):
-            train_indices = []
-            val_indices = []
-            test_indices = []
-
-            # Select test indices based on the current fold
-            for i in range(fold, len(df_sorted), num_folds):
-                test_indices.append(i)
-                # The remaining indices of the group go to training
-                train_indices.extend([i + offset for offset in range(1, num_folds) if i + offset < len(df_sorted)])
-
-            # Group every 4 rows for validation set selection from the training set
-            remaining_indices = list(set(range(len(df_sorted))) - set(test_indices))
-            for i in range(0, len(remaining_indices), 4):
-                group = remaining_indices[i: i + 4]
-                if len(group) == 0:
-                    continue
-                val_idx = np.random.choice(group, 1)[0]
-                val_indices.append(val_idx)
-                remaining_indices = [idx for idx in remaining_indices if idx != val_idx]
-
-            # Update the training indices after selecting validation indices
-            train_indices = list(set(train_indices) - set(val_indices))
-
-            # Extract the feature and target sets based on selected indices
-            features = df_sorted.drop(columns=['log_peak_intensity']).to_numpy()
-            target = df_sorted['log_peak_intensity'].to_numpy()
-
+        for fold, (train_indices, val_indices, test_indices) in enumerate(
+                fold_indices(len(target), num_folds, rng)):
             fold_splits[f"fold_{fold + 1}"] = {
                 'train_x': features[train_indices],
                 'train_y': target[train_indices],
@@ -228,10 +357,11 @@ class SEPLoader:
         :return:
         - Shuffled versions of train_x, train_y, val_x, val_y, test_x, test_y
         """
-        for _ in range(num_shuffles):
-            train_x, train_y = shuffle(train_x, train_y, random_state=SEED)
-            val_x, val_y = shuffle(val_x, val_y, random_state=SEED)
-            test_x, test_y = shuffle(test_x, test_y, random_state=SEED)
+        permutations = shuffle_permutations({'train': len(train_y), 'val': len(val_y), 'test': len(test_y)},
+                                            num_shuffles, SEED)
+        train_x, train_y = train_x[permutations['train']], train_y[permutations['train']]
+        val_x, val_y = val_x[permutations['val']], val_y[permutations['val']]
+        test_x, test_y = test_x[permutations['test']], test_y[permutations['test']]
 
         return train_x, train_y, val_x, val_y, test_x, test_y
 
@@ -266,7 +396,7 @@ class SEPLoader:
 
     def read_shuffled_data_from_csv(self, train_file, val_file, test_file):
         """
-        Read the shuffled data sets from CSV files.
+        Read the shuffled data sets from CSV files (through the binary sidecar cache if enabled).
 
         :param:
         - train_file, val_file, test_file: Paths to the CSV files for training, validation, and test sets.
@@ -274,16 +404,77 @@ class SEPLoader:
         :return:
         - train_x, train_y, val_x, val_y, test_x, test_y: Numpy arrays containing the features and labels
         """
-        train_df = pd.read_csv(train_file)
-        val_df = pd.read_csv(val_file)
-        test_df = pd.read_csv(test_file)
+        read = self.read_cached_csv if self.use_cache else self.read_csv
+        train_x, train_y = read(train_file)
+        val_x, val_y = read(val_file)
+        test_x, test_y = read(test_file)
+
+        return train_x, train_y, val_x, val_y, test_x, test_y
+
+    def read_csv(self, file_path: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Parse a shuffled CSV file (label in the first column, features in the others).
 
+        :param file_path: Path to the CSV file.
+        :return: features, labels
+        """
+        df = pd.read_csv(file_path)
         # Extract features and labels
-        train_x = train_df.iloc[:, 1:].to_numpy()
-        train_y = train_df.iloc[:, 0].to_numpy()
-        val_x = val_df.iloc[:, 1:].to_numpy()
-        val_y = val_df.iloc[:, 0].to_numpy()
-        test_x = test_df.iloc[:, 1:].to_numpy()
-        test_y = test_df.iloc[:, 0].to_numpy()
+        x = df.iloc[:, 1:].to_numpy(dtype=policy_dtype())
+        y = df.iloc[:, 0].to_numpy(dtype=policy_dtype())
+        return x, y
 
-        return train_x, train_y, val_x, val_y, test_x, test_y
+    def cache_paths(self, file_path: str) -> Tuple[str, str]:
+        """
+        Paths of the cached features and labels of a CSV file. The source size and modification time (and the
+        policy dtype) are part of the names, so a changed CSV file never matches a stale cache.
+
+        :param file_path: Path to the CSV file.
+        :return: path of the features .npy, path of the labels .npy
+        """
+        prefix = os.path.join(os.path.dirname(file_path), CACHE_DIR,
+                              f"{self.cache_version(file_path)}_{policy_dtype().name}")
+        return f"{prefix}_x.npy", f"{prefix}_y.npy"
+
+    @staticmethod
+    def cache_version(file_path: str) -> str:
+        """
+        Name of the current version of a CSV file in the cache: its stem, size and modification time.
+        """
+        stat = os.stat(file_path)
+        stem = os.path.splitext(os.path.basename(file_path))[0]
+        return f"{stem}_{stat.st_size}_{stat.st_mtime_ns}"
+
+    def read_cached_csv(self, file_path: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Read a shuffled CSV file through its binary sidecar cache. The first read parses the CSV file and saves
+        the features and labels as contiguous .npy files, the next reads memory-map them (no parsing, and
+        worker processes reading the same fold share the pages).
+
+        :param file_path: Path to the CSV file.
+        :return: features, labels
+        """
+        x_path, y_path = self.cache_paths(file_path)
+        if not (os.path.exists(x_path) and os.path.exists(y_path)):
+            x, y = self.read_csv(file_path)
+            cache_dir = os.path.dirname(x_path)
+            os.makedirs(cache_dir, exist_ok=True)
+            # remove the caches of previous versions of the file (the caches of the current version in another
+            # dtype are kept, workers with different policies share the directory)
+            stem = os.path.splitext(os.path.basename(file_path))[0]
+            cache_name = re.compile(rf"{re.escape(stem)}_\d+_\d+_\w+_[xy]\.npy")
+            current = f"{self.cache_version(file_path)}_"
+            for name in os.listdir(cache_dir):
+                path = os.path.join(cache_dir, name)
+                if cache_name.fullmatch(name) and not name.startswith(current):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+            # write to a temporary file and rename (atomic), concurrent readers never see a partial cache
+            save_npy(x_path, x)
+            save_npy(y_path, y)
+            if self.mmap_mode is None:
+                return x, y
+
+        return np.load(x_path, mmap_mode=self.mmap_mode), np.load(y_path, mmap_mode=self.mmap_mode)
@@ -0,0 +1,265 @@
+##############################################################################################################
+# Description: out-of-core loading of catalogs too large for memory. A catalog (CSV files, or binary shards of
+# .npy files written by write_shards) is read in chunks and streamed as X/y/sample-weight batches through a
+# tf.data pipeline (parallel interleave of the files, prefetch), so training and evaluation never hold the
+# full array.
+##############################################################################################################
+import glob
+import os
+# types for type hinting
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+# imports
+import tensorflow as tf
+from numpy import ndarray
+
+from dataload.dtype_policy import policy_dtype, as_policy
+from dataload.seploader import save_npy
+
+# shards written by write_shards: shard_<index>_x.npy and shard_<index>_y.npy
+SHARD_PATTERN = 'shard_*_x.npy'
+
+
+def csv_chunk_arrays(df: pd.DataFrame, label_column: Union[int, str]) -> Tuple[ndarray, ndarray]:
+    """
+    Features and labels of a chunk of a catalog, in the policy dtype.
+
+    :param df: The chunk.
+    :param label_column: The label column, by name or position.
+    :return: features, labels
+    """
+    label = df.columns[label_column] if isinstance(label_column, int) else label_column
+    x = df.drop(columns=[label]).to_numpy(dtype=policy_dtype())
+    y = df[label].to_numpy(dtype=policy_dtype())
+    return x, y
+
+
+def write_shards(file_path: str, shard_dir: str, label_column: Union[int, str] = 'log_peak_intensity',
+                 rows_per_shard: int = 262144) -> List[str]:
+    """
+    Convert a CSV catalog to binary shards, reading it in chunks (the catalog is never fully in memory).
+
+    :param file_path: Path to the CSV catalog.
+    :param shard_dir: The directory of the shards.
+    :param label_column: The label column, by name or position.
+    :param rows_per_shard: Number of rows per shard.
+    :return: The paths of the feature shards.
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    paths = []
+    for index, df in enumerate(pd.read_csv(file_path, chunksize=rows_per_shard)):
+        x, y = csv_chunk_arrays(df, label_column)
+        prefix = os.path.join(shard_dir, f"shard_{index:05d}")
+        save_npy(f"{prefix}_y.npy", y)
+        # the feature shard is written last, so a listed shard is complete
+        save_npy(f"{prefix}_x.npy", x)
+        paths.append(f"{prefix}_x.npy")
+    print(f"Wrote {len(paths)} shards of {file_path} to {shard_dir}")
+    return paths
+
+
+class StreamingCatalog:
+    """
+    A catalog read in chunks from CSV files or binary shards, streamed as a tf.data pipeline.
+    ModelBuilder.train_pds, ModelBuilder.train_reg_head and Evaluator.evaluate accept it in place of the arrays.
+    """
+
+    def __init__(self,
+                 sources: Union[str, List[str]],
+                 label_column: Union[int, str] = 0,
+                 weight_fn: Optional[Callable[[ndarray], ndarray]] = None,
+                 chunk_size: int = 65536,
+                 cycle_length: int = 4,
+                 deterministic: bool = True) -> None:
+        """
+        :param sources: A CSV file, a shard directory, or a list of them.
+        :param label_column: The label column of the CSV files, by name or position (0 for the shuffled CSV files
+                             of SEPLoader).
+        :param weight_fn: Optional function mapping the labels of a chunk to their sample weights
+                          (e.g. a fitted DenseReweights: lambda y: dr.normalized_reweight(y, dr.alpha)).
+        :param chunk_size: Number of rows read at a time from a file.
+        :param cycle_length: Number of files read in parallel.
+        :param deterministic: Whether the interleave keeps a deterministic order.
+        """
+        sources = [sources] if isinstance(sources, str) else list(sources)
+        self.units = []
+        for source in sources:
+            if os.path.isdir(source):
+                self.units += sorted(glob.glob(os.path.join(source, SHARD_PATTERN)))
+            else:
+                self.units.append(source)
+        if not self.units:
+            raise ValueError(f"No catalog files in {sources}")
+        self.label_column = label_column
+        self.weight_fn = weight_fn
+        self.chunk_size = chunk_size
+        self.cycle_length = cycle_length
+        self.deterministic = deterministic
+        self._num_samples: Optional[int] = None
+        self._n_features: Optional[int] = None
+
+    def chunks(self, unit: Union[str, bytes]) -> Iterator[Tuple[ndarray, ...]]:
+        """
+        Chunks of one file, as (x, y) or (x, y, sample weights).
+
+        :param unit: Path of a CSV file or of a feature shard.
+        :return: Iterator over the chunks.
+        """
+        unit = unit.decode() if isinstance(unit, bytes) else unit
+        if unit.endswith('_x.npy'):
+            # memory-mapped shard, only the rows of the current chunk are read
+            x_all = np.load(unit, mmap_mode='r')
+            y_all = np.load(unit[:-len('_x.npy')] + '_y.npy', mmap_mode='r')
+            parts = ((x_all[start:start + self.chunk_size], y_all[start:start + self.chunk_size])
+                     for start in range(0, len(y_all), self.chunk_size))
+        else:
+            parts = (csv_chunk_arrays(df, self.label_column)
+                     for df in pd.read_csv(unit, chunksize=self.chunk_size))
+        for x, y in parts:
+            x, y = as_policy(x), as_policy(y).reshape(-1)
+            if self.weight_fn is None:
+                yield x, y
+            else:
+                yield x, y, as_policy(self.weight_fn(y)).reshape(-1)
+
+    @property
+    def n_features(self) -> int:
+        """
+        Number of features of the catalog.
+        """
+        if self._n_features is None:
+            self._n_features = next(self.chunks(self.units[0]))[0].shape[1]
+        return self._n_features
+
+    @property
+    def num_samples(self) -> int:
+        """
+        Number of samples of the catalog (from the shard headers, or by counting the lines of the CSV files).
+        """
+        if self._num_samples is None:
+            total = 0
+            for unit in self.units:
+                if unit.endswith('_x.npy'):
+                    total += len(np.load(unit, mmap_mode='r'))
+                else:
+                    with open(unit, 'rb') as f:
+                        total += sum(1 for _ in f) - 1
+            self._num_samples = total
+        return self._num_samples
+
+    def __len__(self) -> int:
+        return self.num_samples
+
+    def dataset(self,
+                batch_size: int,
+                shuffle_buffer: int = 0,
+                seed: Optional[int] = None,
+                repeat: bool = False,
+                output_name: Optional[str] = None) -> tf.data.Dataset:
+        """
+        The catalog as batches of a tf.data pipeline: the files are read in parallel (interleave), the chunks
+        are rebatched, optionally shuffled in a buffer, and prefetched.
+
+        :param batch_size: Number of samples per batch.
+        :param shuffle_buffer: Size of the shuffle buffer, 0 to keep the file order.
+        :param seed: Seed of the shuffle.
+        :param repeat: Whether to repeat the catalog indefinitely.
+        :param output_name: Name of the model output of the labels (e.g. 'regression_head'), None for a single
+                            output model.
+        :return: Dataset of (x, y) or (x, y, sample weights) batches.
+        """
+        dtype = tf.as_dtype(policy_dtype())
+        signature = (tf.TensorSpec([None, self.n_features], dtype), tf.TensorSpec([None], dtype))
+        if self.weight_fn is not None:
+            signature += (tf.TensorSpec([None], dtype),)
+
+        units = tf.data.Dataset.from_tensor_slices(self.units)
+        data = units.interleave(
+            lambda unit: tf.data.Dataset.from_generator(self.chunks, args=(unit,), output_signature=signature),
+            cycle_length=min(self.cycle_length, len(self.units)),
+            num_parallel_calls=tf.data.AUTOTUNE,
+            deterministic=self.deterministic)
+        data = data.unbatch()
+        if shuffle_buffer > 0:
+            data = data.shuffle(shuffle_buffer, seed=seed)
+        data = data.batch(batch_size)
+        if output_name is not None:
+            data = data.map(lambda x, y, *w: (x, {output_name: y}, *w), num_parallel_calls=tf.data.AUTOTUNE)
+        if repeat:
+            data = data.repeat()
+        return data.prefetch(tf.data.AUTOTUNE)
+
+
+def fit_inputs(X: Union[ndarray, StreamingCatalog],
+               y: Optional[ndarray],
+               batch_size: int,
+               sample_weight: Optional[ndarray] = None,
+               output_name: Optional[str] = None,
+               shuffle_buffer: Optional[int] = None,
+               seed: Optional[int] = None) -> Tuple[Dict[str, Any], int]:
+    """
+    Training data arguments of model.fit for arrays or a streaming catalog (batch_size <= 0 for full batch).
+    model.fit does not shuffle datasets, so the catalog is shuffled in a buffer, reshuffled every epoch like
+    the arrays (the batch composition matters to the pairwise losses).
+
+    :param X: The features, or a streaming catalog.
+    :param y: The labels (None for a catalog).
+    :param batch_size: The batch size.
+    :param sample_weight: Optional sample weights of the arrays.
+    :param output_name: Name of the model output of the labels, None for a single output model.
+    :param shuffle_buffer: Size of the shuffle buffer of a catalog. Default is 4 batches (no shuffle for full batch).
+    :param seed: Seed of the shuffle of a catalog.
+    :return: The model.fit arguments, and the number of samples.
+    """
+    if isinstance(X, StreamingCatalog):
+        n = X.num_samples
+        if batch_size <= 0:
+            return {'x': X.dataset(n, output_name=output_name)}, n
+        if shuffle_buffer is None:
+            shuffle_buffer = 4 * batch_size
+        return {'x': X.dataset(batch_size, shuffle_buffer=shuffle_buffer, seed=seed, output_name=output_name)}, n
+    n = len(y)
+    return {'x': X, 'y': {output_name: y} if output_name is not None else y, 'sample_weight': sample_weight,
+            'batch_size': batch_size if batch_size > 0 else n}, n
+
+
+def validation_inputs(X: Union[ndarray, StreamingCatalog],
+                      y: Optional[ndarray],
+                      batch_size: int,
+                      sample_weight: Optional[ndarray] = None,
+                      output_name: Optional[str] = None,
+                      shuffle_buffer: int = 0,
+                      seed: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Validation data arguments of model.fit for arrays or a streaming catalog (batch_size <= 0 for full batch).
+    The validation catalog keeps its order by default, like the validation arrays.
+    """
+    if isinstance(X, StreamingCatalog):
+        if batch_size <= 0:
+            return {'validation_data': X.dataset(X.num_samples, output_name=output_name)}
+        return {'validation_data': X.dataset(batch_size, shuffle_buffer=shuffle_buffer, seed=seed,
+                                             output_name=output_name)}
+    targets = {output_name: y} if output_name is not None else y
+    return {'validation_data': (X, targets) if sample_weight is None else (X, targets, sample_weight),
+            'validation_batch_size': batch_size if batch_size > 0 else len(y)}
+
+
+def predict_stream(model: tf.keras.Model, catalog: StreamingCatalog,
+                   batch_size: int = 4096) -> Tuple[ndarray, Union[ndarray, List[ndarray]]]:
+    """
+    Predictions of a model over a streaming catalog (only the labels and the outputs are kept in memory).
+
+    :param model: The model.
+    :param catalog: The catalog.
+    :param batch_size: Number of samples per predict batch.
+    :return: The labels, and the predictions (a list of arrays for a multi-output model).
+    """
+    labels, chunks = [], []
+    for batch in catalog.dataset(batch_size):
+        outputs = model(batch[0], training=False)
+        labels.append(batch[1].numpy())
+        chunks.append([output.numpy() for output in (outputs if isinstance(outputs, (list, tuple)) else [outputs])])
+    outputs = [np.concatenate(parts) for parts in zip(*chunks)]
+    return np.concatenate(labels), outputs if len(outputs) > 1 else outputs[0]
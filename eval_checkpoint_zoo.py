@@ -0,0 +1,21 @@
+from evaluate.checkpoint_zoo import evaluate_checkpoint_zoo
+
+
+def main():
+    """
+    Evaluate all the saved checkpoints of a directory on a fold and write one metrics table.
+    :return: None
+    """
+    # root = "/home1/jmoukpe2016/keras-functional-api"
+    root = "."
+    checkpoints = root + "/10-29-2023"
+    data_dir = root + '/cme_and_electron/fold/fold_1'
+
+    table = evaluate_checkpoint_zoo(checkpoints, data_dir,
+                                    output_path='checkpoint_zoo_metrics.csv',
+                                    n_workers=4)
+    print(table)
+
+
+if __name__ == '__main__':
+    main()
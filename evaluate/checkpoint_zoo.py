@@ -0,0 +1,236 @@
+##############################################################################################################
+# Description: batch evaluation of a zoo of saved checkpoints (model_weights_*.h5, extended_model_weights_*.h5).
+# Checkpoints are grouped by architecture, each architecture is built once with a compiled predict function
+# and the weights are swapped in with load_weights. Groups are spread across worker processes and the
+# metrics of all the checkpoints are written to one table.
+##############################################################################################################
+import glob
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+# types for type hinting
+from typing import Optional, Dict, List, Tuple, Callable, Any
+
+import numpy as np
+import pandas as pd
+# imports
+import tensorflow as tf
+from numpy import ndarray
+
+from dataload import seploader as sepl
+from dataload.dataset_view import DatasetView
+from dataload.dtype_policy import policy_dtype, as_policy
+from evaluate.metrics import compute_metrics
+from evaluate.utils import build_model
+from models.modeling import pair_error_sums
+
+MODEL_TYPES = ['features_reg_dec', 'features_reg', 'features_dec', 'features']
+# shorthand tags of the early experiments (e.g. best_model_weights_..._dl_dec.h5, dl: dense joint loss)
+TAG_MODEL_TYPES = {'dl': 'features', 'dl_dec': 'features_dec', 'dl_reg': 'features_reg',
+                   'dl_reg_dec': 'features_reg_dec'}
+CHECKPOINT_PATTERN = re.compile(
+    r'^(?P<prefix>(?:best_|final_|extended_)?)model_weights_(?P<ae>ae_)?'
+    r'(?P<timestamp>\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2})_?(?P<tag>.*)\.h5$')
+
+
+def parse_checkpoint(path: str, default_model_type: Optional[str] = None) -> Optional[Tuple[str, bool]]:
+    """
+    Architecture of a checkpoint from its file name.
+
+    :param path: Path of the .h5 weights.
+    :param default_model_type: Model type to use when the name does not tell it, None to skip such files.
+    :return: (model_type, with_head), or None if the architecture is unknown.
+    """
+    match = CHECKPOINT_PATTERN.match(os.path.basename(path))
+    if match is None:
+        return None
+    with_head = match.group('prefix') == 'extended_'
+    tag = match.group('tag')
+
+    found = re.search(r'features(?:_reg)?(?:_dec)?', tag)
+    if found is not None:
+        model_type = found.group(0)
+    elif tag in TAG_MODEL_TYPES:
+        model_type = TAG_MODEL_TYPES[tag]
+    elif match.group('ae'):
+        model_type = 'features_reg_dec'
+    else:
+        model_type = default_model_type
+    if model_type is None:
+        return None
+    return model_type, with_head
+
+
+def group_checkpoints(paths: List[str],
+                      parse: Callable[[str], Optional[Tuple[str, bool]]] = parse_checkpoint
+                      ) -> Tuple[Dict[Tuple[str, bool], List[str]], List[str]]:
+    """
+    Group checkpoints by architecture.
+
+    :param paths: The paths of the checkpoints.
+    :param parse: Function mapping a path to its (model_type, with_head), or None if unknown.
+    :return: The paths of each architecture, and the paths of unknown architecture.
+    """
+    groups: Dict[Tuple[str, bool], List[str]] = {}
+    unknown = []
+    for path in sorted(paths):
+        spec = parse(path)
+        if spec is None:
+            unknown.append(path)
+        else:
+            groups.setdefault(spec, []).append(path)
+    return groups, unknown
+
+
+def compiled_predict(model: tf.keras.Model, input_dim: int) -> Callable[[tf.Tensor], Any]:
+    """
+    Predict function traced once for the architecture (a fixed input signature with any batch size),
+    so swapping the weights in does not retrace it.
+
+    :param model: The model.
+    :param input_dim: The input dimension.
+    :return: The compiled predict function.
+    """
+    @tf.function(input_signature=[tf.TensorSpec([None, input_dim], tf.as_dtype(policy_dtype()))])
+    def predict(x):
+        return model(x, training=False)
+
+    return predict
+
+
+def predict_outputs(predict: Callable[[tf.Tensor], Any], X: ndarray, batch_size: int) -> List[ndarray]:
+    """
+    All the outputs of the model on X, predicted in batches.
+
+    :param predict: The compiled predict function.
+    :param X: The inputs.
+    :param batch_size: Number of samples per batch.
+    :return: The list of outputs (one array per model output).
+    """
+    chunks = []
+    for start in range(0, len(X), batch_size):
+        outputs = predict(tf.constant(as_policy(X[start:start + batch_size])))
+        chunks.append([output.numpy() for output in (outputs if isinstance(outputs, (list, tuple)) else [outputs])])
+    return [np.concatenate(parts) for parts in zip(*chunks)]
+
+
+def evaluate_group(spec: Tuple[str, bool],
+                   paths: List[str],
+                   datasets: Dict[str, Tuple[ndarray, ndarray]],
+                   threshold: float = 10,
+                   batch_size: int = 4096,
+                   with_repr_loss: bool = True,
+                   arch_kwargs: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    """
+    Evaluate the checkpoints of one architecture: the model is built once and the weights swapped in.
+
+    :param spec: The (model_type, with_head) of the architecture.
+    :param paths: The checkpoints of the architecture.
+    :param datasets: The evaluation sets, name -> (X, y).
+    :param threshold: The SEP threshold (linear scale, as in Evaluator.evaluate).
+    :param batch_size: Number of samples per predict batch.
+    :param with_repr_loss: Whether to compute the exact representation loss over all pairs.
+    :param arch_kwargs: Additional arguments of build_model (input_dim, feat_dim, hiddens, output_dim).
+    :return: One row of metrics per checkpoint and dataset.
+    """
+    model_type, with_head = spec
+    arch_kwargs = arch_kwargs or {}
+    model = build_model(model_type, with_head=with_head, **arch_kwargs)
+    predict = compiled_predict(model, arch_kwargs.get('input_dim', 19))
+    # the regression output is the second output of the models with a regression output or head
+    has_regression = with_head or 'reg' in model_type
+
+    log_threshold = np.log(threshold)
+    lower_threshold = np.log(threshold / np.exp(2)) + 1e-4
+
+    rows = []
+    for path in paths:
+        row_base = {'checkpoint': path, 'model_type': model_type, 'with_head': with_head}
+        try:
+            model.load_weights(path)
+        except Exception as e:
+            print(f"Could not load {path} as {spec}: {e}")
+            rows.append({**row_base, 'error': str(e)})
+            continue
+
+        for name, (X, y) in datasets.items():
+            outputs = predict_outputs(predict, X, batch_size)
+            y_flat = np.asarray(y).reshape(-1)
+            row = {**row_base, 'dataset': name, 'num_samples': len(y_flat)}
+
+            if with_repr_loss:
+                pair_sums, _ = pair_error_sums(y_flat, outputs[0])
+                n = len(y_flat)
+                row['repr_loss'] = float(np.sum(pair_sums) / (n * (n - 1) / 2 + 1e-9))
+
+            if has_regression and len(outputs) > 1:
+                scores = compute_metrics(y_flat, outputs[1].reshape(-1), log_threshold, lower_threshold)
+                row.update({metric: float(value) for metric, value in scores.items()})
+            rows.append(row)
+        print(f"Evaluated {path}")
+    return rows
+
+
+def zoo_datasets(data_dir: str) -> Dict[str, Tuple[ndarray, ndarray]]:
+    """
+    The evaluation sets of a fold directory: the combined training set (training + validation) and the test set.
+
+    :param data_dir: The fold directory.
+    :return: The datasets, name -> (X, y).
+    """
+    loader = sepl.SEPLoader()
+    data = DatasetView.from_splits(*loader.load_from_dir(data_dir))
+    return {'training': data['train'], 'test': data['test']}
+
+
+def evaluate_checkpoint_zoo(checkpoints: Any,
+                            data_dir: str,
+                            output_path: str = 'checkpoint_zoo_metrics.csv',
+                            n_workers: int = 1,
+                            threshold: float = 10,
+                            batch_size: int = 4096,
+                            with_repr_loss: bool = True,
+                            default_model_type: Optional[str] = None,
+                            arch_kwargs: Optional[Dict[str, Any]] = None) -> pd.DataFrame:
+    """
+    Evaluate a zoo of checkpoints and write one consolidated metrics table.
+
+    :param checkpoints: A directory (searched for *.h5), a glob pattern, or a list of paths.
+    :param data_dir: The fold directory of the evaluation data.
+    :param output_path: The path of the CSV table.
+    :param n_workers: Number of worker processes (architectures are spread across them), 1 to run in process.
+    :param threshold: The SEP threshold (linear scale).
+    :param batch_size: Number of samples per predict batch.
+    :param with_repr_loss: Whether to compute the exact representation loss over all pairs.
+    :param default_model_type: Model type of the checkpoints whose name does not tell it (None to skip them).
+    :param arch_kwargs: Additional arguments of build_model (input_dim, feat_dim, hiddens, output_dim).
+    :return: The metrics table, one row per checkpoint and dataset.
+    """
+    if isinstance(checkpoints, str):
+        pattern = os.path.join(checkpoints, '*.h5') if os.path.isdir(checkpoints) else checkpoints
+        checkpoints = glob.glob(pattern)
+
+    groups, unknown = group_checkpoints(checkpoints, lambda path: parse_checkpoint(path, default_model_type))
+    for path in unknown:
+        print(f"Skipping {path}: unknown architecture")
+    print(f"{sum(len(paths) for paths in groups.values())} checkpoints in {len(groups)} architectures")
+
+    datasets = zoo_datasets(data_dir)
+    group_args = [(spec, paths, datasets, threshold, batch_size, with_repr_loss, arch_kwargs)
+                  for spec, paths in groups.items()]
+
+    rows = []
+    if n_workers > 1 and len(groups) > 1:
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=min(n_workers, len(groups)), mp_context=context) as executor:
+            for group_rows in executor.map(evaluate_group, *zip(*group_args)):
+                rows.extend(group_rows)
+    else:
+        for args in group_args:
+            rows.extend(evaluate_group(*args))
+
+    table = pd.DataFrame(rows)
+    table.to_csv(output_path, index=False)
+    print(f"Saved the metrics of {len(table)} evaluations to {output_path}")
+    return table
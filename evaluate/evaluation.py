@@ -8,12 +8,16 @@
 import numpy as np
 import math
 import matplotlib.pyplot as plt
-import tensorflow as tf
 # types for type hinting
 from typing import Tuple, List, Optional, Any, Dict, Union
 from numpy import ndarray
 from tensorflow.keras import Model
-from sklearn.metrics import confusion_matrix, f1_score
+
+from dataload.streaming import StreamingCatalog, predict_stream
+from evaluate.metrics import compute_metrics, metric_arrays, threshold_sweep, CI_METRICS
+from models.plot_service import submit_plot
+from models.prediction_cache import cached_predict
+from models.profiling import ProfilerWindow, maybe_capture, maybe_annotate
 
 
 class Evaluator:
@@ -32,8 +36,14 @@ class Evaluator:
     def __init__(self):
         pass
 
-    def evaluate(self, model: Model, X_test: np.ndarray, y_test: np.ndarray, title, res: float = 0.5,
-                 threshold: float = 10, save_tag=None) -> Dict[str, Union[float, Any]]:
+    def evaluate(self, model: Model, X_test: Union[np.ndarray, StreamingCatalog], y_test: Optional[np.ndarray],
+                 title, res: float = 0.5,
+                 threshold: float = 10, save_tag=None,
+                 profiler: Optional[ProfilerWindow] = None,
+                 n_bootstrap: int = 1000,
+                 confidence: float = 0.95,
+                 seed: Optional[int] = 0,
+                 sweep: bool = True) -> Dict[str, Union[float, Any]]:
         """
         Evaluate the performance of the model on test data using TensorFlow's MSE and plot error per bin.
 
@@ -41,17 +51,28 @@ class Evaluator:
         :param title:
         :param threshold:
         :param model: Model to test
-        :param X_test: Test features as a NumPy array.
-        :param y_test: Test labels for the regression output as a NumPy array.
+        :param X_test: Test features as a NumPy array, or a streaming catalog of the test set.
+        :param y_test: Test labels for the regression output as a NumPy array (None for a catalog).
         :param res: The resolution of the bins for plotting error per bin.
-        :return: Performance as a percentage based on MSE. Lower is better.
+        :param profiler: Optional ProfilerWindow capturing a tf.profiler trace of the prediction.
+        :param n_bootstrap: Number of bootstrap resamples for the confidence intervals (0 to skip them).
+        :param confidence: Confidence level of the bootstrap intervals.
+        :param seed: Seed of the bootstrap resampling (fixed by default so the intervals are reproducible,
+                     None for a random seed).
+        :param sweep: Whether to sweep the decision threshold and report the optimal F1, TSS and HSS thresholds.
+        :return: The scalar metrics, the 'plot' path, and the 'details' of the per bin MAE (bin edges and MAE
+                 of each bin, not scalar metrics: log them with mlflow.log_dict).
         """
 
         threshold_val = threshold
         threshold = np.log(threshold_val)
 
-        # Predict the y-values using the model
-        y_pred = model.predict(X_test)
+        # Predict the y-values using the model (streamed for a catalog that does not fit in memory)
+        with maybe_capture(profiler), maybe_annotate(profiler, 'predict'):
+            if isinstance(X_test, StreamingCatalog):
+                y_test, y_pred = predict_stream(model, X_test)
+            else:
+                y_pred = cached_predict(model, X_test)
 
         # Assuming y_pred may have multiple outputs and you're interested in the regression head
         if isinstance(y_pred, list) and len(y_pred) > 1:
@@ -63,16 +84,6 @@ class Evaluator:
         y_pred = y_pred.flatten()
         y_test = y_test.flatten()
 
-        # Calculate the Mean Squared Error using TensorFlow
-        mae = tf.keras.losses.MeanAbsoluteError()(y_test, y_pred).numpy()
-
-        # Calculate the Root Mean Squared Error
-        # rmse = np.sqrt(mse)
-
-        # Print the MSE and RMSE
-        print(f"{save_tag} Mean Absolute Error: {mae}")
-        # print(f"Root Mean Squared Error: {rmse}")
-
         # # Generate bins for plotting
         self.get_bins(list(y_test), res)
         #
@@ -82,56 +93,40 @@ class Evaluator:
         # Define lower threshold
         lower_threshold = np.log(threshold_val / np.exp(2)) + 1e-4  # + 1e-9 to avoid backgrounds being considered
 
-        # Identify different types of events
-        SEP_indices = np.where(y_test > threshold)[0]
-        Elevated_indices = np.where((y_test <= threshold) & (y_test > lower_threshold))[0]
-        Background_indices = np.where(y_test <= lower_threshold)[0]
-
-        y_test_SEP = y_test[SEP_indices]
-        y_pred_SEP = y_pred[SEP_indices]
+        # All the metrics (MAE overall and per event class, confusion counts, F1, TSS, HSS) in one pass,
+        # with bootstrap confidence intervals
+        scores = compute_metrics(y_test, y_pred, threshold, lower_threshold, bins=self.bins,
+                                 n_bootstrap=n_bootstrap, confidence=confidence, seed=seed)
+        mae, mae_SEP = scores['MAE'], scores['MAE_SEP']
+        TP, FP, TN, FN = scores['TP'], scores['FP'], scores['TN'], scores['FN']
+        f1, TSS, HSS = scores['F1_Score'], scores['TSS'], scores['HSS']
 
-        # Calculate the MAE for only SEP events
-        mae_SEP = tf.keras.losses.MeanAbsoluteError()(y_test_SEP, y_pred_SEP).numpy()
+        print(f"{save_tag} Mean Absolute Error: {mae}")
         print(f"{save_tag} Mean Absolute Error for SEP events: {mae_SEP}")
-
-        # Classify events based on the given threshold
-        y_true = (y_test > threshold).astype(int)
-        y_pred_class = (y_pred > threshold).astype(int)
-
-        # Calculate the confusion matrix
-        TN, FP, FN, TP = confusion_matrix(y_true, y_pred_class).ravel()
-
-        # Calculate F1 score
-        f1 = f1_score(y_true, y_pred_class)
-
-        # Calculate True Skill Statistic (TSS)
-        TSS = TP / (TP + FN) - FP / (FP + TN)
-
-        # Calculate Heidke Skill Score (HSS)
-        HSS = 2 * (TP * TN - FP * FN) / ((TP + FN) * (FN + TN) + (TP + FP) * (FP + TN))
-
         print(f"True Positives: {TP}, False Positives: {FP}, True Negatives: {TN}, False Negatives: {FN}")
         print(f"F1 Score: {f1}")
         print(f"True Skill Statistic (TSS): {TSS}")
         print(f"Heidke Skill Score (HSS): {HSS}")
+        if 'MAE_bins' in scores:
+            for low, high, bin_mae in zip(self.bins[:-1], self.bins[1:], scores['MAE_bins']):
+                print(f"MAE for y in [{low:.2f}, {high:.2f}): {bin_mae:.4f}")
+        if n_bootstrap > 0:
+            for name in CI_METRICS:
+                print(f"{name} {confidence:.0%} CI: [{scores[name + '_ci_low']:.4f}, {scores[name + '_ci_high']:.4f}]")
+        if sweep:
+            # skill at every distinct decision threshold from one sort of the predictions
+            curves = threshold_sweep(y_test, y_pred, threshold)
+            for name, (best_threshold, best_value) in curves['best'].items():
+                print(f"Best {name}: {best_value:.4f} at predicted ln intensity > {best_threshold:.4f}")
+                scores[f"{name}_best"] = best_value
+                scores[f"{name}_best_threshold"] = best_threshold
+            self.plot_skill_curves(curves, threshold, save_tag=save_tag)
         print('-----------------------------------------------------')
 
-        # Plot actual vs predicted
-        plt.figure(figsize=(10, 10))
-        plt.scatter(y_test[Background_indices], y_pred[Background_indices], c='b', alpha=0.5, label='Background')
-        plt.scatter(y_test[Elevated_indices], y_pred[Elevated_indices], c='g', alpha=0.5, label='Elevated')
-        plt.scatter(y_test[SEP_indices], y_pred[SEP_indices], c='r', alpha=0.5, label='SEP')
-        plt.axhline(threshold, color='gray', linestyle='--', linewidth=0.8)
-        plt.axvline(threshold, color='gray', linestyle='--', linewidth=0.8)
-        plt.plot([min(y_test), max(y_test)], [min(y_test), max(y_test)], 'gray', linestyle='--', linewidth=0.8)
-        plt.xlabel('Actual Ln Peak Intensity')
-        plt.ylabel('Predicted Ln Peak Intensity')
-        plt.title(title)
-        plt.legend()
-        # Save the plot
+        # Plot actual vs predicted (rendered by the plot service)
         file_path = f"test_{threshold_val}_matrix_plot_{str(save_tag)}.png"
-        plt.savefig(file_path)
-        plt.close()
+        submit_plot('actual_vs_predicted', file_path, y_true=y_test, y_pred=y_pred, threshold=threshold,
+                    lower_threshold=lower_threshold, title=title)
 
         # Calculate individual errors
         individual_errors = np.abs(y_test - y_pred)
@@ -148,10 +143,29 @@ class Evaluator:
 
         metrics = {'MAE': mae, 'MAE_SEP': mae_SEP, 'TP': TP, 'FP': FP, 'TN': TN, 'FN': FN, 'F1_Score': f1, 'TSS': TSS,
                    'HSS': HSS, 'plot': file_path}
-        # Store the metrics in the dictionary
+        # Store the metrics in the dictionary (per class MAE and confidence intervals included)
+        metrics.update({name: value for name, value in scores.items() if name not in metrics and name != 'MAE_bins'})
+        # Non-scalar results (per bin MAE) apart from the scalar metrics, as JSON-ready lists (mlflow.log_dict)
+        metrics['details'] = {'save_tag': str(save_tag), 'bins': [float(edge) for edge in self.bins],
+                              'MAE_bins': [float(value) for value in scores.get('MAE_bins', [])]}
 
         return metrics
 
+    def plot_skill_curves(self, curves: Dict[str, Any], threshold: float, save_tag: Optional[str] = None) -> None:
+        """
+        Plot the skill scores against the decision threshold, as returned by threshold_sweep.
+
+        :param curves: The threshold sweep of the predictions.
+        :param threshold: The SEP threshold (in log space), marked on the plot.
+        :param save_tag: Tag of the saved plot.
+        """
+        # the last threshold (-inf, everything forecast as an event) is left out of the plot
+        thresholds = curves['thresholds'][:-1]
+        submit_plot('lines', f"skill_curves_{str(save_tag)}.png",
+                    series={name: (thresholds, curves[name][:-1]) for name in ['TSS', 'HSS', 'F1', 'POD', 'FAR']},
+                    title='Skill Scores per Decision Threshold',
+                    xlabel='Decision Threshold (Predicted Ln Peak Intensity)', ylabel='Score', vlines=[threshold])
+
     def plot_error_per_bin(self, y_true: np.ndarray, y_pred: np.ndarray, save_tag: Optional[str] = None) -> None:
         """
         Plot the error per bin in a bar chart.
@@ -163,34 +177,14 @@ class Evaluator:
             print("Please generate bins first using get_bins()")
             return
 
-        # Bin the true and predicted y-values
-        true_bins = np.digitize(y_true, self.bins)
-        pred_bins = np.digitize(y_pred, self.bins)
-
-        # Initialize an array to store the mean errors for each bin
-        bin_errors = np.zeros(len(self.bins) - 1)
-
-        # Calculate the mean error for each bin
-        for i in range(1, len(self.bins)):
-            indices = np.where(true_bins == i)
-            if len(indices[0]) == 0:
-                continue
-            true_subset = y_true[indices]
-            pred_subset = y_pred[indices]
-            mae = tf.keras.losses.MeanAbsoluteError()(true_subset, pred_subset).numpy()
-            bin_errors[i - 1] = mae
+        # Mean absolute error of each bin of the true y-values
+        bin_errors = metric_arrays(y_true, y_pred, np.inf, -np.inf, bins=self.bins)['MAE_bins'][0]
 
         # Plotting
-        plt.figure(figsize=(12, 6))
-        plt.bar(range(len(bin_errors)), bin_errors,
-                tick_label=[f"{self.bins[i]:.2f}-{self.bins[i + 1]:.2f}" for i in range(len(self.bins) - 1)])
-        plt.xlabel('Bin Range')
-        plt.ylabel('Mean Absolute Error')
-        plt.title('Error per Bin')
-        plt.xticks(rotation=45)
         file_path = f"test_bin_error_plot_{str(save_tag)}.png"
-        plt.savefig(file_path)
-        plt.close()
+        submit_plot('bars', file_path, values=bin_errors,
+                    tick_labels=[f"{self.bins[i]:.2f}-{self.bins[i + 1]:.2f}" for i in range(len(self.bins) - 1)],
+                    title='Error per Bin', xlabel='Bin Range', ylabel='Mean Absolute Error')
 
     def get_bins(self, y: List[float], res: float = .1) -> Tuple[List[float], float, float]:
         """
@@ -233,14 +227,8 @@ class Evaluator:
         :param groups: Optional grouping for labels to define color assignment.
         """
 
-        if withhead:
-            repr_layer_model = Model(inputs=model.input, outputs=model.output[0])
-        else:
-            # Extract the representation layer from the model
-            repr_layer_model = Model(inputs=model.input, outputs=model.output)
-
-        # Predict the representation for the input data
-        repr_space = repr_layer_model.predict(data)
+        # Predict the representation for the input data (the first output of a model with heads)
+        repr_space = cached_predict(model, data, head=0 if withhead else None)
 
         # If groups are defined, categorize labels into groups
         if groups:
@@ -266,7 +254,7 @@ class Evaluator:
         :param X_test:
         :return:
         """
-        reprs = model.predict(X_test)
+        reprs = cached_predict(model, X_test)
         # Calculate the norms of the representation vectors
         norms = np.linalg.norm(reprs, axis=1)
         # Find all unique norm values
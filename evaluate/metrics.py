@@ -0,0 +1,179 @@
+##############################################################################################################
+# Description: vectorized regression and event classification metrics (MAE overall, per event class and
+# per y-bin, confusion counts, F1, TSS, HSS) with bootstrap confidence intervals computed for all resamples
+# at once from one index matrix, and an O(n log n) sweep of the skill scores over the decision thresholds.
+##############################################################################################################
+# types for type hinting
+from typing import Dict, Optional, List
+
+import numpy as np
+from numpy import ndarray
+
+# metrics with a bootstrap confidence interval
+CI_METRICS = ['MAE', 'MAE_SEP', 'MAE_elevated', 'MAE_background', 'F1_Score', 'TSS', 'HSS']
+
+
+def metric_arrays(y_true: ndarray,
+                  y_pred: ndarray,
+                  threshold: float,
+                  lower_threshold: float,
+                  bins: Optional[List[float]] = None) -> Dict[str, ndarray]:
+    """
+    Computes all the metrics for a set of rows of samples in one pass.
+
+    :param y_true: True values, shape of [B, n] (one row per resample) or [n].
+    :param y_pred: Predicted values, same shape as y_true.
+    :param threshold: The SEP threshold (in log space).
+    :param lower_threshold: The elevated threshold (in log space).
+    :param bins: Optional bin edges of y_true for the per bin MAE.
+    :return: A dictionary of arrays of shape [B] (and [B, num_bins] for 'MAE_bins').
+    """
+    y_true = np.atleast_2d(y_true)
+    y_pred = np.atleast_2d(y_pred)
+    errors = np.abs(y_true - y_pred)
+
+    is_sep = y_true > threshold
+    is_background = y_true <= lower_threshold
+    is_elevated = ~(is_sep | is_background)
+    pred_sep = y_pred > threshold
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        metrics = {
+            'MAE': errors.mean(axis=1),
+            'MAE_SEP': (errors * is_sep).sum(axis=1) / is_sep.sum(axis=1),
+            'MAE_elevated': (errors * is_elevated).sum(axis=1) / is_elevated.sum(axis=1),
+            'MAE_background': (errors * is_background).sum(axis=1) / is_background.sum(axis=1),
+        }
+
+        TP = np.sum(is_sep & pred_sep, axis=1)
+        FP = np.sum(~is_sep & pred_sep, axis=1)
+        FN = np.sum(is_sep & ~pred_sep, axis=1)
+        TN = np.sum(~is_sep & ~pred_sep, axis=1)
+        metrics.update({'TP': TP, 'FP': FP, 'TN': TN, 'FN': FN})
+
+        # F1 is 0 when there are no positive samples nor predictions (as sklearn's f1_score)
+        f1_denom = 2 * TP + FP + FN
+        metrics['F1_Score'] = np.where(f1_denom > 0, 2 * TP / np.maximum(f1_denom, 1), 0.0)
+        metrics['TSS'] = TP / (TP + FN) - FP / (FP + TN)
+        metrics['HSS'] = 2 * (TP * TN - FP * FN) / ((TP + FN) * (FN + TN) + (TP + FP) * (FP + TN))
+
+        if bins is not None and len(bins) > 1:
+            # bin index of each sample, offset by row so one bincount covers all the rows
+            num_bins = len(bins) - 1
+            bin_idx = np.clip(np.digitize(y_true, bins) - 1, 0, num_bins - 1)
+            codes = (bin_idx + num_bins * np.arange(len(y_true))[:, None]).ravel()
+            sums = np.bincount(codes, weights=errors.ravel(), minlength=num_bins * len(y_true))
+            counts = np.bincount(codes, minlength=num_bins * len(y_true))
+            metrics['MAE_bins'] = np.where(counts > 0, sums / np.maximum(counts, 1), 0.0).reshape(len(y_true), -1)
+
+    return metrics
+
+
+def compute_metrics(y_true: ndarray,
+                    y_pred: ndarray,
+                    threshold: float,
+                    lower_threshold: float,
+                    bins: Optional[List[float]] = None,
+                    n_bootstrap: int = 0,
+                    confidence: float = 0.95,
+                    seed: Optional[int] = None,
+                    chunk_size: int = 250) -> Dict[str, object]:
+    """
+    Computes the metrics of the predictions and, optionally, their bootstrap confidence intervals.
+    The resamples are drawn as one [n_bootstrap, n] index matrix (processed in chunks of rows to bound memory).
+
+    :param y_true: True values, shape of [n].
+    :param y_pred: Predicted values, shape of [n].
+    :param threshold: The SEP threshold (in log space).
+    :param lower_threshold: The elevated threshold (in log space).
+    :param bins: Optional bin edges of y_true for the per bin MAE.
+    :param n_bootstrap: Number of bootstrap resamples, 0 to skip the confidence intervals.
+    :param confidence: Confidence level of the percentile intervals.
+    :param seed: Seed of the resampling.
+    :param chunk_size: Number of resamples processed at once.
+    :return: The scalar metrics, 'MAE_bins' if bins are given, and {metric}_ci_low / {metric}_ci_high
+             for the metrics in CI_METRICS when n_bootstrap > 0.
+    """
+    y_true = np.asarray(y_true, dtype=np.float64).reshape(-1)
+    y_pred = np.asarray(y_pred, dtype=np.float64).reshape(-1)
+
+    point = metric_arrays(y_true, y_pred, threshold, lower_threshold, bins)
+    metrics = {name: values[0] for name, values in point.items()}
+
+    if n_bootstrap > 0:
+        rng = np.random.default_rng(seed)
+        resampled = {name: [] for name in CI_METRICS}
+        for start in range(0, n_bootstrap, chunk_size):
+            idx = rng.integers(0, len(y_true), size=(min(chunk_size, n_bootstrap - start), len(y_true)))
+            chunk = metric_arrays(y_true[idx], y_pred[idx], threshold, lower_threshold)
+            for name in CI_METRICS:
+                resampled[name].append(chunk[name])
+
+        alpha = (1 - confidence) / 2
+        for name in CI_METRICS:
+            values = np.concatenate(resampled[name])
+            if np.all(np.isnan(values)):
+                low, high = np.nan, np.nan
+            else:
+                low, high = np.nanquantile(values, [alpha, 1 - alpha])
+            metrics[f"{name}_ci_low"] = float(low)
+            metrics[f"{name}_ci_high"] = float(high)
+
+    return metrics
+
+
+def threshold_sweep(y_true: ndarray, y_pred: ndarray, event_threshold: float) -> Dict[str, object]:
+    """
+    Skill curves of the SEP forecast over every distinct decision threshold of the predictions.
+    The predictions are sorted once and the TP/FP counts at all thresholds are cumulative sums, so the sweep
+    costs O(n log n).
+
+    :param y_true: True values, shape of [n].
+    :param y_pred: Predicted values, shape of [n].
+    :param event_threshold: The threshold on y_true defining the SEP events (in log space).
+    :return: A dictionary with the arrays 'thresholds' (an event is forecast when y_pred > threshold),
+             'TP', 'FP', 'TN', 'FN', 'POD', 'FAR' (false alarm ratio), 'POFD', 'F1', 'TSS' and 'HSS',
+             and 'best': {metric: (threshold, value)} for F1, TSS and HSS.
+    """
+    y_true = np.asarray(y_true, dtype=np.float64).reshape(-1)
+    y_pred = np.asarray(y_pred, dtype=np.float64).reshape(-1)
+    events = y_true > event_threshold
+
+    order = np.argsort(-y_pred, kind='mergesort')
+    sorted_pred = y_pred[order]
+    sorted_events = events[order]
+
+    # last position of each run of equal predictions: thresholds fall between distinct values
+    run_ends = np.r_[np.nonzero(np.diff(sorted_pred))[0], len(sorted_pred) - 1]
+    TP = np.r_[0, np.cumsum(sorted_events)[run_ends]]
+    FP = np.r_[0, np.cumsum(~sorted_events)[run_ends]]
+    # with threshold k, the forecast events are the predictions above the k-th distinct value
+    thresholds = np.r_[sorted_pred[run_ends], -np.inf]
+
+    P = events.sum()
+    N = len(events) - P
+    FN = P - TP
+    TN = N - FP
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        POD = TP / P
+        POFD = FP / N
+        FAR = np.where(TP + FP > 0, FP / np.maximum(TP + FP, 1), 0.0)
+        F1 = np.where(2 * TP + FP + FN > 0, 2 * TP / np.maximum(2 * TP + FP + FN, 1), 0.0)
+        TSS = POD - POFD
+        HSS = 2 * (TP * TN - FP * FN) / ((TP + FN) * (FN + TN) + (TP + FP) * (FP + TN))
+
+    curves = {'thresholds': thresholds, 'TP': TP, 'FP': FP, 'TN': TN, 'FN': FN, 'POD': POD, 'FAR': FAR,
+              'POFD': POFD, 'F1': F1, 'TSS': TSS, 'HSS': HSS}
+
+    best = {}
+    for name in ['F1', 'TSS', 'HSS']:
+        values = curves[name]
+        if np.all(np.isnan(values)):
+            best[name] = (np.nan, np.nan)
+        else:
+            k = int(np.nanargmax(values))
+            best[name] = (float(thresholds[k]), float(values[k]))
+    curves['best'] = best
+
+    return curves
@@ -0,0 +1,188 @@
+##############################################################################################################
+# Description: cached 2D t-SNE projection of the representation space. The embedding is fitted once per
+# (model, reference set) on a density-preserving subsample, saved to disk, and other points (test folds,
+# samples left out of the subsample) are placed into the existing map by kNN interpolation.
+##############################################################################################################
+import hashlib
+import os
+# types for type hinting
+from typing import Optional, Dict, Tuple
+
+import numpy as np
+from numpy import ndarray
+from sklearn.manifold import TSNE
+from sklearn.neighbors import NearestNeighbors
+# imports
+from tensorflow.keras import Model
+
+from models.prediction_cache import PredictionCache, cached_predict
+
+
+def density_preserving_subsample(y: Optional[ndarray], n_samples: int, size: int, n_bins: int = 20,
+                                 min_per_bin: int = 10, seed: int = 42) -> ndarray:
+    """
+    Subsample that keeps the label distribution: each bin of y contributes in proportion to its size, and
+    at least min_per_bin samples (or all of them) so the rare SEP events are still represented.
+    Without labels, a uniform random subsample (density preserving in expectation).
+
+    :param y: The labels, or None.
+    :param n_samples: The number of samples.
+    :param size: The subsample size.
+    :param n_bins: Number of equal width bins of y.
+    :param min_per_bin: Minimum number of samples kept per non-empty bin.
+    :param seed: Seed of the selection.
+    :return: The sorted indices of the subsample.
+    """
+    rng = np.random.default_rng(seed)
+    if size >= n_samples:
+        return np.arange(n_samples)
+    if y is None:
+        return np.sort(rng.choice(n_samples, size, replace=False))
+
+    y = np.asarray(y).reshape(-1)
+    edges = np.linspace(y.min(), y.max(), n_bins + 1)
+    bin_idx = np.clip(np.digitize(y, edges) - 1, 0, n_bins - 1)
+    counts = np.bincount(bin_idx, minlength=n_bins)
+    quotas = np.minimum(counts, np.maximum(np.round(counts * size / n_samples).astype(int), min_per_bin))
+
+    # random priority of each sample, ranked within its bin: keep the first quota of each bin
+    order = np.lexsort((rng.random(n_samples), bin_idx))
+    starts = np.r_[0, np.cumsum(counts)[:-1]]
+    rank = np.empty(n_samples, dtype=int)
+    rank[order] = np.arange(n_samples) - np.repeat(starts, counts)
+    return np.nonzero(rank < quotas[bin_idx])[0]
+
+
+def knn_interpolate(index: NearestNeighbors, anchor_embedding: ndarray, features: ndarray) -> ndarray:
+    """
+    Places points into an embedding by inverse distance weighting of their nearest anchors in feature space.
+
+    :param index: Nearest neighbors index fitted on the features of the embedded points (the anchors).
+    :param anchor_embedding: The embedding of the anchors, shape of [m, 2].
+    :param features: The features of the points to place, shape of [n, d].
+    :return: The embedding of the points, shape of [n, 2]. A point equal to an anchor lands on it.
+    """
+    neighbor_dist, neighbors = index.kneighbors(features)
+    weights = 1. / np.maximum(neighbor_dist, 1e-12)
+    weights /= weights.sum(axis=1, keepdims=True)
+    return np.einsum('nk,nkc->nc', weights, anchor_embedding[neighbors])
+
+
+class EmbeddingProjection:
+    """
+    2D t-SNE map of a model's representation space, fitted once per (model, reference set) and reused for
+    every other set projected with the same model.
+    """
+
+    def __init__(self,
+                 cache_dir: Optional[str] = 'tsne_cache',
+                 max_fit_samples: int = 5000,
+                 n_neighbors: int = 10,
+                 perplexity: float = 30.0) -> None:
+        """
+        :param cache_dir: Directory of the fitted maps (.npz), None to keep them in memory only.
+        :param max_fit_samples: Maximum number of reference points t-SNE is fitted on.
+        :param n_neighbors: Number of anchors used to place a point.
+        :param perplexity: The t-SNE perplexity.
+        """
+        self.cache_dir = cache_dir
+        self.max_fit_samples = max_fit_samples
+        self.n_neighbors = n_neighbors
+        self.perplexity = perplexity
+        # fitted maps (neighbors index of the anchors, anchor embedding) by key, and the key of the latest map
+        # of each (model, head)
+        self.maps: Dict[str, Tuple[NearestNeighbors, ndarray]] = {}
+        self.model_maps: Dict[Tuple[str, Optional[int]], str] = {}
+
+    def map_key(self, model_fingerprint: str, X: ndarray, seed: int, head: Optional[int] = None) -> str:
+        """
+        Key of the map of a model (output head) fitted on a reference set.
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(model_fingerprint.encode())
+        digest.update(PredictionCache.input_fingerprint(X).encode())
+        digest.update(f"{seed}_{self.max_fit_samples}_{self.perplexity}_{head}".encode())
+        return digest.hexdigest()
+
+    def fit(self, model: Model, X: ndarray, y: Optional[ndarray] = None, head: Optional[int] = None,
+            seed: int = 42) -> str:
+        """
+        Fit (or load from the cache) the map of the model on a reference set.
+
+        :param model: The feature extractor model.
+        :param X: The reference inputs.
+        :param y: The reference labels, used for the density-preserving subsample.
+        :param head: Output head of the features for multi-output models.
+        :param seed: Seed of the subsample and of t-SNE.
+        :return: The key of the map.
+        """
+        model_fingerprint = PredictionCache.model_fingerprint(model)
+        key = self.map_key(model_fingerprint, X, seed, head=head)
+        self.model_maps[(model_fingerprint, head)] = key
+        if key in self.maps:
+            return key
+
+        path = os.path.join(self.cache_dir, f"{key}.npz") if self.cache_dir is not None else None
+        if path is not None and os.path.exists(path):
+            with np.load(path) as cached:
+                self.maps[key] = (self.neighbors_index(cached['anchors']), cached['embedding'])
+            print(f"Loaded t-SNE map from {path}")
+            return key
+
+        features = np.asarray(cached_predict(model, X, head=head))
+        subsample = density_preserving_subsample(y, len(features), self.max_fit_samples, seed=seed)
+        anchors = features[subsample]
+        tsne = TSNE(n_components=2, perplexity=min(self.perplexity, len(anchors) - 1), random_state=seed)
+        embedding = tsne.fit_transform(anchors)
+        self.maps[key] = (self.neighbors_index(anchors), embedding)
+
+        if path is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            np.savez(path, anchors=anchors, embedding=embedding)
+            print(f"Saved t-SNE map of {len(anchors)} points to {path}")
+        return key
+
+    def neighbors_index(self, anchors: ndarray) -> NearestNeighbors:
+        """
+        Nearest neighbors index of the anchors of a map.
+        """
+        return NearestNeighbors(n_neighbors=min(self.n_neighbors, len(anchors))).fit(anchors)
+
+    def transform(self, key: str, features: ndarray) -> ndarray:
+        """
+        Place features into a fitted map.
+
+        :param key: The key of the map.
+        :param features: The features, shape of [n, d].
+        :return: The 2D embedding, shape of [n, 2].
+        """
+        index, embedding = self.maps[key]
+        return knn_interpolate(index, embedding, np.asarray(features))
+
+    def project(self, model: Model, X: ndarray, y: Optional[ndarray] = None, head: Optional[int] = None,
+                reference_X: Optional[ndarray] = None, reference_y: Optional[ndarray] = None,
+                seed: int = 42) -> ndarray:
+        """
+        2D embedding of X. The map is the one fitted on reference_X if given, else the latest map of the model head,
+        else a map fitted on X itself (so projecting the training set first, then the test set, fits once).
+
+        :param model: The feature extractor model.
+        :param X: The inputs to project.
+        :param y: The labels of X (used if the map is fitted on X).
+        :param head: Output head of the features for multi-output models.
+        :param reference_X: Optional reference inputs to fit the map on.
+        :param reference_y: The labels of reference_X.
+        :param seed: Seed of the subsample and of t-SNE.
+        :return: The 2D embedding of X, shape of [n, 2].
+        """
+        if reference_X is not None:
+            key = self.fit(model, reference_X, reference_y, head=head, seed=seed)
+        else:
+            key = self.model_maps.get((PredictionCache.model_fingerprint(model), head))
+            if key is None:
+                key = self.fit(model, X, y, head=head, seed=seed)
+        return self.transform(key, cached_predict(model, X, head=head))
+
+
+# projection shared by the t-SNE plotting helpers
+PROJECTION = EmbeddingProjection()
@@ -0,0 +1,242 @@
+##############################################################################################################
+# Description: append-only columnar store of run results. Each append writes an NPZ shard of typed columns
+# (fold, seed, batch size, model type, ... and one float column per metric) with an atomic rename, so
+# concurrent workers can append to the same directory. Group-by statistics are vectorized over all the rows.
+##############################################################################################################
+import glob
+import numbers
+import os
+import time
+import uuid
+from datetime import datetime
+# types for type hinting
+from typing import Dict, List, Optional, Union, Any, Sequence
+
+import numpy as np
+from numpy import ndarray
+
+# typed tag columns (other tag columns are typed from their values)
+TAG_COLUMNS = {
+    'fold': np.int64,
+    'seed': np.int64,
+    'batch_size': np.int64,
+    'model_type': np.str_,
+    'dataset': np.str_,
+    'experiment': np.str_,
+    'session': np.str_,
+    'time': np.float64,
+}
+# fill value of a column missing from a shard, by dtype kind
+MISSING = {'i': -1, 'u': 0, 'f': np.nan, 'b': False, 'U': ''}
+
+
+def column_dtype(name: str, value: Any) -> type:
+    """
+    Type of a column: the declared type of the tag columns, float64 for the metrics.
+    """
+    if name in TAG_COLUMNS:
+        return TAG_COLUMNS[name]
+    if isinstance(value, (bool, np.bool_)):
+        return np.bool_
+    if isinstance(value, str):
+        return np.str_
+    return np.float64
+
+
+def rows_to_columns(rows: List[Dict[str, Any]]) -> Dict[str, ndarray]:
+    """
+    Typed columns of a list of rows. Numbers and strings become columns, other values (arrays, lists) are
+    dropped, and missing entries are filled with the missing value of the column type.
+
+    :param rows: The rows, as dictionaries of column -> scalar.
+    :return: The columns.
+    """
+    names = []
+    for row in rows:
+        names += [name for name, value in row.items()
+                  if name not in names and isinstance(value, (numbers.Number, str, np.bool_, np.number))]
+    columns = {}
+    for name in names:
+        first = next(row[name] for row in rows if name in row)
+        dtype = column_dtype(name, first)
+        missing = MISSING[np.dtype(dtype).kind]
+        columns[name] = np.array([row.get(name, missing) for row in rows], dtype=dtype)
+    return columns
+
+
+def concat_columns(parts: List[Dict[str, ndarray]]) -> Dict[str, ndarray]:
+    """
+    Concatenate column sets, filling the columns missing from a part.
+    """
+    lengths = [len(next(iter(part.values()))) if part else 0 for part in parts]
+    names = []
+    for part in parts:
+        names += [name for name in part if name not in names]
+    columns = {}
+    for name in names:
+        dtype = next(part[name].dtype for part in parts if name in part)
+        missing = MISSING.get(dtype.kind, 0)
+        columns[name] = np.concatenate([part[name] if name in part else np.full(length, missing, dtype=dtype)
+                                        for part, length in zip(parts, lengths)]) if parts else np.array([])
+    return columns
+
+
+def group_statistics(columns: Dict[str, ndarray],
+                     by: Union[str, Sequence[str]] = 'batch_size',
+                     metrics: Optional[List[str]] = None) -> Dict[Any, Dict[str, Dict[str, float]]]:
+    """
+    Mean, standard deviation and count of each metric per group, in one pass of bincounts (NaNs are ignored).
+
+    :param columns: The columns of the rows.
+    :param by: The column(s) to group by.
+    :param metrics: The metric columns. Default is all the float columns that are not tags.
+    :return: {group key: {metric: {'mean', 'std', 'count'}}}, the group key is a tuple when grouping by
+             several columns (the format of calculate_statistics).
+    """
+    by = [by] if isinstance(by, str) else list(by)
+    if metrics is None:
+        metrics = [name for name, values in columns.items()
+                   if values.dtype.kind == 'f' and name not in TAG_COLUMNS and name not in by]
+    n = len(columns[by[0]]) if by and by[0] in columns else 0
+    if n == 0 or not metrics:
+        return {}
+
+    # one integer code per combination of the group columns
+    codes = np.zeros(n, dtype=np.int64)
+    for name in by:
+        uniques, inverse = np.unique(columns[name], return_inverse=True)
+        codes = codes * len(uniques) + inverse
+    _, first, group = np.unique(codes, return_index=True, return_inverse=True)
+    num_groups = len(first)
+
+    values = np.column_stack([columns[name].astype(np.float64) if name in columns else np.full(n, np.nan)
+                              for name in metrics])
+    valid = ~np.isnan(values)
+    flat = (group[:, None] * len(metrics) + np.arange(len(metrics))).ravel()
+    size = num_groups * len(metrics)
+    counts = np.bincount(flat, weights=valid.ravel(), minlength=size)
+    sums = np.bincount(flat, weights=np.where(valid, values, 0.).ravel(), minlength=size)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = sums / counts
+        deviations = np.where(valid, values - means.reshape(num_groups, -1)[group], 0.)
+        stds = np.sqrt(np.bincount(flat, weights=(deviations ** 2).ravel(), minlength=size) / counts)
+    means, stds, counts = (a.reshape(num_groups, -1) for a in (means, stds, counts))
+
+    statistics = {}
+    for g, row in enumerate(first):
+        key = tuple(columns[name][row].item() for name in by)
+        statistics[key[0] if len(by) == 1 else key] = {
+            metric: {'mean': means[g, m], 'std': stds[g, m], 'count': int(counts[g, m])}
+            for m, metric in enumerate(metrics) if counts[g, m] > 0}
+    return statistics
+
+
+class ResultsStore:
+    """
+    Append-only columnar results store in a directory of NPZ shards. Every append writes a new shard, so
+    several processes can append to the same store, and reads only load the shards not seen yet.
+    """
+
+    def __init__(self, root: str = 'results_store', session: Optional[str] = None, **tags) -> None:
+        """
+        :param root: The directory of the shards.
+        :param session: Id of this session of appends. Default is a timestamp.
+        :param tags: Default tags of the appended rows (e.g. experiment='exp_head_pds', dataset='test').
+        """
+        self.root = root
+        self.session = session or f"{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}_{os.getpid()}"
+        self.tags = tags
+        self.shards: Dict[str, Dict[str, ndarray]] = {}
+        os.makedirs(root, exist_ok=True)
+
+    def append(self, rows: Union[Dict[str, Any], List[Dict[str, Any]]], **tags) -> str:
+        """
+        Append rows of results in a new shard.
+
+        :param rows: A row (e.g. the metrics of Evaluator.evaluate) or a list of rows.
+        :param tags: Tags of the rows (fold, seed, batch_size, model_type, ...), added to the default tags.
+        :return: The path of the shard.
+        """
+        rows = [rows] if isinstance(rows, dict) else rows
+        tags = {**self.tags, 'session': self.session, 'time': time.time(), **tags}
+        columns = rows_to_columns([{**row, **tags} for row in rows])
+
+        name = f"shard_{time.time_ns()}_{os.getpid()}_{uuid.uuid4().hex[:8]}"
+        tmp_path = os.path.join(self.root, f".{name}.tmp.npz")
+        path = os.path.join(self.root, f"{name}.npz")
+        np.savez(tmp_path, **columns)
+        # the rename is atomic, readers never see a partial shard
+        os.replace(tmp_path, path)
+        return path
+
+    def own_where(self) -> Dict[str, Any]:
+        """
+        Filter of the rows appended by this store: its session and its default tags (stores sharing a root, e.g.
+        the test and training results of a script, can share a session).
+        """
+        return {'session': self.session, **self.tags}
+
+    def load(self, where: Optional[Dict[str, Any]] = None) -> Dict[str, ndarray]:
+        """
+        All the rows of the store as columns (the shards already read are cached, and the cached shards removed
+        by a compact of another process are dropped).
+
+        :param where: Optional equality filters, column -> value.
+        :return: The columns.
+        """
+        paths = sorted(glob.glob(os.path.join(self.root, 'shard_*.npz')))
+        self.shards = {path: self.shards[path] for path in paths if path in self.shards}
+        for path in paths:
+            if path not in self.shards:
+                with np.load(path) as shard:
+                    self.shards[path] = {name: shard[name] for name in shard.files}
+        columns = concat_columns([self.shards[path] for path in sorted(self.shards)])
+        if where and columns:
+            mask = np.ones(len(next(iter(columns.values()))), dtype=bool)
+            for name, value in where.items():
+                mask &= columns[name] == value if name in columns else False
+            columns = {name: values[mask] for name, values in columns.items()}
+        return columns
+
+    def group_stats(self,
+                    by: Union[str, Sequence[str]] = 'batch_size',
+                    metrics: Optional[List[str]] = None,
+                    where: Optional[Dict[str, Any]] = None) -> Dict[Any, Dict[str, Dict[str, float]]]:
+        """
+        Vectorized group-by statistics over the rows of the store.
+
+        :param by: The column(s) to group by, e.g. 'batch_size' or ['model_type', 'batch_size'].
+        :param metrics: The metric columns. Default is all of them.
+        :param where: Optional equality filters, e.g. store.own_where() or {'dataset': 'test'}.
+        :return: {group key: {metric: {'mean', 'std', 'count'}}}.
+        """
+        return group_statistics(self.load(where), by, metrics)
+
+    def to_frame(self, where: Optional[Dict[str, Any]] = None):
+        """
+        The rows of the store as a pandas DataFrame.
+        """
+        import pandas as pd
+        return pd.DataFrame(self.load(where))
+
+    def compact(self) -> Optional[str]:
+        """
+        Merge the shards read so far into one shard (appends running concurrently are kept as separate shards).
+        Run it from a single process, e.g. between sweeps.
+
+        :return: The path of the merged shard, or None if there is nothing to merge.
+        """
+        self.load()
+        paths = sorted(self.shards)
+        if len(paths) < 2:
+            return None
+        name = f"shard_{time.time_ns()}_{os.getpid()}_{uuid.uuid4().hex[:8]}"
+        tmp_path = os.path.join(self.root, f".{name}.tmp.npz")
+        path = os.path.join(self.root, f"{name}.npz")
+        columns = concat_columns([self.shards[p] for p in paths])
+        np.savez(tmp_path, **columns)
+        os.replace(tmp_path, path)
+        for p in paths:
+            os.remove(p)
+        self.shards = {path: columns}
+        return path
@@ -114,6 +114,166 @@ class Ttest:
                 {"mean": method2_mean, "std": method2_std})
 
 
-# To test the class, we need to create some dummy data.
-np.random.seed(0)  # Seed for reproducibility
-method1_data = np.random.normal(100, 15, 35)  # Method 1 data: normal distribution around
+def adjust_p_values(p_values: np.ndarray, method: str = 'holm') -> np.ndarray:
+    """
+    Correct p-values for multiple comparisons.
+
+    Parameters:
+    p_values (np.ndarray): The p-values of a family of tests.
+    method (str): 'holm' (step-down family-wise error), 'bonferroni' or 'fdr_bh' (Benjamini-Hochberg).
+
+    Returns:
+    np.ndarray: The adjusted p-values, in the order of p_values.
+    """
+    p_values = np.asarray(p_values, dtype=float)
+    m = len(p_values)
+    if m == 0:
+        return p_values
+    if method == 'bonferroni':
+        return np.minimum(p_values * m, 1.0)
+
+    order = np.argsort(p_values)
+    sorted_p = p_values[order]
+    if method == 'holm':
+        adjusted = np.minimum(np.maximum.accumulate(sorted_p * (m - np.arange(m))), 1.0)
+    elif method == 'fdr_bh':
+        adjusted = np.minimum(np.minimum.accumulate((sorted_p * m / np.arange(1, m + 1))[::-1])[::-1], 1.0)
+    else:
+        raise ValueError(f"Unknown correction method {method}, should be 'holm', 'bonferroni' or 'fdr_bh'.")
+    result = np.empty(m)
+    result[order] = adjusted
+    return result
+
+
+def permutation_p_values(groups: list, pairs: np.ndarray, n_permutations: int = 10000,
+                         seed: int = None) -> np.ndarray:
+    """
+    Two-sided permutation p-values of the difference of means of pairs of groups. The pairs with the same
+    group sizes share one [n_permutations, n] permutation index matrix, and the permuted differences of all
+    those pairs are one matrix product with the permuted +1/n_a, -1/n_b weights.
+
+    Parameters:
+    groups (list): The samples of each group (1D arrays).
+    pairs (np.ndarray): The (a, b) group indices of each pair, shape of [num_pairs, 2].
+    n_permutations (int): Number of permutations.
+    seed (int): Seed of the permutations.
+
+    Returns:
+    np.ndarray: The p-value of each pair, (count of permuted |diff| >= observed |diff| + 1) / (n_permutations + 1).
+    """
+    rng = np.random.default_rng(seed)
+    p_values = np.empty(len(pairs))
+    sizes = np.array([[len(groups[a]), len(groups[b])] for a, b in pairs]).reshape(-1, 2)
+    for n_a, n_b in np.unique(sizes, axis=0):
+        selected = np.nonzero((sizes[:, 0] == n_a) & (sizes[:, 1] == n_b))[0]
+        pooled = np.stack([np.concatenate([groups[pairs[k, 0]], groups[pairs[k, 1]]]) for k in selected])
+        weights = np.r_[np.full(n_a, 1.0 / n_a), np.full(n_b, -1.0 / n_b)]
+        observed = np.abs(pooled @ weights)
+
+        # row p of the index matrix is a permutation: sample index[p, k] gets the weight of position k
+        index = np.argsort(rng.random((n_permutations, n_a + n_b)), axis=1)
+        permuted_weights = np.empty((n_permutations, n_a + n_b))
+        np.put_along_axis(permuted_weights, index, np.broadcast_to(weights, index.shape), axis=1)
+        permuted = np.abs(pooled @ permuted_weights.T)
+
+        exceed = np.sum(permuted >= observed[:, None] - 1e-12, axis=1)
+        p_values[selected] = (exceed + 1) / (n_permutations + 1)
+    return p_values
+
+
+def batch_significance_tests(results,
+                             by,
+                             metrics: list = None,
+                             n_permutations: int = 10000,
+                             alpha: float = 0.05,
+                             correction: str = 'holm',
+                             seed: int = None):
+    """
+    Significance tests of every pair of configurations for every metric of a results table: Welch t-tests
+    (vectorized over the pairs), Shapiro-Wilk normality checks of each configuration, and permutation tests,
+    with the p-values of each metric corrected for multiple comparisons.
+
+    Parameters:
+    results: The results table, a pandas DataFrame or a dictionary of columns (e.g. ResultsStore.load()),
+             one row per run (seed, fold, ...).
+    by (str or list): The column(s) defining a configuration, e.g. ['batch_size', 'freeze'].
+    metrics (list): The metric columns to test. Default is every numeric column not in by.
+    n_permutations (int): Number of permutations of the permutation tests (0 to skip them).
+    alpha (float): Significance level, for the normality checks and the corrected verdicts.
+    correction (str): 'holm', 'bonferroni' or 'fdr_bh', applied per metric over the pairs.
+    seed (int): Seed of the permutations.
+
+    Returns:
+    pd.DataFrame: One row per metric and pair of configurations with the means, stds, sample sizes,
+                  Welch t statistic and p-value, Shapiro p-values, permutation p-value, adjusted p-values
+                  and the verdict (significant).
+    """
+    import pandas as pd
+
+    table = results if isinstance(results, pd.DataFrame) else pd.DataFrame(results)
+    by = [by] if isinstance(by, str) else list(by)
+    if metrics is None:
+        excluded = set(by) | {'fold', 'seed', 'time'}
+        metrics = [name for name in table.columns
+                   if name not in excluded and pd.api.types.is_numeric_dtype(table[name])
+                   and not pd.api.types.is_bool_dtype(table[name])]
+
+    configurations = table.groupby(by, sort=True)
+    labels = [', '.join(f"{name}={value}" for name, value in zip(by, key if isinstance(key, tuple) else (key,)))
+              for key, _ in configurations]
+    members = [rows.index for _, rows in configurations]
+    pairs = np.array([(a, b) for a in range(len(labels)) for b in range(a + 1, len(labels))]).reshape(-1, 2)
+
+    rows = []
+    for metric in metrics:
+        groups = [table.loc[index, metric].dropna().to_numpy(dtype=float) for index in members]
+        n = np.array([len(group) for group in groups], dtype=float)
+        means = np.array([group.mean() if len(group) else np.nan for group in groups])
+        variances = np.array([group.var(ddof=1) if len(group) > 1 else np.nan for group in groups])
+        shapiro_p = np.array([stats.shapiro(group)[1] if len(group) >= 3 and np.ptp(group) > 0 else np.nan
+                              for group in groups])
+
+        # Welch t-test of all the pairs at once
+        a, b = pairs[:, 0], pairs[:, 1]
+        se2_a, se2_b = variances[a] / n[a], variances[b] / n[b]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t_stat = (means[a] - means[b]) / np.sqrt(se2_a + se2_b)
+            dof = (se2_a + se2_b) ** 2 / (se2_a ** 2 / (n[a] - 1) + se2_b ** 2 / (n[b] - 1))
+        welch_p = 2 * stats.t.sf(np.abs(t_stat), dof)
+
+        valid = np.nonzero((n[a] > 0) & (n[b] > 0))[0]
+        perm_p = np.full(len(pairs), np.nan)
+        if n_permutations > 0 and len(valid):
+            perm_p[valid] = permutation_p_values(groups, pairs[valid], n_permutations, seed)
+
+        welch_adjusted = np.full(len(pairs), np.nan)
+        tested = ~np.isnan(welch_p)
+        welch_adjusted[tested] = adjust_p_values(welch_p[tested], correction)
+        perm_adjusted = np.full(len(pairs), np.nan)
+        tested_perm = ~np.isnan(perm_p)
+        perm_adjusted[tested_perm] = adjust_p_values(perm_p[tested_perm], correction)
+
+        normal = (shapiro_p[a] > alpha) & (shapiro_p[b] > alpha)
+        # the t-test verdict for normal samples, the permutation verdict otherwise
+        verdict_p = np.where(normal | np.isnan(perm_adjusted), welch_adjusted, perm_adjusted)
+        rows.append(pd.DataFrame({
+            'metric': metric,
+            'config_a': [labels[i] for i in a],
+            'config_b': [labels[i] for i in b],
+            'n_a': n[a].astype(int), 'n_b': n[b].astype(int),
+            'mean_a': means[a], 'mean_b': means[b],
+            'std_a': np.sqrt(variances[a]), 'std_b': np.sqrt(variances[b]),
+            'diff': means[a] - means[b],
+            't_stat': t_stat, 'welch_p': welch_p, 'welch_p_adjusted': welch_adjusted,
+            'shapiro_p_a': shapiro_p[a], 'shapiro_p_b': shapiro_p[b], 'normal': normal,
+            'perm_p': perm_p, 'perm_p_adjusted': perm_adjusted,
+            'significant': verdict_p < alpha,
+        }))
+
+    return pd.concat(rows, ignore_index=True) if rows else pd.DataFrame()
+
+
+if __name__ == '__main__':
+    # To test the class, we need to create some dummy data.
+    np.random.seed(0)  # Seed for reproducibility
+    method1_data = np.random.normal(100, 15, 35)  # Method 1 data: normal distribution around
@@ -1,14 +1,18 @@
 from datetime import datetime
-from typing import List, Tuple, Optional, Dict
+from typing import List, Tuple, Optional, Dict, Union
 
 import matplotlib.pyplot as plt
 import numpy as np
 import tensorflow as tf
-from sklearn.manifold import TSNE
 
 from dataload import seploader as sepl
+from dataload.dataset_view import DatasetView, pair_block
 from evaluate import evaluation as eval
+from evaluate.projection import EmbeddingProjection, PROJECTION
+from evaluate.results_store import ResultsStore, group_statistics, rows_to_columns
 from models import modeling
+from models.plot_service import submit_plot, render_intensity_scatter
+from models.prediction_cache import cached_predict
 
 
 def print_statistics(statistics: dict) -> None:
@@ -37,14 +41,20 @@ def print_statistics(statistics: dict) -> None:
         print(stats_str)
 
 
-def update_tracking(results_tracking: dict, batch_size: int, metrics: dict) -> None:
+def update_tracking(results_tracking: Union[dict, ResultsStore], batch_size: int, metrics: dict, **tags) -> None:
     """
-    Update the results tracking dictionary with the new metrics from a model run.
+    Update the results tracking with the new metrics from a model run.
 
-    :param results_tracking: A dictionary to track the metrics for each method (batch size).
+    :param results_tracking: A ResultsStore (the run is appended to its shards), or a dictionary to track the
+                             metrics for each method (batch size).
     :param batch_size: The batch size used in the model run.
     :param metrics: A dictionary containing the metrics from the model run.
+    :param tags: Tags of the run stored with a ResultsStore (fold, seed, model_type, ...).
     """
+    if isinstance(results_tracking, ResultsStore):
+        results_tracking.append(metrics, batch_size=batch_size, **tags)
+        return
+
     if batch_size not in results_tracking:
         results_tracking[batch_size] = []
 
@@ -53,32 +63,20 @@ def update_tracking(results_tracking: dict, batch_size: int, metrics: dict) -> N
 
 
 # Define the function to calculate statistics
-def calculate_statistics(results_tracking: dict) -> dict:
+def calculate_statistics(results_tracking: Union[dict, ResultsStore]) -> dict:
     """
-    Calculate the mean and standard deviation for each metric across all runs.
+    Calculate the mean and standard deviation for each metric across all runs, per batch size.
 
-    :param results_tracking: A dictionary with batch size keys and lists of metric dictionaries as values.
+    :param results_tracking: A ResultsStore (the runs of its session and tags are used, so stores sharing a
+                             root and a session stay apart), or a dictionary with batch size keys and lists of
+                             metric dictionaries as values.
     :return: A dictionary with the calculated statistics for each metric.
     """
-    statistics = {}
-    for batch_size, runs in results_tracking.items():
-        # Initialize a dictionary for this batch size
-        stats_for_batch = {}
-        # Exclude non-numeric metrics like 'plot'
-        numeric_metrics = {metric for metric in runs[0] if isinstance(runs[0][metric], (int, float))}
-
-        # Calculate mean and standard deviation for each numeric metric
-        for metric in numeric_metrics:
-            values = [run[metric] for run in runs]
-            stats_for_batch[metric] = {
-                'mean': np.mean(values),
-                'std': np.std(values)
-            }
+    if isinstance(results_tracking, ResultsStore):
+        return results_tracking.group_stats(by='batch_size', where=results_tracking.own_where())
 
-        # Assign the stats to the corresponding batch size
-        statistics[batch_size] = stats_for_batch
-
-    return statistics
+    rows = [{**run, 'batch_size': batch_size} for batch_size, runs in results_tracking.items() for run in runs]
+    return group_statistics(rows_to_columns(rows), by='batch_size')
 
 
 def split_combined_joint_weights_indices(
@@ -87,6 +85,8 @@ def split_combined_joint_weights_indices(
         len_train: int, len_val: int) -> Tuple[np.ndarray, List[Tuple[int, int]], np.ndarray, List[Tuple[int, int]]]:
     """
     Splits the combined joint weights and indices back into the original training and validation joint weights and indices.
+    When all the pairs are given in np.triu_indices order (as DenseJointReweights makes them), which is
+    recognized from their count and their first and last pairs, the blocks are sliced by offset arithmetic.
 
     Parameters:
         combined_weights (np.ndarray): The combined joint weights of training and validation sets.
@@ -98,6 +98,16 @@ def split_combined_joint_weights_indices(
         Tuple[np.ndarray, List[Tuple[int, int]], np.ndarray, List[Tuple[int, int]]]:
         Tuple containing the training and validation joint weights and index pairs.
     """
+    n = len_train + len_val
+    num_pairs = n * (n - 1) // 2
+    if (num_pairs > 0 and len(combined_weights) == num_pairs and len(combined_indices) == num_pairs
+            and tuple(combined_indices[0]) == (0, 1) and tuple(combined_indices[-1]) == (n - 2, n - 1)):
+        # all the pairs in np.triu_indices order (DenseJointReweights): address the blocks by offsets.
+        # The order is assumed from the count and the first and last pairs, not checked pair by pair
+        train_weights, train_indices = pair_block(combined_weights, 0, len_train, n)
+        val_weights, val_indices = pair_block(combined_weights, len_train, n, n)
+        return train_weights, train_indices, val_weights, val_indices
+
     train_weights, train_indices = [], []
     val_weights, val_indices = [], []
 
@@ -118,7 +128,9 @@ def plot_tsne_extended(
         model_type='features_reg',
         threshold: float = None, sep_threshold: float = None,
         show_plot=False,
-        save_tag=None, seed=42):
+        save_tag=None, seed=42,
+        projection: Optional[EmbeddingProjection] = None,
+        reference_X: Optional[np.ndarray] = None, reference_y: Optional[np.ndarray] = None):
     """
     Applies t-SNE to the features extracted by the given model and saves the plot in 2D with a timestamp.
     The color of the points is determined by their label values.
@@ -135,6 +147,9 @@ def plot_tsne_extended(
     - sep_threshold: Threshold for SEP events
     - save_tag: Optional tag to add to the saved file name
     - seed: Random seed for t-SNE
+    - projection: The cached t-SNE projection (default is the shared one). The map is fitted once per
+      (model, reference set) and the other sets are placed into it.
+    - reference_X, reference_y: Optional set to fit the map on (default is the latest map of the model, or X)
 
 
     Returns:
@@ -149,70 +164,25 @@ def plot_tsne_extended(
     # threshold = np.log(10 / np.exp(2)) + 1e-4
     # sep_threshold = np.log(10)
 
-    # Extract features using the trained extended model
-    if model_type == 'features_reg_dec':
-        features, _, _ = model.predict(X)
-    elif model_type == 'features_reg' or model_type == 'features_dec':
-        features, _ = model.predict(X)
-    else:  # model_type == 'features'
-        features = model.predict(X)
-
-    # Apply t-SNE
-    tsne = TSNE(n_components=2, random_state=seed)
-    tsne_result = tsne.fit_transform(features)
-
-    # Identify indices based on thresholds
-    above_sep_threshold_indices = np.where(y > sep_threshold)[0]
-    elevated_event_indices = np.where((y > threshold) & (y <= sep_threshold))[0]
-    below_threshold_indices = np.where(y <= threshold)[0]
-
-    plt.figure(figsize=(12, 8))
-
-    # Create scatter plot for below-threshold points (in gray)
-    plt.scatter(tsne_result[below_threshold_indices, 0], tsne_result[below_threshold_indices, 1], marker='o',
-                color='gray', alpha=0.6)
-
-    # Normalize y-values for better color mapping
-    norm = plt.Normalize(y.min(), y.max())
-
-    # Compute marker sizes based on y-values. Squaring to amplify differences.
-    marker_sizes_elevated = 50 * ((y[elevated_event_indices] - y.min()) / (y.max() - y.min())) ** 2 + 10
-    marker_sizes_sep = 50 * ((y[above_sep_threshold_indices] - y.min()) / (y.max() - y.min())) ** 2 + 10
-
-    # Create scatter plot for elevated events (square marker)
-    plt.scatter(tsne_result[elevated_event_indices, 0], tsne_result[elevated_event_indices, 1],
-                c=y[elevated_event_indices], cmap='plasma', norm=norm, alpha=0.6, marker='o', s=marker_sizes_elevated)
-
-    # Create scatter plot for SEPs (diamond marker)
-    plt.scatter(tsne_result[above_sep_threshold_indices, 0], tsne_result[above_sep_threshold_indices, 1],
-                c=y[above_sep_threshold_indices], cmap='plasma', norm=norm, alpha=0.6, marker='d', s=marker_sizes_sep)
+    # Project the features of the trained extended model into the cached t-SNE map
+    # (the features are the first output of the models with heads, i.e. model_type other than 'features')
+    projection = projection or PROJECTION
+    tsne_result = projection.project(model, X, y, head=0, reference_X=reference_X, reference_y=reference_y,
+                                     seed=seed)
 
-    # Add a color bar
-    sm = plt.cm.ScalarMappable(cmap='plasma', norm=norm)
-    sm.set_array([])
-    cbar = plt.colorbar(sm)
-    cbar.set_label('ln Intensity')
-
-    # Add a legend
-    legend_labels = [plt.Line2D([0], [0], marker='o', color='w', markerfacecolor='gray', markersize=10),
-                     plt.Line2D([0], [0], marker='o', color='w', markerfacecolor='blue', markersize=10),
-                     plt.Line2D([0], [0], marker='d', color='w', markerfacecolor='red', markersize=10)]
-
-    plt.legend(legend_labels, ['Background', 'Elevated Events (darker colors)', 'SEPs (lighter colors)'],
-               loc='upper left')
-
-    plt.title(f'{title}\n2D t-SNE Visualization')
-    plt.xlabel('Dimension 1')
-    plt.ylabel('Dimension 2')
-
-    # Save the plot
     file_path = f"{prefix}_tsne_plot_{str(save_tag)}.png"
-    plt.savefig(file_path)
+    plot_data = dict(points=tsne_result, y=y, threshold=threshold, sep_threshold=sep_threshold,
+                     title=f'{title}\n2D t-SNE Visualization', colorbar_label='ln Intensity',
+                     legend_labels=('Background', 'Elevated Events (darker colors)', 'SEPs (lighter colors)'))
 
     if show_plot:
+        # shown interactively, so rendered here rather than by the plot service
+        render_intensity_scatter(plt.figure(figsize=(12, 8)), **plot_data)
+        plt.savefig(file_path)
         plt.show()
-
-    plt.close()
+        plt.close()
+    else:
+        submit_plot('intensity_scatter', file_path, **plot_data)
 
     return file_path
 
@@ -239,66 +209,24 @@ def plot_2D_pds(model, X, y, title, prefix, save_tag=None):
 
     # Check if feature dimension is 2
     if model is not None:
-        features = model.predict(X)
+        features = cached_predict(model, X)
     else:
         features = X
 
     if features.shape[1] != 2:
         raise ValueError("Feature dimension is not 2, cannot plot directly without t-SNE.")
 
-    # Identify indices based on thresholds
-    above_sep_threshold_indices = np.where(y > sep_threshold)[0]
-    elevated_event_indices = np.where((y > threshold) & (y <= sep_threshold))[0]
-    below_threshold_indices = np.where(y <= threshold)[0]
-
-    plt.figure(figsize=(12, 8))
-
-    # Create scatter plot for below-threshold points (in gray)
-    plt.scatter(features[below_threshold_indices, 0], features[below_threshold_indices, 1], marker='o',
-                color='gray', alpha=0.6)
-
-    # Normalize y-values for better color mapping
-    norm = plt.Normalize(y.min(), y.max())
-
-    # Compute marker sizes based on y-values
-    marker_sizes_elevated = 50 * ((y[elevated_event_indices] - y.min()) / (y.max() - y.min())) ** 2 + 10
-    marker_sizes_sep = 50 * ((y[above_sep_threshold_indices] - y.min()) / (y.max() - y.min())) ** 2 + 10
-
-    # Create scatter plot for elevated events (circle marker)
-    plt.scatter(features[elevated_event_indices, 0], features[elevated_event_indices, 1],
-                c=y[elevated_event_indices], cmap='plasma', norm=norm, alpha=0.6, marker='o', s=marker_sizes_elevated)
-
-    # Create scatter plot for SEPs (diamond marker)
-    plt.scatter(features[above_sep_threshold_indices, 0], features[above_sep_threshold_indices, 1],
-                c=y[above_sep_threshold_indices], cmap='plasma', norm=norm, alpha=0.6, marker='d', s=marker_sizes_sep)
-
-    # Add a color bar
-    sm = plt.cm.ScalarMappable(cmap='plasma', norm=norm)
-    sm.set_array([])
-    cbar = plt.colorbar(sm)
-    cbar.set_label('Label Value')
-
-    # Add a legend
-    legend_labels = [plt.Line2D([0], [0], marker='o', color='w', markerfacecolor='gray', markersize=10),
-                     plt.Line2D([0], [0], marker='o', color='w', markerfacecolor='blue', markersize=10),
-                     plt.Line2D([0], [0], marker='d', color='w', markerfacecolor='red', markersize=10)]
-
-    plt.legend(legend_labels, ['Background', 'Elevated Events', 'SEPs'],
-               loc='upper left')
-
-    plt.title(f'{title}\n2D Feature Visualization')
-    plt.xlabel('Dimension 1')
-    plt.ylabel('Dimension 2')
-
     # Save the plot
     file_path = f"{prefix}_2d_features_plot_{save_tag}.png"
-    plt.savefig(file_path)
-    plt.close()
+    submit_plot('intensity_scatter', file_path, points=features, y=y, threshold=threshold,
+                sep_threshold=sep_threshold, title=f'{title}\n2D Feature Visualization')
 
     return file_path
 
 
-def plot_tsne_pds(model, X, y, title, prefix, save_tag=None, seed=42):
+def plot_tsne_pds(model, X, y, title, prefix, save_tag=None, seed=42,
+                  projection: Optional[EmbeddingProjection] = None,
+                  reference_X: Optional[np.ndarray] = None, reference_y: Optional[np.ndarray] = None):
     """
     Applies t-SNE to the features extracted by the given model and saves the plot in 2D with a timestamp.
     The color of the points is determined by their label values.
@@ -308,6 +236,8 @@ def plot_tsne_pds(model, X, y, title, prefix, save_tag=None, seed=42):
     - X: Input data (NumPy array or compatible)
     - y: Target labels (NumPy array or compatible)
     - prefix: Prefix for the file name
+    - projection: The cached t-SNE projection (default is the shared one)
+    - reference_X, reference_y: Optional set to fit the map on (default is the latest map of the model, or X)
 
     Returns:
     - Saves a 2D t-SNE plot to a file with a timestamp
@@ -316,62 +246,15 @@ def plot_tsne_pds(model, X, y, title, prefix, save_tag=None, seed=42):
     threshold = np.log(10 / np.exp(2)) + 1e-4
     sep_threshold = np.log(10)
 
-    # Extract features using the trained model
-    features = model.predict(X)
-
-    # Apply t-SNE
-    tsne = TSNE(n_components=2, random_state=seed)
-    tsne_result = tsne.fit_transform(features)
-
-    # Identify indices based on thresholds
-    above_sep_threshold_indices = np.where(y > sep_threshold)[0]
-    elevated_event_indices = np.where((y > threshold) & (y <= sep_threshold))[0]
-    below_threshold_indices = np.where(y <= threshold)[0]
-
-    plt.figure(figsize=(12, 8))
-
-    # Create scatter plot for below-threshold points (in gray)
-    plt.scatter(tsne_result[below_threshold_indices, 0], tsne_result[below_threshold_indices, 1], marker='o',
-                color='gray', alpha=0.6)
-
-    # Normalize y-values for better color mapping
-    norm = plt.Normalize(y.min(), y.max())
-
-    # Compute marker sizes based on y-values
-    marker_sizes_elevated = 50 * ((y[elevated_event_indices] - y.min()) / (y.max() - y.min())) ** 2 + 10
-    marker_sizes_sep = 50 * ((y[above_sep_threshold_indices] - y.min()) / (y.max() - y.min())) ** 2 + 10
-
-    # Create scatter plot for elevated events (square marker)
-    plt.scatter(tsne_result[elevated_event_indices, 0], tsne_result[elevated_event_indices, 1],
-                c=y[elevated_event_indices], cmap='plasma', norm=norm, alpha=0.6, marker='o', s=marker_sizes_elevated)
-
-    # Create scatter plot for SEPs (diamond marker)
-    plt.scatter(tsne_result[above_sep_threshold_indices, 0], tsne_result[above_sep_threshold_indices, 1],
-                c=y[above_sep_threshold_indices], cmap='plasma', norm=norm, alpha=0.6, marker='d', s=marker_sizes_sep)
-
-    # Add a color bar
-    sm = plt.cm.ScalarMappable(cmap='plasma', norm=norm)
-    sm.set_array([])
-    cbar = plt.colorbar(sm)
-    cbar.set_label('Label Value')
-
-    # Add legend
-    # Add a legend
-    legend_labels = [plt.Line2D([0], [0], marker='o', color='w', markerfacecolor='gray', markersize=10),
-                     plt.Line2D([0], [0], marker='o', color='w', markerfacecolor='blue', markersize=10),
-                     plt.Line2D([0], [0], marker='d', color='w', markerfacecolor='red', markersize=10)]
-
-    plt.legend(legend_labels, ['Background', 'Elevated Events (darker colors)', 'SEPs (lighter colors)'],
-               loc='upper left')
-
-    plt.title(f'{title}\n2D t-SNE Visualization')
-    plt.xlabel('Dimension 1')
-    plt.ylabel('Dimension 2')
+    # Project the features of the trained model into the cached t-SNE map
+    projection = projection or PROJECTION
+    tsne_result = projection.project(model, X, y, reference_X=reference_X, reference_y=reference_y, seed=seed)
 
     # Save the plot
     file_path = f"{prefix}_tsne_plot_{str(save_tag)}.png"
-    plt.savefig(file_path)
-    plt.close()
+    submit_plot('intensity_scatter', file_path, points=tsne_result, y=y, threshold=threshold,
+                sep_threshold=sep_threshold, title=f'{title}\n2D t-SNE Visualization',
+                legend_labels=('Background', 'Elevated Events (darker colors)', 'SEPs (lighter colors)'))
 
     return file_path
 
@@ -397,57 +280,90 @@ def count_above_threshold(y_values: List[float], threshold: float = 0.3027, sep_
     return elevated_count, sep_count
 
 
-def load_model_with_weights(model_type: str,
-                            weight_path: str,
-                            input_dim: int = 19,
-                            feat_dim: int = 9,
-                            hiddens: Optional[list] = None,
-                            output_dim: int = 1) -> tf.keras.Model:
+def build_model(model_type: str,
+                with_head: bool = False,
+                input_dim: int = 19,
+                feat_dim: int = 9,
+                hiddens: Optional[list] = None,
+                output_dim: int = 1) -> tf.keras.Model:
     """
-    Load a model of a given type with pre-trained weights.
+    Build the architecture of a model type, without weights.
 
-    :param output_dim:
-    :param model_type: The type of the model to load ('features', 'reg', 'dec', 'features_reg_dec', etc.).
-    :param weight_path: The path to the saved weights.
+    :param model_type: The type of the model ('features', 'features_reg', 'features_dec', 'features_reg_dec').
+    :param with_head: Whether the model is extended with the regression projection head.
     :param input_dim: The input dimension for the model. Default is 19.
     :param feat_dim: The feature dimension for the model. Default is 9.
     :param hiddens: A list of integers specifying the number of hidden units for each hidden layer.
-    :return: A loaded model with pre-trained weights.
+    :param output_dim: The output dimension of the regression output.
+    :return: The model.
     """
     if hiddens is None:
         hiddens = [18]
     mb = modeling.ModelBuilder()
 
-    model = None  # will be determined by model type
+    if with_head:
+        if model_type == 'features':
+            features_model = mb.create_model_pds(input_dim=input_dim, feat_dim=feat_dim, hiddens=hiddens)
+            return mb.add_reg_proj_head(features_model, freeze_features=False, pds=True)
+        elif model_type == 'features_reg':
+            features_model = mb.create_model(input_dim=input_dim, feat_dim=feat_dim, output_dim=output_dim,
+                                             hiddens=hiddens)
+            return mb.add_reg_proj_head(features_model, freeze_features=False)
+        elif model_type == 'features_reg_dec':
+            features_model = mb.create_model(input_dim=input_dim, feat_dim=feat_dim, output_dim=output_dim,
+                                             hiddens=hiddens, with_ae=True)
+            return mb.add_reg_proj_head(features_model, freeze_features=False)
+        else:  # regular reg
+            return mb.create_model(input_dim=input_dim, feat_dim=feat_dim, output_dim=output_dim, hiddens=hiddens)
+
     if model_type == 'features_reg_dec':
-        # Add logic to create this type of model
-        model = mb.create_model_pds(
+        return mb.create_model_pds(
             input_dim=input_dim,
             feat_dim=feat_dim,
             hiddens=hiddens,
             output_dim=output_dim,
             with_ae=True, with_reg=True)
     elif model_type == 'features_reg':
-        model = mb.create_model_pds(
+        return mb.create_model_pds(
             input_dim=input_dim,
             feat_dim=feat_dim,
             hiddens=hiddens,
             output_dim=output_dim,
             with_ae=False, with_reg=True)
     elif model_type == 'features_dec':
-        model = mb.create_model_pds(
+        return mb.create_model_pds(
             input_dim=input_dim,
             feat_dim=feat_dim,
             hiddens=hiddens,
             output_dim=None,
             with_ae=True, with_reg=False)
     else:  # features
-        model = mb.create_model_pds(
+        return mb.create_model_pds(
             input_dim=input_dim,
             feat_dim=feat_dim,
             hiddens=hiddens,
             output_dim=None,
             with_ae=False, with_reg=False)
+
+
+def load_model_with_weights(model_type: str,
+                            weight_path: str,
+                            input_dim: int = 19,
+                            feat_dim: int = 9,
+                            hiddens: Optional[list] = None,
+                            output_dim: int = 1) -> tf.keras.Model:
+    """
+    Load a model of a given type with pre-trained weights.
+
+    :param output_dim:
+    :param model_type: The type of the model to load ('features', 'reg', 'dec', 'features_reg_dec', etc.).
+    :param weight_path: The path to the saved weights.
+    :param input_dim: The input dimension for the model. Default is 19.
+    :param feat_dim: The feature dimension for the model. Default is 9.
+    :param hiddens: A list of integers specifying the number of hidden units for each hidden layer.
+    :return: A loaded model with pre-trained weights.
+    """
+    model = build_model(model_type, input_dim=input_dim, feat_dim=feat_dim, hiddens=hiddens, output_dim=output_dim)
     # Load weights into the model
     model.load_weights(weight_path)
     print(f"Weights {weight_path} loaded successfully!")
@@ -482,21 +398,8 @@ def load_and_plot_tsne(
     # check for gpus
     print(tf.config.list_physical_devices('GPU'))
     # Load the appropriate model
-    mb = modeling.ModelBuilder()
-
     if with_head:
-        if model_type == 'features':
-            features_model = mb.create_model_pds(input_dim=19, feat_dim=9, hiddens=[18])
-            loaded_model = mb.add_reg_proj_head(features_model, freeze_features=False, pds=True)
-        elif model_type == 'features_reg':
-            features_model = mb.create_model(input_dim=19, feat_dim=9, output_dim=1, hiddens=[18])
-            loaded_model = mb.add_reg_proj_head(features_model, freeze_features=False)
-        elif model_type == 'features_reg_dec':
-            features_model = mb.create_model(input_dim=19, feat_dim=9, output_dim=1, hiddens=[18], with_ae=True)
-            loaded_model = mb.add_reg_proj_head(features_model, freeze_features=False)
-        else:  # regular reg
-            loaded_model = mb.create_model(input_dim=19, feat_dim=9, output_dim=1, hiddens=[18])
-
+        loaded_model = build_model(model_type, with_head=True)
         loaded_model.load_weights(model_path)
         print(f'Model loaded from {model_path}')
     else:
@@ -515,16 +418,11 @@ def load_and_plot_tsne(
     print(f'Test set: elevated events: {elevateds}  and sep events: {seps}')
 
     # Combine training and validation sets
-    combined_train_x, combined_train_y = loader.combine(train_x, train_y, val_x, val_y)
-
-    # Plot and save t-SNE
-    test_plot_path = plot_tsne_extended(loaded_model,
-                                        test_x, test_y,
-                                        title,
-                                        model_type + '_testing_',
-                                        model_type=model_type,
-                                        save_tag=timestamp)
+    data = DatasetView.from_splits(train_x, train_y, val_x, val_y, test_x, test_y)
+    combined_train_x, combined_train_y = data['train']
+    test_x, test_y = data['test']
 
+    # Plot and save t-SNE (the map is fitted on the training set, the test set is placed into it)
     training_plot_path = plot_tsne_extended(loaded_model,
                                             combined_train_x,
                                             combined_train_y,
@@ -533,6 +431,15 @@ def load_and_plot_tsne(
                                             model_type=model_type,
                                             save_tag=timestamp)
 
+    test_plot_path = plot_tsne_extended(loaded_model,
+                                        test_x, test_y,
+                                        title,
+                                        model_type + '_testing_',
+                                        model_type=model_type,
+                                        save_tag=timestamp,
+                                        reference_X=combined_train_x,
+                                        reference_y=combined_train_y)
+
     return test_plot_path, training_plot_path
 
 
@@ -587,7 +494,9 @@ def load_and_test(model_path, model_type, title, threshold=10,
     print(f'Test set: elevated events: {elevateds}  and sep events: {seps}')
 
     # Combine training and validation sets
-    combined_train_x, combined_train_y = loader.combine(train_x, train_y, val_x, val_y)
+    data = DatasetView.from_splits(train_x, train_y, val_x, val_y, test_x, test_y)
+    combined_train_x, combined_train_y = data['train']
+    test_x, test_y = data['test']
 
     # Evaluate and save results
     ev = eval.Evaluator()
@@ -8,14 +8,17 @@ import tensorflow as tf
 
 from dataload import DenseReweights as dr
 from dataload import seploader as sepl
+from dataload.dataset_view import DatasetView
 from evaluate import evaluation as eval
 from evaluate.utils import count_above_threshold, \
     plot_tsne_extended, \
     update_tracking, \
     calculate_statistics, \
     print_statistics
+from evaluate.results_store import ResultsStore
 # types for type hinting
 from models import modeling
+from models.plot_service import log_plot_artifact
 
 # Set the DagsHub credentials programmatically
 os.environ['MLFLOW_TRACKING_USERNAME'] = 'ERUD1T3'
@@ -45,8 +48,8 @@ def main():
     # Read the CSV file
     loader = sepl.SEPLoader()
     # Initialize a nested dictionary to store the metrics
-    test_results = {}
-    training_results = {}
+    test_results = ResultsStore('results_store', experiment='exp_head_rrt_ae', dataset='test')
+    training_results = ResultsStore('results_store', experiment='exp_head_rrt_ae', dataset='training')
 
     for fold in folds:
         shuffled_data = loader.load_fold_from_dir(data_path, fold)
@@ -57,8 +60,12 @@ def main():
         shuffled_test_x = shuffled_data[4]
         shuffled_test_y = shuffled_data[5]
         # combine and get weights
-        combined_train_x, combined_train_y = loader.combine(shuffled_train_x, shuffled_train_y, shuffled_val_x,
-                                                            shuffled_val_y)
+        data = DatasetView.from_splits(shuffled_train_x, shuffled_train_y, shuffled_val_x, shuffled_val_y,
+                                       shuffled_test_x, shuffled_test_y)
+        shuffled_train_x, shuffled_train_y = data['subtrain']
+        shuffled_val_x, shuffled_val_y = data['val']
+        shuffled_test_x, shuffled_test_y = data['test']
+        combined_train_x, combined_train_y = data['train']
         min_norm_weight = 0.01 / len(combined_train_y)
 
         # get validation sample weights based on dense weights
@@ -127,11 +134,11 @@ def main():
                     file_path = plot_tsne_extended(feat_reg_ae, combined_train_x, combined_train_y, title,
                                                    'rrtae_stage1_training_',
                                                    model_type='features_reg_dec', save_tag=timestamp, seed=seed)
-                    mlflow.log_artifact(file_path)
+                    log_plot_artifact(file_path)
                     file_path = plot_tsne_extended(feat_reg_ae, shuffled_test_x, shuffled_test_y, title,
                                                    'rrtae_stage1_testing_',
                                                    model_type='features_reg_dec', save_tag=timestamp, seed=seed)
-                    mlflow.log_artifact(file_path)
+                    log_plot_artifact(file_path)
                     # add the regression head with dense weighting
                     regressor = mb.add_reg_proj_head(feat_reg_ae, freeze_features=freeze)
 
@@ -161,37 +168,41 @@ def main():
                     file_path = plot_tsne_extended(regressor, combined_train_x, combined_train_y, title,
                                                    'rrtae_stage2_training_',
                                                    save_tag=timestamp, seed=seed)
-                    mlflow.log_artifact(file_path)
+                    log_plot_artifact(file_path)
                     file_path = plot_tsne_extended(regressor, shuffled_test_x, shuffled_test_y, title,
                                                    'rrtae_stage2_testing_',
                                                    save_tag=timestamp, seed=seed)
-                    mlflow.log_artifact(file_path)
+                    log_plot_artifact(file_path)
                     ev = eval.Evaluator()
                     metrics = ev.evaluate(regressor, shuffled_test_x, shuffled_test_y, title, threshold=10,
                                           save_tag='rrtae_test_' + timestamp)
                     # Log each metric in the dictionary
                     for key, value in metrics.items():
                         if key == 'plot':
-                            mlflow.log_artifact(value)  # Log the plot as an artifact
+                            log_plot_artifact(value)  # Log the plot as an artifact
+                        elif key == 'details':
+                            mlflow.log_dict(value, f"bin_mae_{value['save_tag']}.json")
                         else:
                             mlflow.log_metric(key, value)  # Log other items as metrics
 
-                    update_tracking(test_results, batch_size, metrics)
+                    update_tracking(test_results, batch_size, metrics, fold=fold, seed=seed, freeze=freeze)
                     metrics = ev.evaluate(regressor, combined_train_x, combined_train_y, title, threshold=10,
                                           save_tag='rrtae_training_' + timestamp)
                     # Log each metric in the dictionary
                     for key, value in metrics.items():
                         if key == 'plot':
-                            mlflow.log_artifact(value)  # Log the plot as an artifact
+                            log_plot_artifact(value)  # Log the plot as an artifact
+                        elif key == 'details':
+                            mlflow.log_dict(value, f"bin_mae_{value['save_tag']}.json")
                         else:
                             mlflow.log_metric(key, value)  # Log other items as metrics
 
-                    update_tracking(training_results, batch_size, metrics)
+                    update_tracking(training_results, batch_size, metrics, fold=fold, seed=seed, freeze=freeze)
 
-    print(test_results)
+    print(test_results.to_frame(where=test_results.own_where()))
     test_stats = calculate_statistics(test_results)
     print(test_stats)
-    print(training_results)
+    print(training_results.to_frame(where=training_results.own_where()))
     training_stats = calculate_statistics(training_results)
     print(training_stats)
 
@@ -9,11 +9,13 @@ import tensorflow as tf
 
 from dataload import DenseReweights as dr
 from dataload import seploader as sepl
+from dataload.dataset_view import DatasetView
 from evaluate.utils import count_above_threshold, \
     plot_tsne_pds, \
     split_combined_joint_weights_indices, \
     load_model_with_weights
 from models import modeling
+from models.plot_service import log_plot_artifact
 
 # Set the DagsHub credentials programmatically
 os.environ['MLFLOW_TRACKING_USERNAME'] = 'ERUD1T3'
@@ -55,8 +57,12 @@ def main():
         shuffled_val_y, shuffled_test_x, shuffled_test_y = loader.load_from_dir(data_path)
 
     # combine training and validation
-    combined_train_x, combined_train_y = loader.combine(
-        shuffled_train_x, shuffled_train_y, shuffled_val_x, shuffled_val_y)
+    data = DatasetView.from_splits(shuffled_train_x, shuffled_train_y, shuffled_val_x, shuffled_val_y,
+                                   shuffled_test_x, shuffled_test_y)
+    shuffled_train_x, shuffled_train_y = data['subtrain']
+    shuffled_val_x, shuffled_val_y = data['val']
+    shuffled_test_x, shuffled_test_y = data['test']
+    combined_train_x, combined_train_y = data['train']
 
     # print(f'len combined: {len(combined_train_y)}')
     min_norm_weight = 0.01 / len(combined_train_y)
@@ -152,7 +158,7 @@ def main():
                                       combined_train_y,
                                       title, 'training',
                                       save_tag=timestamp)
-            mlflow.log_artifact(file_path)
+            log_plot_artifact(file_path)
             print('file_path' + file_path)
 
             file_path = plot_tsne_pds(feature_extractor,
@@ -160,7 +166,7 @@ def main():
                                       shuffled_test_y,
                                       title, 'testing',
                                       save_tag=timestamp)
-            mlflow.log_artifact(file_path)
+            log_plot_artifact(file_path)
             print('file_path' + file_path)
 
 
@@ -5,9 +5,12 @@ import mlflow.tensorflow
 import numpy as np
 import tensorflow as tf
 from dataload import seploader as sepl
+from dataload.dataset_view import DatasetView
 from evaluate.utils import count_above_threshold, plot_tsne_pds
 # types for type hinting
 from models import modeling
+from models.plot_service import log_plot_artifact
+from models.pair_metrics import pair_counts_from_history
 import os
 
 # # Set the tracking URI to a local directory
@@ -61,8 +64,12 @@ def main():
     print(f'Test set: elevated events: {elevateds}  and sep events: {seps}')
 
     # combine training and validation
-    combined_train_x, combined_train_y = loader.combine(shuffled_train_x, shuffled_train_y, shuffled_val_x,
-                                                        shuffled_val_y)
+    data = DatasetView.from_splits(shuffled_train_x, shuffled_train_y, shuffled_val_x, shuffled_val_y,
+                                   shuffled_test_x, shuffled_test_y)
+    shuffled_train_x, shuffled_train_y = data['subtrain']
+    shuffled_val_x, shuffled_val_y = data['val']
+    shuffled_test_x, shuffled_test_y = data['test']
+    combined_train_x, combined_train_y = data['train']
 
     for batch_size in [300, -1]:  # Replace with the batch sizes you're interested in
         title = f'PDS, batche size {batch_size}'
@@ -97,58 +104,54 @@ def main():
 
             # print options used
             print(Options)
-            # reset the counts
-            # mb.sep_sep_count = 0
-            # mb.sep_elevated_count = 0
-            # mb.sep_background_count = 0
-            # mb.elevated_elevated_count = 0
-            # mb.elevated_background_count = 0
-            # mb.background_background_count = 0
-            # mb.number_of_batches = 0
-
-            _, entire_training_loss = mb.train_pds(feature_extractor,
-                                                   shuffled_train_x, shuffled_train_y,
-                                                   shuffled_val_x, shuffled_val_y,
-                                                   combined_train_x, combined_train_y,
-                                                   learning_rate=Options['learning_rate'],
-                                                   epochs=Options['epochs'],
-                                                   batch_size=Options['batch_size'],
-                                                   patience=Options['patience'],
-                                                   save_tag=timestamp + f"_features_{batch_size}")
+
+            history = mb.train_pds(feature_extractor,
+                                   shuffled_train_x, shuffled_train_y,
+                                   shuffled_val_x, shuffled_val_y,
+                                   combined_train_x, combined_train_y,
+                                   learning_rate=Options['learning_rate'],
+                                   epochs=Options['epochs'],
+                                   batch_size=Options['batch_size'],
+                                   patience=Options['patience'],
+                                   save_tag=timestamp + f"_features_{batch_size}")
+            # loss of the final model over the whole training set
+            entire_training_loss = modeling.evaluate(feature_extractor, combined_train_x, combined_train_y)
 
             # Log the training loss to MLflow
             mlflow.log_metric("entire_train_loss", entire_training_loss)
 
-            sep_sep_count = int(mb.sep_sep_count.numpy())
-            sep_elevated_count = int(mb.sep_elevated_count.numpy())
-            sep_background_count = int(mb.sep_background_count.numpy())
-            elevated_elevated_count = int(mb.elevated_elevated_count.numpy())
-            elevated_background_count = int(mb.elevated_background_count.numpy())
-            background_background_count = int(mb.background_background_count.numpy())
-
-            mlflow.log_metric("sep_sep", sep_sep_count)
-            mlflow.log_metric("sep_elevated", sep_elevated_count)
-            mlflow.log_metric("sep_background", sep_background_count)
-            mlflow.log_metric("elevated_elevated", elevated_elevated_count)
-            mlflow.log_metric("elevated_background", elevated_background_count)
-            mlflow.log_metric("background_background", background_background_count)
+            # pair counts of the search fit (not the retrain fit), from the pair type metrics, logged as search_*
+            pair_counts = pair_counts_from_history(history.history)
+            sep_sep_count = pair_counts['sep_sep']
+            sep_elevated_count = pair_counts['sep_elevated']
+            sep_background_count = pair_counts['sep_background']
+            elevated_elevated_count = pair_counts['elevated_elevated']
+            elevated_background_count = pair_counts['elevated_background']
+            background_background_count = pair_counts['background_background']
+
+            mlflow.log_metric("search_sep_sep", sep_sep_count)
+            mlflow.log_metric("search_sep_elevated", sep_elevated_count)
+            mlflow.log_metric("search_sep_background", sep_background_count)
+            mlflow.log_metric("search_elevated_elevated", elevated_elevated_count)
+            mlflow.log_metric("search_elevated_background", elevated_background_count)
+            mlflow.log_metric("search_background_background", background_background_count)
 
             total_pairs = (sep_sep_count + sep_elevated_count + sep_background_count +
                            elevated_elevated_count + elevated_background_count +
                            background_background_count)
 
-            mlflow.log_metric("total_pairs", total_pairs)
-            mlflow.log_metric("number_of_batches", mb.number_of_batches)
+            mlflow.log_metric("search_total_pairs", total_pairs)
+            mlflow.log_metric("search_number_of_batches", pair_counts['number_of_batches'])
 
             percent_sep_sep = (sep_sep_count / total_pairs) * 100 if total_pairs > 0 else 0
-            mlflow.log_metric("percent_sep_sep", percent_sep_sep)
+            mlflow.log_metric("search_percent_sep_sep", percent_sep_sep)
 
             file_path = plot_tsne_pds(feature_extractor,
                                       combined_train_x,
                                       combined_train_y,
                                       title, 'training',
                                       save_tag=timestamp)
-            mlflow.log_artifact(file_path)
+            log_plot_artifact(file_path)
             print('file_path' + file_path)
             file_path = plot_tsne_pds(feature_extractor,
                                       shuffled_test_x,
@@ -156,7 +159,7 @@ def main():
                                       title, 'testing',
                                       save_tag=timestamp)
             # Log t-SNE plot
-            mlflow.log_artifact(file_path)
+            log_plot_artifact(file_path)
             print('file_path' + file_path)
 
 
@@ -6,6 +6,7 @@ import os
 import numpy as np
 import tensorflow as tf
 from dataload import seploader as sepl
+from dataload.dataset_view import DatasetView
 from evaluate.utils import count_above_threshold, plot_tsne_pds
 # types for type hinting
 from models import modeling
@@ -57,8 +58,12 @@ def main():
     print(f'Test set: elevated events: {elevateds}  and sep events: {seps}')
 
     # combine training and validation
-    combined_train_x, combined_train_y = loader.combine(shuffled_train_x, shuffled_train_y, shuffled_val_x,
-                                                        shuffled_val_y)
+    data = DatasetView.from_splits(shuffled_train_x, shuffled_train_y, shuffled_val_x, shuffled_val_y,
+                                   shuffled_test_x, shuffled_test_y)
+    shuffled_train_x, shuffled_train_y = data['subtrain']
+    shuffled_val_x, shuffled_val_y = data['val']
+    shuffled_test_x, shuffled_test_y = data['test']
+    combined_train_x, combined_train_y = data['train']
 
     for batch_size in [-1]:  # Replace with the batch sizes you're interested in
         title = f'PDS, {"with" if batch_size > 0 else "without"} batches'
@@ -110,7 +115,7 @@ def main():
                                   combined_train_y,
                                   title, 'training',
                                   save_tag=timestamp)
-        # mlflow.log_artifact(file_path)
+        # log_plot_artifact(file_path)
         print('file_path' + file_path)
         file_path = plot_tsne_pds(feature_extractor,
                                   shuffled_test_x,
@@ -118,7 +123,7 @@ def main():
                                   title, 'testing',
                                   save_tag=timestamp)
         # Log t-SNE plot
-        # mlflow.log_artifact(file_path)
+        # log_plot_artifact(file_path)
         print('file_path' + file_path)
 
 
@@ -0,0 +1,242 @@
+##############################################################################################################
+# Description: class-balanced batch sampling as a tf.data pipeline. The samples are pooled by class (SEP,
+# elevated, background) from a label-sorted index, and whole epochs of batch index matrices are drawn at once
+# with per-class quotas (or quotas fitted to a target pair type mix), so no Python runs per batch.
+##############################################################################################################
+# types for type hinting
+from typing import Dict, Iterator, List, Optional, Sequence, Union
+
+import numpy as np
+# imports
+import tensorflow as tf
+from numpy import ndarray
+
+from dataload.dtype_policy import as_policy
+from models.pair_metrics import PAIR_TYPES, PAIR_TYPE_CLASSES
+
+# classes in the order of the class index of pair_metrics
+CLASSES = ['sep', 'elevated', 'background']
+
+
+def pair_counts_of(s: ndarray, e: ndarray, b: ndarray) -> ndarray:
+    """
+    Number of pairs of each pair type (in the order of PAIR_TYPES) of batches of s SEP, e elevated and b
+    background samples (arrays of the same shape, the pair types are stacked on the first axis).
+    """
+    q = [s, e, b]
+    return np.stack([q[a] * np.maximum(q[a] - 1, 0) / 2 if a == c else q[a] * q[c] for a, c in PAIR_TYPE_CLASSES])
+
+
+def pair_type_fractions(quotas: Sequence[int]) -> ndarray:
+    """
+    Fraction of the pairs of a batch of each pair type (in the order of PAIR_TYPES) given the class quotas.
+
+    :param quotas: The number of SEP, elevated and background samples per batch.
+    :return: The six fractions.
+    """
+    counts = pair_counts_of(*np.asarray(quotas, dtype=np.float64))
+    return counts / max(counts.sum(), 1.)
+
+
+def quotas_for_pair_mix(pair_mix: Union[Dict[str, float], Sequence[float]], batch_size: int,
+                        available: Sequence[bool] = (True, True, True)) -> List[int]:
+    """
+    Class quotas of a batch whose pair type fractions are the closest (least squares) to a target mix.
+    The batch has batch_size (batch_size - 1) / 2 pairs whatever the quotas, so for a number s of SEP samples
+    the squared error is a quartic in the number e of elevated samples: its minimum is at a root of the cubic
+    derivative, found for all s at once (eigenvalues of the companion matrices) and rounded to the nearest
+    integers, in O(batch_size) memory.
+
+    :param pair_mix: The target fraction of each pair type, as a dict keyed by PAIR_TYPES or a sequence
+                     in the order of PAIR_TYPES (normalized to sum to 1).
+    :param batch_size: The batch size.
+    :param available: Whether each class has samples (empty classes get no quota).
+    :return: The number of SEP, elevated and background samples per batch.
+    """
+    if isinstance(pair_mix, dict):
+        pair_mix = [pair_mix.get(name, 0.) for name in PAIR_TYPES]
+    target = np.asarray(pair_mix, dtype=np.float64)
+    target = target / target.sum()
+    num_pairs = max(batch_size * (batch_size - 1) / 2, 1.)
+
+    s = np.arange(batch_size + 1, dtype=np.float64) if available[0] else np.zeros(1)
+    rest = batch_size - s
+    zero, one = np.zeros_like(s), np.ones_like(s)
+    # pair counts as polynomials in e, coefficients of degree 0, 1, 2 (b = rest - e)
+    counts = np.stack([
+        np.stack([s * (s - 1) / 2, zero, zero], axis=1),  # sep_sep
+        np.stack([zero, s, zero], axis=1),  # sep_elevated
+        np.stack([s * rest, -s, zero], axis=1),  # sep_background
+        np.stack([zero, -one / 2, one / 2], axis=1),  # elevated_elevated
+        np.stack([zero, rest, -one], axis=1),  # elevated_background
+        np.stack([rest * (rest - 1) / 2, -(2 * rest - 1) / 2, one / 2], axis=1),  # background_background
+    ])
+    residuals = counts / num_pairs
+    residuals[:, :, 0] -= target[:, None]
+    a0, a1, a2 = residuals[:, :, 0], residuals[:, :, 1], residuals[:, :, 2]
+    # half the derivative of the squared error: sum of residual * residual', a cubic with a positive leading term
+    d0, d1 = np.sum(a0 * a1, axis=0), np.sum(2 * a0 * a2 + a1 ** 2, axis=0)
+    d2, d3 = np.sum(3 * a1 * a2, axis=0), np.sum(2 * a2 ** 2, axis=0)
+    companion = np.zeros((len(s), 3, 3))
+    companion[:, 0, :] = -np.stack([d2, d1, d0], axis=1) / d3[:, None]
+    companion[:, 1, 0] = companion[:, 2, 1] = 1.
+    roots = np.real(np.linalg.eigvals(companion))
+
+    # candidate e: the rounded roots and the bounds
+    candidates = np.concatenate([np.floor(roots), np.ceil(roots), np.zeros((len(s), 1)), rest[:, None]], axis=1)
+    candidates = np.clip(candidates, 0, rest[:, None])
+    s_grid = np.broadcast_to(s[:, None], candidates.shape)
+    b_grid = rest[:, None] - candidates
+    errors = np.sum((pair_counts_of(s_grid, candidates, b_grid) / num_pairs - target[:, None, None]) ** 2, axis=0)
+    if not available[1]:
+        errors[candidates > 0] = np.inf
+    if not available[2]:
+        errors[b_grid > 0] = np.inf
+    best = np.unravel_index(np.argmin(errors), errors.shape)
+    return [int(s_grid[best]), int(candidates[best]), int(b_grid[best])]
+
+
+class ClassBalancedBatchSampler:
+    """
+    Batches with a fixed number of samples of each class (SEP, elevated, background).
+    The pools of the classes are contiguous ranges of a label-sorted index. Each pool is consumed as a stream
+    of random permutations, so every sample of a class is seen before any is repeated, and the samples of a
+    batch are shuffled. ModelBuilder.train_pds_injection trains on its datasets.
+    """
+
+    def __init__(self,
+                 y: ndarray,
+                 batch_size: int,
+                 quotas: Optional[Sequence[Optional[int]]] = None,
+                 pair_mix: Optional[Union[Dict[str, float], Sequence[float]]] = None,
+                 sep_threshold: Optional[float] = None,
+                 elevated_threshold: Optional[float] = None,
+                 seed: Optional[int] = None) -> None:
+        """
+        :param y: The labels.
+        :param batch_size: The batch size (<= 0 for the number of samples).
+        :param quotas: The number of SEP, elevated and background samples per batch. A None quota takes a share
+                       of the rest of the batch proportional to the size of its class. Default is (2, None, None):
+                       two SEP samples per batch, the rest drawn from the elevated and background samples.
+        :param pair_mix: Target fraction of each pair type (dict keyed by PAIR_TYPES, or a sequence in that
+                         order) to fit the quotas to, instead of quotas.
+        :param sep_threshold: The threshold of the SEP samples. Default is ln(10).
+        :param elevated_threshold: The threshold of the elevated samples. Default is ln(10 / e^2).
+        :param seed: Seed of the sampling.
+        """
+        if sep_threshold is None:
+            sep_threshold = np.log(10)
+        if elevated_threshold is None:
+            elevated_threshold = np.log(10.0 / np.exp(2))
+
+        y = np.asarray(y).reshape(-1)
+        self.num_samples = len(y)
+        self.batch_size = batch_size if batch_size > 0 else len(y)
+        self.rng = np.random.default_rng(seed)
+
+        # label-sorted index, descending, so the pools of SEP, elevated and background are consecutive ranges
+        self.order = np.argsort(-y, kind='stable')
+        sorted_y = y[self.order]
+        bounds = [0,
+                  int(np.sum(sorted_y > sep_threshold)),
+                  int(np.sum(sorted_y > elevated_threshold)),
+                  len(y)]
+        self.pools = [self.order[bounds[c]:bounds[c + 1]] for c in range(len(CLASSES))]
+        sizes = [len(pool) for pool in self.pools]
+
+        if pair_mix is not None:
+            self.quotas = quotas_for_pair_mix(pair_mix, self.batch_size, [size > 0 for size in sizes])
+        else:
+            self.quotas = self.fill_quotas(quotas if quotas is not None else (2, None, None), sizes)
+        for name, quota, size in zip(CLASSES, self.quotas, sizes):
+            if quota > 0 and size == 0:
+                raise ValueError(f"No {name} samples for a quota of {quota} per batch")
+
+        # position of each pool in its current permutation
+        self.permutations = [self.rng.permutation(pool) for pool in self.pools]
+        self.cursors = [0] * len(CLASSES)
+
+        print(f"Batch quotas (SEP, elevated, background): {self.quotas} of {sizes} samples, pair type mix: "
+              + ', '.join(f"{name} {f:.3f}" for name, f in zip(PAIR_TYPES, pair_type_fractions(self.quotas))))
+
+    def fill_quotas(self, quotas: Sequence[Optional[int]], sizes: List[int]) -> List[int]:
+        """
+        Resolve the None quotas: the rest of the batch is shared between their classes in proportion to the
+        class sizes (largest remainder rounding).
+        """
+        fixed = sum(q for q in quotas if q is not None)
+        if fixed > self.batch_size:
+            raise ValueError(f"The quotas {list(quotas)} exceed the batch size {self.batch_size}")
+        free = [c for c, q in enumerate(quotas) if q is None]
+        resolved = [q if q is not None else 0 for q in quotas]
+        total = sum(sizes[c] for c in free)
+        if not free or total == 0:
+            return resolved
+        shares = np.array([sizes[c] for c in free], dtype=np.float64) * (self.batch_size - fixed) / total
+        counts = np.floor(shares).astype(int)
+        counts[np.argsort(counts - shares)[:self.batch_size - fixed - counts.sum()]] += 1
+        for c, count in zip(free, counts):
+            resolved[c] = int(count)
+        return resolved
+
+    def steps_per_epoch(self) -> int:
+        """
+        Number of batches of an epoch (one pass over the number of samples).
+        """
+        return max(1, self.num_samples // self.batch_size)
+
+    def draw(self, c: int, count: int) -> ndarray:
+        """
+        The next count samples of the stream of permutations of a class pool.
+        """
+        pool, start = self.pools[c], self.cursors[c]
+        needed = start + count
+        parts = [self.permutations[c]]
+        while len(parts) * len(pool) < needed:
+            parts.append(self.rng.permutation(pool))
+        stream = np.concatenate(parts) if len(parts) > 1 else parts[0]
+        # keep the permutation the stream stopped in
+        last = (needed - 1) // len(pool)
+        self.permutations[c] = parts[last]
+        self.cursors[c] = needed - last * len(pool)
+        return stream[start:needed]
+
+    def epoch_indices(self, steps: Optional[int] = None) -> ndarray:
+        """
+        Sample indices of all the batches of an epoch.
+
+        :param steps: The number of batches. Default is steps_per_epoch().
+        :return: The index matrix, shape of [steps, batch_size].
+        """
+        steps = steps if steps is not None else self.steps_per_epoch()
+        blocks = [self.draw(c, steps * quota).reshape(steps, quota)
+                  for c, quota in enumerate(self.quotas) if quota > 0]
+        batches = np.concatenate(blocks, axis=1)
+        # shuffle the samples within each batch
+        return np.take_along_axis(batches, np.argsort(self.rng.random(batches.shape), axis=1), axis=1)
+
+    def epochs(self, steps: Optional[int] = None) -> Iterator[ndarray]:
+        """
+        Index matrices of successive epochs, indefinitely.
+        """
+        while True:
+            yield self.epoch_indices(steps)
+
+    def dataset(self, X: ndarray, y: ndarray, steps: Optional[int] = None) -> tf.data.Dataset:
+        """
+        The batches as a tf.data pipeline repeated indefinitely (for model.fit with steps_per_epoch): the index
+        matrices of whole epochs are drawn in numpy, the batches are gathered in the graph and prefetched.
+
+        :param X: The features the labels were sampled from.
+        :param y: The labels.
+        :param steps: The number of batches per epoch. Default is steps_per_epoch().
+        :return: Dataset of (x, y) batches.
+        """
+        features = tf.convert_to_tensor(as_policy(X))
+        labels = tf.convert_to_tensor(as_policy(y))
+        indices = tf.data.Dataset.from_generator(
+            lambda: self.epochs(steps),
+            output_signature=tf.TensorSpec([None, self.batch_size], tf.int64))
+        data = indices.unbatch().map(lambda batch: (tf.gather(features, batch), tf.gather(labels, batch)),
+                                     num_parallel_calls=tf.data.AUTOTUNE)
+        return data.prefetch(tf.data.AUTOTUNE)
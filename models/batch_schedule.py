@@ -0,0 +1,235 @@
+##############################################################################################################
+# Description: batch size schedules for progressive batching (random, curriculum growth, step function)
+# with optional linear learning rate scaling, and a cache of compiled train steps per batch size bucket.
+##############################################################################################################
+import bisect
+import random
+# types for type hinting
+from typing import List, Optional, Dict, Tuple, Callable
+
+import numpy as np
+# imports
+import tensorflow as tf
+
+
+class BatchSizeSchedule:
+    """
+    Base class for batch size schedules. A schedule maps an epoch index to a batch size,
+    where a batch size <= 0 means the whole dataset as one batch.
+    """
+
+    def __init__(self, base_batch_size: Optional[int] = None, scale_lr: bool = False) -> None:
+        """
+        :param base_batch_size: The batch size the base learning rate was tuned for (used for linear LR scaling).
+        :param scale_lr: Whether to scale the learning rate linearly with the batch size.
+        """
+        self.base_batch_size = base_batch_size
+        self.scale_lr = scale_lr
+
+    def __call__(self, epoch: int) -> int:
+        """
+        Batch size to use for the given epoch.
+
+        :param epoch: The index of the epoch.
+        :return: The batch size, <= 0 for the whole dataset.
+        """
+        raise NotImplementedError
+
+    def bucket(self, batch_size: int, n_samples: int) -> int:
+        """
+        Effective batch size for a dataset of n_samples, used as the key of compiled train steps.
+
+        :param batch_size: Batch size returned by the schedule.
+        :param n_samples: Number of samples in the dataset.
+        :return: The effective batch size.
+        """
+        return n_samples if batch_size <= 0 else min(batch_size, n_samples)
+
+    def learning_rate(self, base_lr: float, batch_size: int, n_samples: int) -> float:
+        """
+        Learning rate for the given batch size, linearly scaled from the base batch size if scale_lr is set.
+
+        :param base_lr: The base learning rate.
+        :param batch_size: Batch size returned by the schedule.
+        :param n_samples: Number of samples in the dataset.
+        :return: The learning rate to use.
+        """
+        if not self.scale_lr or not self.base_batch_size:
+            return base_lr
+        return base_lr * self.bucket(batch_size, n_samples) / self.base_batch_size
+
+
+class RandomBatchSizeSchedule(BatchSizeSchedule):
+    """
+    Picks a batch size at random from a list every epoch (the original progressive batching).
+    """
+
+    def __init__(self, batch_sizes: List[int], base_batch_size: Optional[int] = None, scale_lr: bool = False):
+        """
+        :param batch_sizes: The batch sizes to pick from.
+        :param base_batch_size: The batch size the base learning rate was tuned for.
+        :param scale_lr: Whether to scale the learning rate linearly with the batch size.
+        """
+        super().__init__(base_batch_size, scale_lr)
+        self.batch_sizes = list(batch_sizes)
+
+    def __call__(self, epoch: int) -> int:
+        return random.choice(self.batch_sizes)
+
+
+class CurriculumBatchSizeSchedule(BatchSizeSchedule):
+    """
+    Grows the batch size geometrically from start_size to end_size, multiplying it by growth every `every` epochs.
+    """
+
+    def __init__(self,
+                 start_size: int,
+                 end_size: int,
+                 growth: float = 2.0,
+                 every: int = 10,
+                 base_batch_size: Optional[int] = None,
+                 scale_lr: bool = False):
+        """
+        :param start_size: The batch size of the first epoch.
+        :param end_size: The largest batch size, <= 0 for the whole dataset.
+        :param growth: Multiplicative growth factor.
+        :param every: Number of epochs between growth steps.
+        :param base_batch_size: The batch size the base learning rate was tuned for.
+        :param scale_lr: Whether to scale the learning rate linearly with the batch size.
+        """
+        super().__init__(base_batch_size, scale_lr)
+        self.start_size = start_size
+        self.end_size = end_size
+        self.growth = growth
+        self.every = max(int(every), 1)
+
+    def __call__(self, epoch: int) -> int:
+        size = int(self.start_size * self.growth ** (epoch // self.every))
+        if self.end_size > 0:
+            return min(size, self.end_size)
+        return size
+
+
+class StepBatchSizeSchedule(BatchSizeSchedule):
+    """
+    Step function schedule: batch_sizes[i] is used from boundaries[i - 1] (inclusive) to boundaries[i] (exclusive).
+    """
+
+    def __init__(self,
+                 boundaries: List[int],
+                 batch_sizes: List[int],
+                 base_batch_size: Optional[int] = None,
+                 scale_lr: bool = False):
+        """
+        :param boundaries: Increasing epoch indices at which the batch size changes.
+        :param batch_sizes: Batch sizes, one more than the number of boundaries.
+        :param base_batch_size: The batch size the base learning rate was tuned for.
+        :param scale_lr: Whether to scale the learning rate linearly with the batch size.
+        """
+        super().__init__(base_batch_size, scale_lr)
+        if len(batch_sizes) != len(boundaries) + 1:
+            raise ValueError("batch_sizes should have exactly one more element than boundaries.")
+        self.boundaries = list(boundaries)
+        self.batch_sizes = list(batch_sizes)
+
+    def __call__(self, epoch: int) -> int:
+        return self.batch_sizes[bisect.bisect_right(self.boundaries, epoch)]
+
+
+class CompiledStepCache:
+    """
+    Cache of compiled (tf.function) train/eval steps, one per batch size bucket, so that switching
+    the batch size between epochs does not retrace after warm-up. Also accumulates the throughput per bucket.
+    """
+
+    def __init__(self, model: tf.keras.Model, optimizer: tf.keras.optimizers.Optimizer, loss_fn: Callable) -> None:
+        """
+        :param model: The model to train.
+        :param optimizer: The optimizer applying the gradients.
+        :param loss_fn: The loss function, called as loss_fn(y, predictions, sample_weights=...).
+        """
+        self.model = model
+        self.optimizer = optimizer
+        self.loss_fn = loss_fn
+        self.steps: Dict[Tuple[int, bool], Callable] = {}
+        self.stats: Dict[int, Dict[str, float]] = {}
+
+    def get(self, bucket: int, training: bool = True) -> Callable:
+        """
+        Get the compiled step for a batch size bucket, building it on first use.
+
+        :param bucket: The effective batch size.
+        :param training: Whether the step applies gradients.
+        :return: A function step(batch_X, batch_y, batch_weights) -> loss.
+        """
+        key = (bucket, training)
+        if key not in self.steps:
+            self.steps[key] = self.build_step(training)
+        return self.steps[key]
+
+    def build_step(self, training: bool) -> Callable:
+        """
+        Build a compiled step. Shapes are relaxed so the trailing partial batch of an epoch reuses the trace.
+
+        :param training: Whether the step applies gradients.
+        :return: The compiled step function.
+        """
+        model, optimizer, loss_fn = self.model, self.optimizer, self.loss_fn
+
+        @tf.function(experimental_relax_shapes=True)
+        def step(batch_X, batch_y, batch_weights=None):
+            with tf.GradientTape() as tape:
+                predictions = model(batch_X, training=training)
+                loss = loss_fn(batch_y, predictions, sample_weights=batch_weights)
+            if training:
+                gradients = tape.gradient(loss, model.trainable_variables)
+                optimizer.apply_gradients(zip(gradients, model.trainable_variables))
+            return loss
+
+        return step
+
+    def record(self, bucket: int, seconds: float, n_samples: int) -> None:
+        """
+        Record the time spent on n_samples with the given bucket.
+
+        :param bucket: The effective batch size.
+        :param seconds: Wall time spent.
+        :param n_samples: Number of samples processed.
+        """
+        stats = self.stats.setdefault(bucket, {'seconds': 0.0, 'samples': 0, 'epochs': 0})
+        stats['seconds'] += seconds
+        stats['samples'] += n_samples
+        stats['epochs'] += 1
+
+    def throughput(self) -> Dict[int, float]:
+        """
+        Samples per second for each bucket.
+
+        :return: A dictionary mapping the effective batch size to samples per second.
+        """
+        return {bucket: stats['samples'] / stats['seconds'] if stats['seconds'] > 0 else 0.0
+                for bucket, stats in self.stats.items()}
+
+    def print_throughput(self) -> None:
+        """
+        Print the throughput per batch size bucket.
+        """
+        print("Batch Size".ljust(15) + "Epochs".ljust(10) + "Samples/s".ljust(15) + "Seconds")
+        for bucket, samples_per_sec in sorted(self.throughput().items()):
+            stats = self.stats[bucket]
+            print(f"{str(bucket).ljust(15)}{str(stats['epochs']).ljust(10)}"
+                  f"{f'{samples_per_sec:.1f}'.ljust(15)}{stats['seconds']:.2f}")
+
+
+def as_schedule(batch_sizes) -> BatchSizeSchedule:
+    """
+    Convert a list of batch sizes (the previous train_pds_dl_bs API) or a single batch size to a schedule.
+
+    :param batch_sizes: A BatchSizeSchedule, a list of batch sizes or a single batch size.
+    :return: A BatchSizeSchedule.
+    """
+    if isinstance(batch_sizes, BatchSizeSchedule):
+        return batch_sizes
+    if isinstance(batch_sizes, (int, np.integer)):
+        return RandomBatchSizeSchedule([int(batch_sizes)])
+    return RandomBatchSizeSchedule(batch_sizes)
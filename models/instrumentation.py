@@ -0,0 +1,223 @@
+##############################################################################################################
+# Description: opt-in training throughput instrumentation (step latency, samples/s, pairs/s,
+# host syncs, tf.function retracing) for the custom training loops and the model.fit paths.
+##############################################################################################################
+import time
+from contextlib import contextmanager, nullcontext
+# types for type hinting
+from typing import Optional, Dict, List, Callable
+
+import mlflow
+import numpy as np
+# imports
+from tensorflow.keras import callbacks
+
+
+class TrainingInstrumentation:
+    """
+    Records per-step wall time, samples and pairs processed, host syncs, time spent in named phases
+    (e.g. joint weight lookup) and tf.function retracing events, and emits an epoch summary
+    (printed, and logged to the active MLflow run if any).
+    """
+
+    def __init__(self, name: str = 'train', log_to_mlflow: bool = True, verbose: bool = True) -> None:
+        """
+        :param name: Prefix of the summary keys and MLflow metrics.
+        :param log_to_mlflow: Whether to log the epoch summaries to the active MLflow run.
+        :param verbose: Whether to print the epoch summaries.
+        """
+        self.name = name
+        self.log_to_mlflow = log_to_mlflow
+        self.verbose = verbose
+        self.watched: List[Callable] = []
+        self.summaries: List[Dict[str, float]] = []
+        self.epoch_index = 0
+        self.last_tracing_count = 0
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Reset the counters of the current epoch.
+        """
+        self.step_times = []
+        self.samples = 0
+        self.pairs = 0
+        self.host_syncs = 0
+        self.phase_times: Dict[str, float] = {}
+        self.epoch_start = time.perf_counter()
+
+    def watch(self, fn: Callable) -> None:
+        """
+        Watch a tf.function for retracing events.
+
+        :param fn: The tf.function (anything exposing experimental_get_tracing_count).
+        """
+        if hasattr(fn, 'experimental_get_tracing_count') and not any(fn is w for w in self.watched):
+            self.watched.append(fn)
+
+    def tracing_count(self) -> int:
+        """
+        Total number of traces of the watched functions.
+        """
+        return sum(fn.experimental_get_tracing_count() for fn in self.watched)
+
+    @contextmanager
+    def epoch(self):
+        """
+        Instrument the training pass of one epoch: reset the counters on entry and emit the summary on exit,
+        so that validation passes and checkpointing outside the block are not counted.
+        """
+        self.reset()
+        yield
+        self.end_epoch()
+
+    @contextmanager
+    def step(self, n_samples: int):
+        """
+        Time one training step over a batch of n_samples. The step should end with a host sync
+        (e.g. loss.numpy()) for the wall time to include the device work.
+
+        :param n_samples: Number of samples in the batch.
+        """
+        start = time.perf_counter()
+        yield
+        self.step_times.append(time.perf_counter() - start)
+        self.samples += n_samples
+        self.pairs += n_samples * (n_samples - 1) // 2
+
+    @contextmanager
+    def phase(self, name: str):
+        """
+        Accumulate the wall time of a named phase (e.g. 'weight_lookup') within the epoch.
+
+        :param name: The name of the phase.
+        """
+        start = time.perf_counter()
+        yield
+        self.phase_times[name] = self.phase_times.get(name, 0.0) + time.perf_counter() - start
+
+    def host_sync(self, count: int = 1) -> None:
+        """
+        Count device to host synchronizations (e.g. .numpy() on a tensor).
+
+        :param count: Number of synchronizations.
+        """
+        self.host_syncs += count
+
+    def end_epoch(self) -> Dict[str, float]:
+        """
+        Summarize the current epoch, print and log it, and reset the counters.
+
+        :return: The epoch summary.
+        """
+        epoch_seconds = time.perf_counter() - self.epoch_start
+        tracing_count = self.tracing_count()
+        step_ms = np.array(self.step_times) * 1e3 if self.step_times else np.zeros(1)
+
+        prefix = f"{self.name}_"
+        summary = {
+            prefix + 'epoch_s': epoch_seconds,
+            prefix + 'steps': len(self.step_times),
+            prefix + 'step_ms_mean': float(np.mean(step_ms)),
+            prefix + 'step_ms_p50': float(np.median(step_ms)),
+            prefix + 'step_ms_max': float(np.max(step_ms)),
+            prefix + 'samples_per_s': self.samples / epoch_seconds if epoch_seconds > 0 else 0.0,
+            prefix + 'pairs_per_s': self.pairs / epoch_seconds if epoch_seconds > 0 else 0.0,
+            prefix + 'host_syncs': self.host_syncs,
+            prefix + 'retraces': tracing_count - self.last_tracing_count,
+        }
+        for phase_name, seconds in self.phase_times.items():
+            summary[prefix + phase_name + '_s'] = seconds
+
+        self.last_tracing_count = tracing_count
+        self.summaries.append(summary)
+
+        if self.verbose:
+            print(f"[{self.name}] epoch {self.epoch_index + 1}: "
+                  + ", ".join(f"{key[len(prefix):]}={value:.4g}" for key, value in summary.items()))
+        if self.log_to_mlflow and mlflow.active_run() is not None:
+            mlflow.log_metrics(summary, step=self.epoch_index)
+
+        self.epoch_index += 1
+        self.reset()
+
+        return summary
+
+    def callback(self, batch_size: int, n_samples: int) -> 'InstrumentationCallback':
+        """
+        Keras callback instrumenting a model.fit call.
+
+        :param batch_size: The effective batch size of the fit call.
+        :param n_samples: The number of training samples of the fit call.
+        :return: The callback.
+        """
+        return InstrumentationCallback(self, batch_size, n_samples)
+
+
+class InstrumentationCallback(callbacks.Callback):
+    """
+    Keras callback feeding a TrainingInstrumentation from model.fit. The train step of fit returns its logs
+    to the host every batch, which is counted as one host sync per step.
+    """
+
+    def __init__(self, instrumentation: TrainingInstrumentation, batch_size: int, n_samples: int):
+        super().__init__()
+        self.instrumentation = instrumentation
+        self.batch_size = batch_size
+        self.n_samples = n_samples
+        self.batch_start = None
+
+    def on_train_begin(self, logs=None):
+        self.instrumentation.watch(self.model.train_function)
+        self.instrumentation.last_tracing_count = self.instrumentation.tracing_count()
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.instrumentation.reset()
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.batch_start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        n = int(min(self.batch_size, max(self.n_samples - batch * self.batch_size, 0)))
+        self.instrumentation.step_times.append(time.perf_counter() - self.batch_start)
+        self.instrumentation.samples += n
+        self.instrumentation.pairs += n * (n - 1) // 2
+        self.instrumentation.host_sync()
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.instrumentation.end_epoch()
+
+
+def instrumentation_callbacks(instrumentation: Optional[TrainingInstrumentation],
+                              batch_size: int,
+                              n_samples: int) -> List[callbacks.Callback]:
+    """
+    Callbacks to append to a model.fit call: the instrumentation callback, or none if instrumentation is None.
+
+    :param instrumentation: The optional instrumentation.
+    :param batch_size: The effective batch size of the fit call.
+    :param n_samples: The number of training samples of the fit call.
+    :return: A list with zero or one callback.
+    """
+    return [instrumentation.callback(batch_size, n_samples)] if instrumentation is not None else []
+
+
+def maybe_epoch(instrumentation: Optional[TrainingInstrumentation]):
+    """
+    instrumentation.epoch(), or a no-op context if instrumentation is None.
+    """
+    return instrumentation.epoch() if instrumentation is not None else nullcontext()
+
+
+def maybe_step(instrumentation: Optional[TrainingInstrumentation], n_samples: int):
+    """
+    instrumentation.step(n_samples), or a no-op context if instrumentation is None.
+    """
+    return instrumentation.step(n_samples) if instrumentation is not None else nullcontext()
+
+
+def maybe_phase(instrumentation: Optional[TrainingInstrumentation], name: str):
+    """
+    instrumentation.phase(name), or a no-op context if instrumentation is None.
+    """
+    return instrumentation.phase(name) if instrumentation is not None else nullcontext()
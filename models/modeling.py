@@ -3,12 +3,11 @@
 # using validation loss to determine epoch number for training).
 # this module should be interchangeable with other modules (
 ##############################################################################################################
-import random
-from itertools import cycle
+import time
+from concurrent.futures import ThreadPoolExecutor, Future
 # types for type hinting
-from typing import Tuple, List, Optional
+from typing import Tuple, List, Optional, Union, Callable
 
-import matplotlib.pyplot as plt
 import numpy as np
 # imports
 import tensorflow as tf
@@ -16,6 +15,22 @@ from numpy import ndarray
 from tensorflow import Tensor
 from tensorflow.keras import layers, callbacks, Model
 
+from dataload.dtype_policy import as_policy, policy_dtype, set_dtype_policy
+from dataload.streaming import StreamingCatalog, fit_inputs, validation_inputs
+from models.batch_sampler import ClassBalancedBatchSampler
+from models.batch_schedule import BatchSizeSchedule, CompiledStepCache, as_schedule
+from models.pair_metrics import PAIR_TYPES, pair_type_metrics
+from models.instrumentation import TrainingInstrumentation, instrumentation_callbacks, maybe_epoch, maybe_step, \
+    maybe_phase
+from models.plot_service import submit_plot
+from models.prediction_cache import cached_predict
+from models.profiling import ProfilerWindow, profiler_callbacks, maybe_profile_epoch, maybe_profile_step, \
+    maybe_annotate
+from models.training_state import TrainingState, TrainingStateCallback
+
+# the Keras float type of the models follows the dtype policy of the data (e.g. DTYPE_POLICY=float64)
+set_dtype_policy(policy_dtype())
+
 
 def ydist(val1: float, val2: float) -> float:
     """
@@ -70,13 +85,6 @@ class ModelBuilder:
         :param debug: Boolean to enable debug output.
         """
         self.debug = debug
-        self.sep_sep_count = tf.Variable(0, dtype=tf.int32)
-        self.sep_elevated_count = tf.Variable(0, dtype=tf.int32)
-        self.sep_background_count = tf.Variable(0, dtype=tf.int32)
-        self.elevated_elevated_count = tf.Variable(0, dtype=tf.int32)
-        self.elevated_background_count = tf.Variable(0, dtype=tf.int32)
-        self.background_background_count = tf.Variable(0, dtype=tf.int32)
-        self.number_of_batches = 0
 
     def create_model(self,
                      input_dim: int,
@@ -236,19 +244,24 @@ class ModelBuilder:
 
     def train_pds(self,
                   model: Model,
-                  X_subtrain: ndarray,
-                  y_subtrain: ndarray,
-                  X_val: ndarray,
-                  y_val: ndarray,
-                  X_train: ndarray,
-                  y_train: ndarray,
+                  X_subtrain: Union[ndarray, StreamingCatalog],
+                  y_subtrain: Optional[ndarray],
+                  X_val: Union[ndarray, StreamingCatalog],
+                  y_val: Optional[ndarray],
+                  X_train: Union[ndarray, StreamingCatalog],
+                  y_train: Optional[ndarray],
                   learning_rate: float = 1e-3,
                   epochs: int = 100,
                   batch_size: int = 32,
                   patience: int = 9,
-                  save_tag=None) -> callbacks.History:
+                  save_tag=None,
+                  resume: Union[bool, str] = False,
+                  state_freq: int = 1,
+                  instrumentation: Optional[TrainingInstrumentation] = None,
+                  profiler: Optional[ProfilerWindow] = None) -> callbacks.History:
         """
         Trains the model and returns the training history.
+        The X sets can also be streaming catalogs (dataload.streaming), with their y set to None.
 
         :param X_train: training and validation sets together
         :param y_train: labels of training and validation sets together
@@ -262,6 +275,12 @@ class ModelBuilder:
         :param epochs: The maximum number of epochs for training.
         :param batch_size: The batch size for training.
         :param patience: The number of epochs with no improvement to wait before early stopping.
+        :param resume: True to resume from the training state of this save_tag, or the path of the
+                       training state directory of a preempted run.
+        :param state_freq: Save the training state every state_freq epochs.
+        :param instrumentation: Optional TrainingInstrumentation reporting step latency, samples/s, pairs/s
+                                and retraces for every training epoch.
+        :param profiler: Optional ProfilerWindow tracing a window of epochs or steps with tf.profiler.
         :return: The training history as a History object.
         """
 
@@ -287,45 +306,66 @@ class ModelBuilder:
         callback_list = [early_stopping_cb, checkpoint_cb]
 
         # Compile the model
-        model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=learning_rate), loss=self.repr_loss)
-
-        # First train the model with a validation set to determine the best epoch
-        history = model.fit(X_subtrain, y_subtrain,
-                            epochs=epochs,
-                            batch_size=batch_size if batch_size > 0 else len(y_subtrain),
-                            validation_data=(X_val, y_val),
-                            validation_batch_size=batch_size if batch_size > 0 else len(y_val),
-                            callbacks=callback_list)
-
-        # Get the best epoch from early stopping
-        best_epoch = np.argmin(history.history['val_loss']) + 1
-
-        # Plot training loss and validation loss
-        plt.plot(history.history['loss'], label='Training Loss')
-        plt.plot(history.history['val_loss'], label='Validation Loss')
-        plt.xlabel('Epoch')
-        plt.ylabel('Loss')
-        plt.title('Training and Validation Loss Over Epochs')
-        plt.legend()
-        file_path = f"training_plot_{str(save_tag)}.png"
-        plt.savefig(file_path)
-        plt.close()
+        model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=learning_rate), loss=self.repr_loss,
+                      metrics=pair_type_metrics())
+
+        # Restore the training state of a preempted run (after compile so the optimizer exists)
+        training_state = TrainingState(model, save_tag, save_freq=state_freq)
+        training_state.optimizer = model.optimizer
+        restored = training_state.restore(resume)
+
+        if restored is None or restored['phase'] == 'search':
+            state_cb = TrainingStateCallback(training_state, 'search', early_stopping_cb, restored)
+            # First train the model with a validation set to determine the best epoch
+            subtrain_inputs, n_subtrain = fit_inputs(X_subtrain, y_subtrain, batch_size)
+            history = model.fit(**subtrain_inputs,
+                                epochs=epochs,
+                                initial_epoch=restored['epoch'] if restored is not None else 0,
+                                **validation_inputs(X_val, y_val, batch_size),
+                                callbacks=callback_list + [state_cb] + instrumentation_callbacks(
+                                    instrumentation, batch_size if batch_size > 0 else n_subtrain,
+                                    n_subtrain) + profiler_callbacks(profiler))
+            history.history = state_cb.history
+
+            # Get the best epoch from early stopping
+            best_epoch = int(np.argmin(history.history['val_loss']) + 1)
+
+            # Plot training loss and validation loss
+            file_path = f"training_plot_{str(save_tag)}.png"
+            submit_plot('lines', file_path,
+                        series={'Training Loss': history.history['loss'],
+                                'Validation Loss': history.history['val_loss']},
+                        title='Training and Validation Loss Over Epochs', xlabel='Epoch', ylabel='Loss')
+
+            training_state.save(0, 'retrain', {'search_history': history.history, 'best_epoch': best_epoch,
+                                               'history': {}})
+        else:
+            history = callbacks.History()
+            history.history = restored['search_history']
+            best_epoch = restored['best_epoch']
 
         # Retrain the model on the combined dataset (training + validation) to the best epoch found
         # X_combined = np.concatenate((X_subtrain, X_val), axis=0)
         # y_combined = np.concatenate((y_subtrain, y_val), axis=0)
 
         # model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=learning_rate), loss=self.repr_loss)
-        model.fit(X_train, y_train,
+        retrain_state_cb = TrainingStateCallback(
+            training_state, 'retrain', restored=restored,
+            extra_state={'search_history': history.history, 'best_epoch': best_epoch})
+        train_inputs, n_train = fit_inputs(X_train, y_train, batch_size)
+        model.fit(**train_inputs,
                   epochs=best_epoch,
-                  batch_size=batch_size if batch_size > 0 else len(y_train),
-                  callbacks=[checkpoint_cb])
+                  initial_epoch=restored['epoch'] if retrain_state_cb.restored is not None else 0,
+                  callbacks=[checkpoint_cb, retrain_state_cb] + instrumentation_callbacks(
+                      instrumentation, batch_size if batch_size > 0 else n_train, n_train)
+                  + profiler_callbacks(profiler))
 
         # Evaluate the model on the entire training set
         # entire_training_loss = model.evaluate(X_train, y_train)
 
         # save the model weights
         model.save_weights(f"model_weights_{str(save_tag)}.h5")
+        training_state.clear()
 
         return history  # , entire_training_loss
 
@@ -341,7 +381,10 @@ class ModelBuilder:
                         epochs: int = 100,
                         batch_size: int = 32,
                         patience: int = 9,
-                        save_tag=None) -> callbacks.History:
+                        save_tag=None,
+                        monitor_freq: int = 1,
+                        epoch_freq: int = 1,
+                        background: bool = True) -> callbacks.History:
         """
         Trains the model and returns the training history.
 
@@ -357,6 +400,9 @@ class ModelBuilder:
         :param epochs: The maximum number of epochs for training.
         :param batch_size: The batch size for training.
         :param patience: The number of epochs with no improvement to wait before early stopping.
+        :param monitor_freq: Evaluate the SEP-SEP loss every monitor_freq batches.
+        :param epoch_freq: Evaluate the pair type losses every epoch_freq epochs.
+        :param background: Whether to run the investigation evaluations in a background thread.
         :return: The training history as a History object.
         """
 
@@ -367,7 +413,9 @@ class ModelBuilder:
         # print("Run the command line:\n tensorboard --logdir logs/fit")
 
         # Initialize the custom callback
-        investigate_cb = InvestigateCallback(model, X_train, y_train, batch_size, self, save_tag)
+        investigate_cb = InvestigateCallback(model, X_train, y_train, batch_size, self, save_tag,
+                                             monitor_freq=monitor_freq, epoch_freq=epoch_freq,
+                                             background=background)
 
         # Setup early stopping
         early_stopping_cb = callbacks.EarlyStopping(monitor='val_loss', patience=patience, restore_best_weights=True)
@@ -385,7 +433,8 @@ class ModelBuilder:
         callback_list = [early_stopping_cb, checkpoint_cb]
 
         # Compile the model
-        model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=learning_rate), loss=self.repr_loss)
+        model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=learning_rate), loss=self.repr_loss,
+                      metrics=pair_type_metrics())
 
         # First train the model with a validation set to determine the best epoch
         history = model.fit(X_subtrain, y_subtrain,
@@ -399,15 +448,11 @@ class ModelBuilder:
         best_epoch = np.argmin(history.history['val_loss']) + 1
 
         # Plot training loss and validation loss
-        plt.plot(history.history['loss'], label='Training Loss')
-        plt.plot(history.history['val_loss'], label='Validation Loss')
-        plt.xlabel('Epoch')
-        plt.ylabel('Loss')
-        plt.title('Training and Validation Loss Over Epochs')
-        plt.legend()
         file_path = f"training_plot_{str(save_tag)}.png"
-        plt.savefig(file_path)
-        plt.close()
+        submit_plot('lines', file_path,
+                    series={'Training Loss': history.history['loss'],
+                            'Validation Loss': history.history['val_loss']},
+                    title='Training and Validation Loss Over Epochs', xlabel='Epoch', ylabel='Loss')
 
         # Retrain the model on the combined dataset (training + validation) to the best epoch found
         # X_combined = np.concatenate((X_subtrain, X_val), axis=0)
@@ -461,7 +506,10 @@ class ModelBuilder:
                             batch_size: int,
                             joint_weights: Optional[np.ndarray] = None,
                             joint_weight_indices: Optional[List[Tuple[int, int]]] = None,
-                            training: bool = True) -> float:
+                            training: bool = True,
+                            step_fn: Optional[Callable] = None,
+                            instrumentation: Optional[TrainingInstrumentation] = None,
+                            profiler: Optional[ProfilerWindow] = None) -> float:
         """
         Train or evaluate the model for one epoch.
         processing the batches with indices is what making it slow
@@ -474,14 +522,24 @@ class ModelBuilder:
         :param joint_weights: Optional array containing all joint weights for the dataset.
         :param joint_weight_indices: Optional list of tuples, each containing a pair of indices for which a joint weight exists.
         :param training: Whether to apply training (True) or run evaluation (False).
+        :param step_fn: Optional compiled step (see CompiledStepCache) used instead of the eager step.
+        :param instrumentation: Optional instrumentation recording the step times and weight lookup time.
+        :param profiler: Optional profiler window annotating the data slicing, weight lookup and train steps.
         :return: The average loss for the epoch.
         """
+        # the data in the policy dtype, the dtype of the model (no copy when it was loaded with the policy)
+        X, y, joint_weights = as_policy(X), as_policy(y), as_policy(joint_weights)
+
         epoch_loss = 0.0
         num_batches = 0
 
+        if instrumentation is not None and step_fn is not None:
+            instrumentation.watch(step_fn)
+
         for batch_idx in range(0, len(X), batch_size):
-            batch_X = X[batch_idx:batch_idx + batch_size]
-            batch_y = y[batch_idx:batch_idx + batch_size]
+            with maybe_annotate(profiler, 'data_slicing'):
+                batch_X = X[batch_idx:batch_idx + batch_size]
+                batch_y = y[batch_idx:batch_idx + batch_size]
 
             if len(batch_y) <= 1:
                 # can't form a pair so skip
@@ -490,22 +548,30 @@ class ModelBuilder:
             # Get the corresponding joint weights for this batch
             batch_weights = None
             if joint_weights is not None and joint_weight_indices is not None:
-                batch_weights = self.process_batch_weights(
-                    np.arange(batch_idx, batch_idx + batch_size), joint_weights, joint_weight_indices)
+                with maybe_phase(instrumentation, 'weight_lookup'), maybe_annotate(profiler, 'weight_lookup'):
+                    batch_weights = self.process_batch_weights(
+                        np.arange(batch_idx, batch_idx + batch_size), joint_weights, joint_weight_indices)
 
             # print(f"batch_weights: {batch_weights}")
             # print(f"batch_y: {batch_y}")
             # print(f"batch_X: {batch_X}")
-            with tf.GradientTape() as tape:
-                predictions = model(batch_X, training=training)
-                loss = loss_fn(batch_y, predictions, sample_weights=batch_weights)
-
-            if training:
-                gradients = tape.gradient(loss, model.trainable_variables)
-                # print(f"Gradients: {gradients}")
-                optimizer.apply_gradients(zip(gradients, model.trainable_variables))
-
-            epoch_loss += loss.numpy()
+            with maybe_step(instrumentation, len(batch_y)), maybe_profile_step(profiler):
+                if step_fn is not None:
+                    loss = step_fn(batch_X, batch_y, batch_weights)
+                else:
+                    with tf.GradientTape() as tape:
+                        predictions = model(batch_X, training=training)
+                        with maybe_annotate(profiler, 'repr_loss'):
+                            loss = loss_fn(batch_y, predictions, sample_weights=batch_weights)
+
+                    if training:
+                        gradients = tape.gradient(loss, model.trainable_variables)
+                        # print(f"Gradients: {gradients}")
+                        optimizer.apply_gradients(zip(gradients, model.trainable_variables))
+
+                epoch_loss += loss.numpy()
+            if instrumentation is not None:
+                instrumentation.host_sync()
             num_batches += 1
 
             print(f"batch: {num_batches}/{len(X) // batch_size}")
@@ -527,7 +593,9 @@ class ModelBuilder:
             joint_weight_indices: Optional[List[Tuple[int, int]]] = None,
             with_reg=False,
             with_ae=False,
-            training: bool = True) -> float:
+            training: bool = True,
+            instrumentation: Optional[TrainingInstrumentation] = None,
+            profiler: Optional[ProfilerWindow] = None) -> float:
         """
         Train the model for one epoch.
         processing the batches with indices is what making it slow
@@ -545,17 +613,24 @@ class ModelBuilder:
         :param joint_weights: Optional array containing all joint weights for the dataset.
         :param joint_weight_indices: Optional list of tuples, each containing a pair of indices for which a joint weight exists.
         :param training: Whether to apply training or evaluation (default is True for training).
+        :param instrumentation: Optional instrumentation recording the step times and weight lookup time.
+        :param profiler: Optional profiler window annotating the data slicing, weight lookup and train steps.
         :return: The average loss for the epoch.
         """
 
+        # the data in the policy dtype, the dtype of the model (no copy when it was loaded with the policy)
+        X, y, sample_weights, joint_weights = as_policy(X), as_policy(y), as_policy(sample_weights), \
+            as_policy(joint_weights)
+
         epoch_loss = 0.0
         num_batches = 0
 
         for batch_idx in range(0, len(X), batch_size):
-            batch_X = X[batch_idx:batch_idx + batch_size]
-            batch_y = y[batch_idx:batch_idx + batch_size]
-            batch_sample_weights = None if sample_weights is None \
-                else sample_weights[batch_idx:batch_idx + batch_size]
+            with maybe_annotate(profiler, 'data_slicing'):
+                batch_X = X[batch_idx:batch_idx + batch_size]
+                batch_y = y[batch_idx:batch_idx + batch_size]
+                batch_sample_weights = None if sample_weights is None \
+                    else sample_weights[batch_idx:batch_idx + batch_size]
 
             if len(batch_y) <= 1:
                 # can't form a pair so skip
@@ -564,63 +639,63 @@ class ModelBuilder:
             # Get the corresponding joint weights for this batch
             batch_weights = None
             if joint_weights is not None and joint_weight_indices is not None:
-                batch_weights = self.process_batch_weights(
-                    np.arange(batch_idx, batch_idx + batch_size), joint_weights, joint_weight_indices)
-
-            with tf.GradientTape() as tape:
-                outputs = model(batch_X, training=training)
-
-                # Unpack the outputs based on the model configuration
-                if with_reg and with_ae:
-                    primary_predictions, regressor_predictions, decoder_predictions = outputs
-                elif with_reg:
-                    primary_predictions, regressor_predictions = outputs
-                    decoder_predictions = None
-                elif with_ae:
-                    primary_predictions, decoder_predictions = outputs
-                    regressor_predictions = None
-                else:
-                    primary_predictions = outputs
-                    regressor_predictions, decoder_predictions = None, None
-
-                # Primary loss
-                primary_loss = primary_loss_fn(batch_y, primary_predictions, sample_weights=batch_weights)
-
-                # Regressor loss
-                regressor_loss = 0
-                if with_reg and gamma_coeff is not None:
-                    regressor_loss = tf.keras.losses.mean_squared_error(batch_y, regressor_predictions)
-                    if batch_sample_weights is not None:
-                        regressor_loss = tf.cast(regressor_loss, batch_sample_weights.dtype)
-                        regressor_loss = tf.reduce_sum(regressor_loss * batch_sample_weights) / tf.reduce_sum(
-                            batch_sample_weights)
-                    regressor_loss *= gamma_coeff
-
-                # Decoder loss
-                decoder_loss = 0
-                if with_ae and lambda_coeff is not None:
-                    decoder_loss = tf.keras.losses.mean_squared_error(batch_X, decoder_predictions)
-                    decoder_loss *= lambda_coeff
-
-                # Make sure all loss tensors have the same dtype
-                dtype_to_use = tf.float32  # or tf.float64 based on your preference
-
-                primary_loss = tf.cast(primary_loss, dtype_to_use)
-                regressor_loss = tf.cast(regressor_loss, dtype_to_use)
-                decoder_loss = tf.cast(decoder_loss, dtype_to_use)
-
-                # Total loss
-                total_loss = primary_loss + regressor_loss + decoder_loss
-
-            if training:
-                gradients = tape.gradient(total_loss, model.trainable_variables)
-                optimizer.apply_gradients(zip(gradients, model.trainable_variables))
-
-            # Make sure total_loss is reduced to a single scalar value.
-            total_loss_scalar = tf.reduce_sum(total_loss)
-
-            # Update epoch_loss
-            epoch_loss += total_loss_scalar.numpy()
+                with maybe_phase(instrumentation, 'weight_lookup'), maybe_annotate(profiler, 'weight_lookup'):
+                    batch_weights = self.process_batch_weights(
+                        np.arange(batch_idx, batch_idx + batch_size), joint_weights, joint_weight_indices)
+
+            with maybe_step(instrumentation, len(batch_y)), maybe_profile_step(profiler):
+                with tf.GradientTape() as tape:
+                    outputs = model(batch_X, training=training)
+
+                    # Unpack the outputs based on the model configuration
+                    if with_reg and with_ae:
+                        primary_predictions, regressor_predictions, decoder_predictions = outputs
+                    elif with_reg:
+                        primary_predictions, regressor_predictions = outputs
+                        decoder_predictions = None
+                    elif with_ae:
+                        primary_predictions, decoder_predictions = outputs
+                        regressor_predictions = None
+                    else:
+                        primary_predictions = outputs
+                        regressor_predictions, decoder_predictions = None, None
+
+                    # Primary loss
+                    with maybe_annotate(profiler, 'repr_loss'):
+                        primary_loss = primary_loss_fn(batch_y, primary_predictions, sample_weights=batch_weights)
+
+                    # Regressor loss
+                    regressor_loss = 0
+                    if with_reg and gamma_coeff is not None:
+                        regressor_loss = tf.keras.losses.mean_squared_error(batch_y, regressor_predictions)
+                        if batch_sample_weights is not None:
+                            batch_sample_weights = tf.cast(batch_sample_weights, regressor_loss.dtype)
+                            regressor_loss = tf.reduce_sum(regressor_loss * batch_sample_weights) / tf.reduce_sum(
+                                batch_sample_weights)
+                        regressor_loss *= gamma_coeff
+
+                    # Decoder loss
+                    decoder_loss = 0
+                    if with_ae and lambda_coeff is not None:
+                        decoder_loss = tf.keras.losses.mean_squared_error(batch_X, decoder_predictions)
+                        decoder_loss *= lambda_coeff
+
+                    # (the data is in the policy dtype, the dtype of the model, so the losses need no cast)
+
+                    # Total loss
+                    total_loss = primary_loss + regressor_loss + decoder_loss
+
+                if training:
+                    gradients = tape.gradient(total_loss, model.trainable_variables)
+                    optimizer.apply_gradients(zip(gradients, model.trainable_variables))
+
+                # Make sure total_loss is reduced to a single scalar value.
+                total_loss_scalar = tf.reduce_sum(total_loss)
+
+                # Update epoch_loss
+                epoch_loss += total_loss_scalar.numpy()
+            if instrumentation is not None:
+                instrumentation.host_sync()
 
             num_batches += 1
 
@@ -646,7 +721,11 @@ class ModelBuilder:
                      epochs: int = 100,
                      batch_size: int = 32,
                      patience: int = 9,
-                     save_tag: Optional[str] = None) -> dict:
+                     save_tag: Optional[str] = None,
+                     resume: Union[bool, str] = False,
+                     state_freq: int = 1,
+                     instrumentation: Optional[TrainingInstrumentation] = None,
+                     profiler: Optional[ProfilerWindow] = None) -> dict:
         """
         Custom training loop to train the model and returns the training history.
 
@@ -668,6 +747,12 @@ class ModelBuilder:
         :param batch_size: The batch size for training.
         :param patience: The number of epochs with no improvement to wait before early stopping.
         :param save_tag: Tag to use for saving experiments.
+        :param resume: True to resume from the training state of this save_tag, or the path of the
+                       training state directory of a preempted run.
+        :param state_freq: Save the training state every state_freq epochs.
+        :param instrumentation: Optional TrainingInstrumentation reporting step latency, samples/s, pairs/s
+                                and retraces for every training epoch.
+        :param profiler: Optional ProfilerWindow tracing a window of epochs or steps with tf.profiler.
         :return: The training history as a dictionary.
         """
 
@@ -685,73 +770,111 @@ class ModelBuilder:
         # Optimizer and history initialization
         optimizer = tf.keras.optimizers.Adam(learning_rate=learning_rate)
         history = {'loss': [], 'val_loss': []}
+        # Reset history for retraining
+        retrain_history = {'loss': []}
 
-        for epoch in range(epochs):
-            train_loss = self.train_for_one_epoch(
-                model, optimizer, self.repr_loss_dl,
-                X_subtrain, y_subtrain,
-                batch_size=batch_size if batch_size > 0 else len(y_subtrain),
-                joint_weights=sample_joint_weights,
-                joint_weight_indices=sample_joint_weights_indices)
-
-            val_loss = self.train_for_one_epoch(
-                model, optimizer, self.repr_loss_dl, X_val, y_val,
-                batch_size=batch_size if batch_size > 0 else len(y_val),
-                joint_weights=val_sample_joint_weights,
-                joint_weight_indices=val_sample_joint_weights_indices, training=False)
-
-            # Log and save epoch losses
-            history['loss'].append(train_loss)
-            history['val_loss'].append(val_loss)
-
-            print(f"Epoch {epoch + 1}/{epochs}, Loss: {train_loss}, Validation Loss: {val_loss}")
-
-            # Early stopping logic
-            if val_loss < best_val_loss:
-                best_val_loss = val_loss
-                best_epoch = epoch
-                epochs_without_improvement = 0
-                # Save the model weights
-                model.save_weights(f"best_model_weights_{str(save_tag)}.h5")
+        # Restore the training state of a preempted run
+        training_state = TrainingState(model, save_tag, save_freq=state_freq)
+        training_state.optimizer = optimizer
+        restored = training_state.restore(resume)
+        phase, start_epoch = 'search', 0
+        if restored is not None:
+            phase, start_epoch = restored['phase'], restored['epoch']
+            best_epoch = restored['best_epoch']
+            if phase == 'search':
+                history = restored['history']
+                best_val_loss = restored['best_val_loss']
+                epochs_without_improvement = restored['epochs_without_improvement']
             else:
-                epochs_without_improvement += 1
+                history = restored['search_history']
+                retrain_history = restored['history']
+
+        if phase == 'search':
+            for epoch in range(start_epoch, epochs):
+                with maybe_epoch(instrumentation), maybe_profile_epoch(profiler, epoch):
+                    train_loss = self.train_for_one_epoch(
+                        model, optimizer, self.repr_loss_dl,
+                        X_subtrain, y_subtrain,
+                        batch_size=batch_size if batch_size > 0 else len(y_subtrain),
+                        joint_weights=sample_joint_weights,
+                        joint_weight_indices=sample_joint_weights_indices,
+                        instrumentation=instrumentation, profiler=profiler)
+
+                val_loss = self.train_for_one_epoch(
+                    model, optimizer, self.repr_loss_dl, X_val, y_val,
+                    batch_size=batch_size if batch_size > 0 else len(y_val),
+                    joint_weights=val_sample_joint_weights,
+                    joint_weight_indices=val_sample_joint_weights_indices, training=False)
+
+                # Log and save epoch losses
+                history['loss'].append(train_loss)
+                history['val_loss'].append(val_loss)
+
+                print(f"Epoch {epoch + 1}/{epochs}, Loss: {train_loss}, Validation Loss: {val_loss}")
+
+                # Early stopping logic
+                if val_loss < best_val_loss:
+                    best_val_loss = val_loss
+                    best_epoch = epoch
+                    epochs_without_improvement = 0
+                    # Save the model weights
+                    model.save_weights(f"best_model_weights_{str(save_tag)}.h5")
+                else:
+                    epochs_without_improvement += 1
+
+                if training_state.should_save(epoch + 1):
+                    training_state.save(epoch + 1, 'search', {
+                        'history': history, 'best_val_loss': best_val_loss, 'best_epoch': best_epoch,
+                        'epochs_without_improvement': epochs_without_improvement})
+
                 if epochs_without_improvement >= patience:
                     print("Early stopping triggered.")
                     break
 
-        # Plotting the losses
-        plt.plot(history['loss'], label='Training Loss')
-        plt.plot(history['val_loss'], label='Validation Loss')
-        plt.xlabel('Epoch')
-        plt.ylabel('Loss')
-        plt.title('Training and Validation Loss Over Epochs')
-        plt.legend()
-        plt.savefig(f"training_plot_{str(save_tag)}.png")
-        plt.close()
+            # A window cut short by early stopping should not run into the retraining
+            if profiler is not None:
+                profiler.close()
+
+            # Plotting the losses
+            submit_plot('lines', f"training_plot_{str(save_tag)}.png",
+                        series={'Training Loss': history['loss'],
+                                'Validation Loss': history['val_loss']},
+                        title='Training and Validation Loss Over Epochs', xlabel='Epoch', ylabel='Loss')
+
+            start_epoch = 0
+            training_state.save(0, 'retrain', {'search_history': history, 'best_epoch': best_epoch,
+                                               'history': retrain_history})
 
         # Retraining on the combined dataset
         print(f"Retraining to the best epoch: {best_epoch}")
-        # Reset history for retraining
-        retrain_history = {'loss': []}
 
         # NOTE: test if this fixes the issue
         # Retrain up to the best epoch
-        for epoch in range(best_epoch):
-            retrain_loss = self.train_for_one_epoch(
-                model, optimizer,
-                self.repr_loss_dl,
-                X_train, y_train,
-                batch_size=batch_size if batch_size > 0 else len(y_train),
-                joint_weights=train_sample_joint_weights,
-                joint_weight_indices=train_sample_joint_weights_indices)
+        for epoch in range(start_epoch, best_epoch):
+            with maybe_epoch(instrumentation), maybe_profile_epoch(profiler, epoch):
+                retrain_loss = self.train_for_one_epoch(
+                    model, optimizer,
+                    self.repr_loss_dl,
+                    X_train, y_train,
+                    batch_size=batch_size if batch_size > 0 else len(y_train),
+                    joint_weights=train_sample_joint_weights,
+                    joint_weight_indices=train_sample_joint_weights_indices,
+                    instrumentation=instrumentation, profiler=profiler)
 
             # Log the retrain loss
             retrain_history['loss'].append(retrain_loss)
 
             print(f"Retrain Epoch {epoch + 1}/{best_epoch}, Loss: {retrain_loss}")
 
+            if training_state.should_save(epoch + 1):
+                training_state.save(epoch + 1, 'retrain', {'search_history': history, 'best_epoch': best_epoch,
+                                                           'history': retrain_history})
+
         # Save the final model
         model.save_weights(f"final_model_weights_{str(save_tag)}.h5")
+        training_state.clear()
+        if profiler is not None:
+            profiler.close()
 
         return history
 
@@ -771,12 +894,17 @@ class ModelBuilder:
                         train_sample_joint_weights_indices: Optional[List[Tuple[int, int]]] = None,
                         learning_rate: float = 1e-3,
                         epochs: int = 100,
-                        batch_sizes=None,
+                        batch_sizes: Optional[Union[List[int], BatchSizeSchedule]] = None,
                         patience: int = 9,
-                        save_tag: Optional[str] = None) -> dict:
+                        save_tag: Optional[str] = None,
+                        resume: Union[bool, str] = False,
+                        state_freq: int = 1,
+                        instrumentation: Optional[TrainingInstrumentation] = None,
+                        profiler: Optional[ProfilerWindow] = None) -> dict:
         """
         Custom training loop to train the model and returns the training history.
-        Per epoch batch size variation
+        Per epoch batch size variation, following a batch size schedule. The compiled train steps are
+        cached per batch size so switching the batch size does not retrace after warm-up.
 
         :param train_sample_joint_weights_indices:
         :param train_sample_joint_weights:
@@ -793,15 +921,22 @@ class ModelBuilder:
         :param val_sample_joint_weights_indices: Indices of the reweighting factors in validation set.
         :param learning_rate: The learning rate for the Adam optimizer.
         :param epochs: The maximum number of epochs for training.
-        :param batch_sizes: The batch size for training.
+        :param batch_sizes: A BatchSizeSchedule, or a list of batch sizes to pick from at random every epoch.
         :param patience: The number of epochs with no improvement to wait before early stopping.
         :param save_tag: Tag to use for saving experiments.
+        :param resume: True to resume from the training state of this save_tag, or the path of the
+                       training state directory of a preempted run.
+        :param state_freq: Save the training state every state_freq epochs.
+        :param instrumentation: Optional TrainingInstrumentation reporting step latency, samples/s, pairs/s
+                                and retraces for every training epoch.
+        :param profiler: Optional ProfilerWindow tracing a window of epochs or steps with tf.profiler.
         :return: The training history as a dictionary.
         """
 
         # Initialize early stopping and best epoch variables
         if batch_sizes is None:
             batch_sizes = [32]
+        schedule = as_schedule(batch_sizes)
         best_val_loss = float('inf')
         best_epoch = 0
         epochs_without_improvement = 0
@@ -814,80 +949,142 @@ class ModelBuilder:
 
         # Optimizer and history initialization
         optimizer = tf.keras.optimizers.Adam(learning_rate=learning_rate)
-        history = {'loss': [], 'val_loss': []}
-
-        for epoch in range(epochs):
-            batch_size = random.choice(batch_sizes)
-            train_loss = self.train_for_one_epoch(
-                model, optimizer,
-                self.repr_loss_dl,
-                X_subtrain, y_subtrain,
-                batch_size=batch_size if batch_size > 0 else len(y_subtrain),
-                joint_weights=sample_joint_weights,
-                joint_weight_indices=sample_joint_weights_indices)
-
-            val_loss = self.train_for_one_epoch(
-                model, optimizer,
-                self.repr_loss_dl,
-                X_val, y_val,
-                batch_size=batch_size if batch_size > 0 else len(y_val),
-                training=False,
-                joint_weights=val_sample_joint_weights,
-                joint_weight_indices=val_sample_joint_weights_indices)
-
-            # Log and save epoch losses
-            history['loss'].append(train_loss)
-            history['val_loss'].append(val_loss)
-
-            print(f"Epoch {epoch + 1}/{epochs}, Loss: {train_loss}, Validation Loss: {val_loss}")
-
-            # Early stopping logic
-            if val_loss < best_val_loss:
-                best_val_loss = val_loss
-                best_epoch = epoch
-                epochs_without_improvement = 0
-                # Save the model weights
-                model.save_weights(f"best_model_weights_{str(save_tag)}.h5")
+        history = {'loss': [], 'val_loss': [], 'batch_size': []}
+        # Reset history for retraining
+        retrain_history = {'loss': [], 'batch_size': []}
+        # Compiled train and eval steps per batch size
+        step_cache = CompiledStepCache(model, optimizer, self.repr_loss_dl)
+
+        # Restore the training state of a preempted run
+        training_state = TrainingState(model, save_tag, save_freq=state_freq)
+        training_state.optimizer = optimizer
+        restored = training_state.restore(resume)
+        phase, start_epoch = 'search', 0
+        if restored is not None:
+            phase, start_epoch = restored['phase'], restored['epoch']
+            best_epoch = restored['best_epoch']
+            if phase == 'search':
+                history = restored['history']
+                best_val_loss = restored['best_val_loss']
+                epochs_without_improvement = restored['epochs_without_improvement']
             else:
-                epochs_without_improvement += 1
+                history = restored['search_history']
+                retrain_history = restored['history']
+
+        if phase == 'search':
+            for epoch in range(start_epoch, epochs):
+                batch_size = schedule(epoch)
+                bucket = schedule.bucket(batch_size, len(y_subtrain))
+                val_bucket = schedule.bucket(batch_size, len(y_val))
+                if schedule.scale_lr:
+                    optimizer.learning_rate = schedule.learning_rate(learning_rate, batch_size, len(y_subtrain))
+
+                epoch_start = time.perf_counter()
+                with maybe_epoch(instrumentation), maybe_profile_epoch(profiler, epoch):
+                    train_loss = self.train_for_one_epoch(
+                        model, optimizer,
+                        self.repr_loss_dl,
+                        X_subtrain, y_subtrain,
+                        batch_size=bucket,
+                        joint_weights=sample_joint_weights,
+                        joint_weight_indices=sample_joint_weights_indices,
+                        step_fn=step_cache.get(bucket),
+                        instrumentation=instrumentation, profiler=profiler)
+                step_cache.record(bucket, time.perf_counter() - epoch_start, len(y_subtrain))
+
+                val_loss = self.train_for_one_epoch(
+                    model, optimizer,
+                    self.repr_loss_dl,
+                    X_val, y_val,
+                    batch_size=val_bucket,
+                    training=False,
+                    joint_weights=val_sample_joint_weights,
+                    joint_weight_indices=val_sample_joint_weights_indices,
+                    step_fn=step_cache.get(val_bucket, training=False))
+
+                # Log and save epoch losses
+                history['loss'].append(train_loss)
+                history['val_loss'].append(val_loss)
+                history['batch_size'].append(bucket)
+
+                print(f"Epoch {epoch + 1}/{epochs}, Batch Size: {bucket}, Loss: {train_loss}, "
+                      f"Validation Loss: {val_loss}")
+
+                # Early stopping logic
+                if val_loss < best_val_loss:
+                    best_val_loss = val_loss
+                    best_epoch = epoch
+                    epochs_without_improvement = 0
+                    # Save the model weights
+                    model.save_weights(f"best_model_weights_{str(save_tag)}.h5")
+                else:
+                    epochs_without_improvement += 1
+
+                if training_state.should_save(epoch + 1):
+                    training_state.save(epoch + 1, 'search', {
+                        'history': history, 'best_val_loss': best_val_loss, 'best_epoch': best_epoch,
+                        'epochs_without_improvement': epochs_without_improvement})
+
                 if epochs_without_improvement >= patience:
                     print("Early stopping triggered.")
                     break
 
-        # Plotting the losses
-        plt.plot(history['loss'], label='Training Loss')
-        plt.plot(history['val_loss'], label='Validation Loss')
-        plt.xlabel('Epoch')
-        plt.ylabel('Loss')
-        plt.title('Training and Validation Loss Over Epochs')
-        plt.legend()
-        plt.savefig(f"training_plot_{str(save_tag)}.png")
-        plt.close()
+            # A window cut short by early stopping should not run into the retraining
+            if profiler is not None:
+                profiler.close()
+
+            # Plotting the losses
+            submit_plot('lines', f"training_plot_{str(save_tag)}.png",
+                        series={'Training Loss': history['loss'],
+                                'Validation Loss': history['val_loss']},
+                        title='Training and Validation Loss Over Epochs', xlabel='Epoch', ylabel='Loss')
+
+            start_epoch = 0
+            training_state.save(0, 'retrain', {'search_history': history, 'best_epoch': best_epoch,
+                                               'history': retrain_history})
 
         # Retraining on the combined dataset
         print(f"Retraining to the best epoch: {best_epoch}")
-        # Reset history for retraining
-        retrain_history = {'loss': []}
 
         # NOTE: test if this fixes the issue
         # Retrain up to the best epoch
-        for epoch in range(best_epoch):
-            batch_size = random.choice(batch_sizes)
-            retrain_loss = self.train_for_one_epoch(
-                model, optimizer,
-                self.repr_loss_dl,
-                X_train, y_train,
-                batch_size=batch_size if batch_size > 0 else len(y_train),
-                joint_weights=train_sample_joint_weights,
-                joint_weight_indices=train_sample_joint_weights_indices)
+        for epoch in range(start_epoch, best_epoch):
+            batch_size = schedule(epoch)
+            bucket = schedule.bucket(batch_size, len(y_train))
+            if schedule.scale_lr:
+                optimizer.learning_rate = schedule.learning_rate(learning_rate, batch_size, len(y_train))
+
+            epoch_start = time.perf_counter()
+            with maybe_epoch(instrumentation), maybe_profile_epoch(profiler, epoch):
+                retrain_loss = self.train_for_one_epoch(
+                    model, optimizer,
+                    self.repr_loss_dl,
+                    X_train, y_train,
+                    batch_size=bucket,
+                    joint_weights=train_sample_joint_weights,
+                    joint_weight_indices=train_sample_joint_weights_indices,
+                    step_fn=step_cache.get(bucket),
+                    instrumentation=instrumentation, profiler=profiler)
+            step_cache.record(bucket, time.perf_counter() - epoch_start, len(y_train))
 
             # Log the retrain loss
             retrain_history['loss'].append(retrain_loss)
+            retrain_history['batch_size'].append(bucket)
 
             print(f"Retrain Epoch {epoch + 1}/{best_epoch}, Loss: {retrain_loss}")
 
+            if training_state.should_save(epoch + 1):
+                training_state.save(epoch + 1, 'retrain', {'search_history': history, 'best_epoch': best_epoch,
+                                                           'history': retrain_history})
+
+        # Report the throughput per batch size (the first epoch of each includes tracing)
+        step_cache.print_throughput()
+
         # Save the final model
         model.save_weights(f"final_model_weights_{str(save_tag)}.h5")
+        training_state.clear()
+        if profiler is not None:
+            profiler.close()
 
         return history
 
@@ -914,7 +1111,11 @@ class ModelBuilder:
                            epochs: int = 100,
                            batch_size: int = 32,
                            patience: int = 9,
-                           save_tag: Optional[str] = None) -> dict:
+                           save_tag: Optional[str] = None,
+                           resume: Union[bool, str] = False,
+                           state_freq: int = 1,
+                           instrumentation: Optional[TrainingInstrumentation] = None,
+                           profiler: Optional[ProfilerWindow] = None) -> dict:
         """
         Custom training loop to train the model and returns the training history.
 
@@ -941,6 +1142,12 @@ class ModelBuilder:
         :param batch_size: The batch size for training.
         :param patience: The number of epochs with no improvement to wait before early stopping.
         :param save_tag: Tag to use for saving experiments.
+        :param resume: True to resume from the training state of this save_tag, or the path of the
+                       training state directory of a preempted run.
+        :param state_freq: Save the training state every state_freq epochs.
+        :param instrumentation: Optional TrainingInstrumentation reporting step latency, samples/s, pairs/s
+                                and retraces for every training epoch.
+        :param profiler: Optional ProfilerWindow tracing a window of epochs or steps with tf.profiler.
         :return: The training history as a dictionary.
         """
 
@@ -950,12 +1157,35 @@ class ModelBuilder:
         epochs_without_improvement = 0
         epochs_for_estimation = 5
 
-        gamma_coeff, lambda_coeff = self.estimate_gamma_lambda_coeffs(
-            model, X_subtrain, y_subtrain, self.repr_loss_dl,
-            sample_weights, sample_joint_weights, sample_joint_weights_indices,
-            learning_rate=learning_rate, n_epochs=epochs_for_estimation,
-            batch_size=batch_size if batch_size > 0 else len(y_subtrain),
-            with_ae=with_ae, with_reg=with_reg)
+        # Optimizer and history initialization
+        optimizer = tf.keras.optimizers.Adam(learning_rate=learning_rate)
+        history = {'loss': [], 'val_loss': []}
+        # Reset history for retraining
+        retrain_history = {'loss': []}
+
+        # Restore the training state of a preempted run, skipping the coefficient estimation
+        training_state = TrainingState(model, save_tag, save_freq=state_freq)
+        training_state.optimizer = optimizer
+        restored = training_state.restore(resume)
+        phase, start_epoch = 'search', 0
+        if restored is not None:
+            phase, start_epoch = restored['phase'], restored['epoch']
+            best_epoch = restored['best_epoch']
+            gamma_coeff, lambda_coeff = restored['gamma_coeff'], restored['lambda_coeff']
+            if phase == 'search':
+                history = restored['history']
+                best_val_loss = restored['best_val_loss']
+                epochs_without_improvement = restored['epochs_without_improvement']
+            else:
+                history = restored['search_history']
+                retrain_history = restored['history']
+        else:
+            gamma_coeff, lambda_coeff = self.estimate_gamma_lambda_coeffs(
+                model, X_subtrain, y_subtrain, self.repr_loss_dl,
+                sample_weights, sample_joint_weights, sample_joint_weights_indices,
+                learning_rate=learning_rate, n_epochs=epochs_for_estimation,
+                batch_size=batch_size if batch_size > 0 else len(y_subtrain),
+                with_ae=with_ae, with_reg=with_reg)
 
         print(f'found gamma: {gamma_coeff}, lambda: {lambda_coeff}')
 
@@ -965,113 +1195,98 @@ class ModelBuilder:
         #
         # print("Run the command line:\n tensorboard --logdir logs/fit")
 
-        # Optimizer and history initialization
-        optimizer = tf.keras.optimizers.Adam(learning_rate=learning_rate)
-        history = {'loss': [], 'val_loss': []}
+        coeffs = {'gamma_coeff': gamma_coeff, 'lambda_coeff': lambda_coeff}
+
+        if phase == 'search':
+            for epoch in range(start_epoch, epochs):
+                with maybe_epoch(instrumentation), maybe_profile_epoch(profiler, epoch):
+                    train_loss = self.train_for_one_epoch_mh(
+                        model, optimizer, self.repr_loss_dl, X_subtrain, y_subtrain,
+                        batch_size=batch_size if batch_size > 0 else len(y_subtrain)
+                        , gamma_coeff=gamma_coeff, lambda_coeff=lambda_coeff,
+                        sample_weights=sample_weights, joint_weights=sample_joint_weights,
+                        joint_weight_indices=sample_joint_weights_indices, with_reg=with_reg, with_ae=with_ae,
+                        instrumentation=instrumentation, profiler=profiler)
+
+                val_loss = self.train_for_one_epoch_mh(
+                    model, optimizer, self.repr_loss_dl, X_val, y_val,
+                    batch_size=batch_size if batch_size > 0 else len(y_val),
+                    gamma_coeff=gamma_coeff, lambda_coeff=lambda_coeff,
+                    sample_weights=val_sample_weights, joint_weights=val_sample_joint_weights,
+                    joint_weight_indices=val_sample_joint_weights_indices, with_reg=with_reg, with_ae=with_ae,
+                    training=False)
+
+                # Log and save epoch losses
+                history['loss'].append(train_loss)
+                history['val_loss'].append(val_loss)
+
+                print(f"Epoch {epoch + 1}/{epochs}, Loss: {train_loss}, Validation Loss: {val_loss}")
+
+                # Early stopping logic
+                if val_loss < best_val_loss:
+                    best_val_loss = val_loss
+                    best_epoch = epoch
+                    epochs_without_improvement = 0
+                    # Save the model weights
+                    model.save_weights(f"best_model_weights_{str(save_tag)}.h5")
+                else:
+                    epochs_without_improvement += 1
+
+                if training_state.should_save(epoch + 1):
+                    training_state.save(epoch + 1, 'search', {
+                        'history': history, 'best_val_loss': best_val_loss, 'best_epoch': best_epoch,
+                        'epochs_without_improvement': epochs_without_improvement, **coeffs})
 
-        for epoch in range(epochs):
-            train_loss = self.train_for_one_epoch_mh(
-                model, optimizer, self.repr_loss_dl, X_subtrain, y_subtrain,
-                batch_size=batch_size if batch_size > 0 else len(y_subtrain)
-                , gamma_coeff=gamma_coeff, lambda_coeff=lambda_coeff,
-                sample_weights=sample_weights, joint_weights=sample_joint_weights,
-                joint_weight_indices=sample_joint_weights_indices, with_reg=with_reg, with_ae=with_ae)
-
-            val_loss = self.train_for_one_epoch_mh(
-                model, optimizer, self.repr_loss_dl, X_val, y_val,
-                batch_size=batch_size if batch_size > 0 else len(y_val),
-                gamma_coeff=gamma_coeff, lambda_coeff=lambda_coeff,
-                sample_weights=val_sample_weights, joint_weights=val_sample_joint_weights,
-                joint_weight_indices=val_sample_joint_weights_indices, with_reg=with_reg, with_ae=with_ae,
-                training=False)
-
-            # Log and save epoch losses
-            history['loss'].append(train_loss)
-            history['val_loss'].append(val_loss)
-
-            print(f"Epoch {epoch + 1}/{epochs}, Loss: {train_loss}, Validation Loss: {val_loss}")
-
-            # Early stopping logic
-            if val_loss < best_val_loss:
-                best_val_loss = val_loss
-                best_epoch = epoch
-                epochs_without_improvement = 0
-                # Save the model weights
-                model.save_weights(f"best_model_weights_{str(save_tag)}.h5")
-            else:
-                epochs_without_improvement += 1
                 if epochs_without_improvement >= patience:
                     print("Early stopping triggered.")
                     break
 
-        # Plotting the losses
-        plt.plot(history['loss'], label='Training Loss')
-        plt.plot(history['val_loss'], label='Validation Loss')
-        plt.xlabel('Epoch')
-        plt.ylabel('Loss')
-        plt.title('Training and Validation Loss Over Epochs')
-        plt.legend()
-        plt.savefig(f"training_plot_{str(save_tag)}.png")
-        plt.close()
+            # A window cut short by early stopping should not run into the retraining
+            if profiler is not None:
+                profiler.close()
+
+            # Plotting the losses
+            submit_plot('lines', f"training_plot_{str(save_tag)}.png",
+                        series={'Training Loss': history['loss'],
+                                'Validation Loss': history['val_loss']},
+                        title='Training and Validation Loss Over Epochs', xlabel='Epoch', ylabel='Loss')
+
+            start_epoch = 0
+            training_state.save(0, 'retrain', {'search_history': history, 'best_epoch': best_epoch,
+                                               'history': retrain_history, **coeffs})
 
         # Retraining on the combined dataset
         print(f"Retraining to the best epoch: {best_epoch}")
 
-        # Reset history for retraining
-        retrain_history = {'loss': []}
-
         # Retrain up to the best epoch
-        for epoch in range(best_epoch):
-            retrain_loss = self.train_for_one_epoch_mh(
-                model, optimizer, self.repr_loss_dl, X_train, y_train,
-                batch_size=batch_size if batch_size > 0 else len(y_train),
-                gamma_coeff=gamma_coeff, lambda_coeff=lambda_coeff,
-                sample_weights=train_sample_weights,
-                joint_weights=train_sample_joint_weights,
-                joint_weight_indices=train_sample_joint_weights_indices,
-                with_reg=with_reg, with_ae=with_ae)
+        for epoch in range(start_epoch, best_epoch):
+            with maybe_epoch(instrumentation), maybe_profile_epoch(profiler, epoch):
+                retrain_loss = self.train_for_one_epoch_mh(
+                    model, optimizer, self.repr_loss_dl, X_train, y_train,
+                    batch_size=batch_size if batch_size > 0 else len(y_train),
+                    gamma_coeff=gamma_coeff, lambda_coeff=lambda_coeff,
+                    sample_weights=train_sample_weights,
+                    joint_weights=train_sample_joint_weights,
+                    joint_weight_indices=train_sample_joint_weights_indices,
+                    with_reg=with_reg, with_ae=with_ae,
+                    instrumentation=instrumentation, profiler=profiler)
 
             # Log the retrain loss
             retrain_history['loss'].append(retrain_loss)
             print(f"Retrain Epoch {epoch + 1}/{best_epoch}, Loss: {retrain_loss}")
 
+            if training_state.should_save(epoch + 1):
+                training_state.save(epoch + 1, 'retrain', {'search_history': history, 'best_epoch': best_epoch,
+                                                           'history': retrain_history, **coeffs})
+
         # Save the final model
         model.save_weights(f"final_model_weights_{str(save_tag)}.h5")
+        training_state.clear()
+        if profiler is not None:
+            profiler.close()
 
         return history
 
-    def custom_data_generator(self, X, y, batch_size):
-        """
-        Yields batches of data such that the last two samples in each batch
-        have target labels above ln(10), and the remaining have labels below ln(10).
-        Below-threshold samples cycle through before repeating.
-        """
-        above_threshold_indices = np.where(y > np.log(10))[0]
-        below_threshold_indices = np.where(y <= np.log(10))[0]
-
-        # Create an iterator that will cycle through the below_threshold_indices
-        cyclic_below_threshold = cycle(below_threshold_indices)
-
-        while True:
-            # Select random above-threshold indices
-            batch_indices_above = np.random.choice(above_threshold_indices, 2, replace=False)
-
-            # Select (batch_size - 2) below-threshold indices in a cyclic manner
-            batch_indices_below = [next(cyclic_below_threshold) for _ in range(batch_size - 2)]
-
-            batch_indices = np.concatenate([batch_indices_below, batch_indices_above])
-
-            batch_X = X[batch_indices]
-            batch_y = y[batch_indices]
-
-            # Shuffle the entire batch
-            indices = np.arange(batch_X.shape[0])
-            np.random.shuffle(indices)
-            batch_X = batch_X[indices]
-            batch_y = batch_y[indices]
-
-            yield batch_X, batch_y
-
     def train_pds_injection(self,
                             model: Model,
                             X_subtrain: Tensor,
@@ -1083,7 +1298,15 @@ class ModelBuilder:
                             learning_rate: float = 1e-3,
                             epochs: int = 100,
                             batch_size: int = 32,
-                            patience: int = 9) -> callbacks.History:
+                            patience: int = 9,
+                            save_tag=None,
+                            resume: Union[bool, str] = False,
+                            state_freq: int = 1,
+                            quotas: Optional[List[Optional[int]]] = None,
+                            pair_mix: Optional[Union[dict, List[float]]] = None,
+                            seed: Optional[int] = None,
+                            instrumentation: Optional[TrainingInstrumentation] = None,
+                            profiler: Optional[ProfilerWindow] = None) -> callbacks.History:
         """
         Trains the model and returns the training history. injection of rare examples
 
@@ -1098,15 +1321,29 @@ class ModelBuilder:
         :param epochs: The maximum number of epochs for training.
         :param batch_size: The batch size for training.
         :param patience: The number of epochs with no improvement to wait before early stopping.
+        :param save_tag: Tag to name the training state directory.
+        :param resume: True to resume from the training state of this save_tag, or the path of the
+                       training state directory of a preempted run.
+        :param state_freq: Save the training state every state_freq epochs.
+        :param quotas: The number of SEP, elevated and background samples per batch (see
+                       ClassBalancedBatchSampler). Default is two SEP samples per batch.
+        :param pair_mix: Target fraction of each pair type to fit the quotas to, instead of quotas.
+        :param seed: Seed of the batch sampling.
+        :param instrumentation: Optional TrainingInstrumentation reporting step latency, samples/s, pairs/s
+                                and retraces for every training epoch.
+        :param profiler: Optional ProfilerWindow tracing a window of epochs or steps with tf.profiler.
         :return: The training history as a History object.
         """
 
-        # Create custom data generators for training and validation
-        train_gen = self.custom_data_generator(X_subtrain, y_subtrain, batch_size)
-        val_gen = self.custom_data_generator(X_val, y_val, batch_size)
+        # Class-balanced batches for training and validation
+        train_sampler = ClassBalancedBatchSampler(y_subtrain, batch_size, quotas=quotas, pair_mix=pair_mix, seed=seed)
+        val_sampler = ClassBalancedBatchSampler(y_val, batch_size, quotas=quotas, pair_mix=pair_mix,
+                                                seed=None if seed is None else seed + 1)
+        train_gen = train_sampler.dataset(X_subtrain, y_subtrain)
+        val_gen = val_sampler.dataset(X_val, y_val)
 
-        train_steps = len(y_subtrain) // batch_size
-        val_steps = len(y_val) // batch_size if len(y_val) > batch_size else len(y_val)
+        train_steps = train_sampler.steps_per_epoch()
+        val_steps = val_sampler.steps_per_epoch()
 
         # Setup TensorBoard
         # log_dir = "logs/fit/" + datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
@@ -1126,44 +1363,70 @@ class ModelBuilder:
         callback_list = [early_stopping_cb, checkpoint_cb]
 
         # Compile the model
-        model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=learning_rate), loss=self.repr_loss)
-
-        # First train the model with a validation set to determine the best epoch
-        history = model.fit(train_gen,
-                            steps_per_epoch=train_steps,
-                            validation_data=val_gen,
-                            validation_steps=val_steps,
-                            epochs=epochs,
-                            batch_size=batch_size if batch_size > 0 else len(y_subtrain),
-                            validation_batch_size=batch_size if batch_size > 0 else len(y_val),
-                            callbacks=callback_list)
-
-        # Get the best epoch from early stopping
-        best_epoch = np.argmin(history.history['val_loss']) + 1
-
-        # Plot training loss and validation loss
-        plt.plot(history.history['loss'], label='Training Loss')
-        plt.plot(history.history['val_loss'], label='Validation Loss')
-        plt.xlabel('Epoch')
-        plt.ylabel('Loss')
-        plt.title('Training and Validation Loss Over Epochs')
-        plt.legend()
-        plt.show()
-
-        # Create custom generators for combined data
-        train_gen_comb = self.custom_data_generator(X_train, y_train, batch_size)
+        model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=learning_rate), loss=self.repr_loss,
+                      metrics=pair_type_metrics())
+
+        # Restore the training state of a preempted run (after compile so the optimizer exists)
+        training_state = TrainingState(model, save_tag, save_freq=state_freq)
+        training_state.optimizer = model.optimizer
+        restored = training_state.restore(resume)
+
+        if restored is None or restored['phase'] == 'search':
+            state_cb = TrainingStateCallback(training_state, 'search', early_stopping_cb, restored)
+            # First train the model with a validation set to determine the best epoch
+            history = model.fit(train_gen,
+                                steps_per_epoch=train_steps,
+                                validation_data=val_gen,
+                                validation_steps=val_steps,
+                                epochs=epochs,
+                                initial_epoch=restored['epoch'] if restored is not None else 0,
+                                callbacks=callback_list + [state_cb] + instrumentation_callbacks(
+                                    instrumentation, train_sampler.batch_size,
+                                    len(y_subtrain)) + profiler_callbacks(profiler))
+            history.history = state_cb.history
+
+            # Get the best epoch from early stopping
+            best_epoch = int(np.argmin(history.history['val_loss']) + 1)
+
+            # Plot training loss and validation loss (saved instead of shown so the run does not block)
+            submit_plot('lines', f"training_plot_{str(save_tag)}.png",
+                        series={'Training Loss': history.history['loss'],
+                                'Validation Loss': history.history['val_loss']},
+                        title='Training and Validation Loss Over Epochs', xlabel='Epoch', ylabel='Loss')
+        else:
+            history = callbacks.History()
+            history.history = restored['search_history']
+            best_epoch = restored['best_epoch']
 
-        # Calculate the number of steps per epoch for training
-        train_steps_comb = len(X_train) // batch_size
+        # Class-balanced batches of the combined data
+        train_sampler_comb = ClassBalancedBatchSampler(y_train, batch_size, quotas=quotas, pair_mix=pair_mix,
+                                                       seed=None if seed is None else seed + 2)
+        train_gen_comb = train_sampler_comb.dataset(X_train, y_train)
+        train_steps_comb = train_sampler_comb.steps_per_epoch()
 
         model.compile(
-            optimizer=tf.keras.optimizers.Adam(learning_rate=learning_rate), loss=self.repr_loss)
+            optimizer=tf.keras.optimizers.Adam(learning_rate=learning_rate), loss=self.repr_loss,
+            metrics=pair_type_metrics())
 
+        # The retraining uses a fresh optimizer, so its slots are restored after compiling it
+        training_state.optimizer = model.optimizer
+        if restored is not None and restored['phase'] == 'retrain':
+            restored = training_state.restore(training_state.state_dir)
+        else:
+            training_state.save(0, 'retrain', {'search_history': history.history, 'best_epoch': best_epoch,
+                                               'history': {}})
+
+        retrain_state_cb = TrainingStateCallback(
+            training_state, 'retrain', restored=restored,
+            extra_state={'search_history': history.history, 'best_epoch': best_epoch})
         model.fit(train_gen_comb,
                   steps_per_epoch=train_steps_comb,
                   epochs=best_epoch,
-                  batch_size=batch_size if batch_size > 0 else len(y_train),
-                  callbacks=[checkpoint_cb])
+                  initial_epoch=restored['epoch'] if retrain_state_cb.restored is not None else 0,
+                  callbacks=[checkpoint_cb, retrain_state_cb] + instrumentation_callbacks(
+                      instrumentation, train_sampler_comb.batch_size, len(y_train))
+                  + profiler_callbacks(profiler))
+        training_state.clear()
 
         return history
 
@@ -1258,12 +1521,12 @@ class ModelBuilder:
 
     def train_reg_head(self,
                        model: Model,
-                       X_subtrain: ndarray,
-                       y_subtrain: ndarray,
-                       X_val: ndarray,
-                       y_val: ndarray,
-                       X_train: ndarray,
-                       y_train: ndarray,
+                       X_subtrain: Union[ndarray, StreamingCatalog],
+                       y_subtrain: Optional[ndarray],
+                       X_val: Union[ndarray, StreamingCatalog],
+                       y_val: Optional[ndarray],
+                       X_train: Union[ndarray, StreamingCatalog],
+                       y_train: Optional[ndarray],
                        sample_weights: Optional[ndarray] = None,
                        sample_val_weights: Optional[ndarray] = None,
                        sample_train_weights: Optional[ndarray] = None,
@@ -1271,10 +1534,15 @@ class ModelBuilder:
                        epochs: int = 100,
                        batch_size: int = 32,
                        patience: int = 9,
-                       save_tag=None) -> callbacks.History:
+                       save_tag=None,
+                       resume: Union[bool, str] = False,
+                       state_freq: int = 1,
+                       instrumentation: Optional[TrainingInstrumentation] = None,
+                       profiler: Optional[ProfilerWindow] = None) -> callbacks.History:
         """
         Train a neural network model focusing only on the regression output.
         Include reweighting for balancing the loss.
+        The X sets can also be streaming catalogs (dataload.streaming), with their y set to None.
 
         :param save_tag:
         :param model: The neural network model.
@@ -1291,6 +1559,12 @@ class ModelBuilder:
         :param epochs: Number of epochs.
         :param batch_size: Batch size.
         :param patience: Number of epochs for early stopping.
+        :param resume: True to resume from the training state of this save_tag, or the path of the
+                       training state directory of a preempted run.
+        :param state_freq: Save the training state every state_freq epochs.
+        :param instrumentation: Optional TrainingInstrumentation reporting step latency, samples/s, pairs/s
+                                and retraces for every training epoch.
+        :param profiler: Optional ProfilerWindow tracing a window of epochs or steps with tf.profiler.
         :return: Training history.
         """
 
@@ -1308,38 +1582,59 @@ class ModelBuilder:
         # Compile the model
         model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=learning_rate), loss={'regression_head': 'mse'})
 
-        # Train the model with a validation set
-        history = model.fit(X_subtrain, {'regression_head': y_subtrain},
-                            sample_weight=sample_weights,
-                            epochs=epochs,
-                            batch_size=batch_size if batch_size > 0 else len(y_subtrain),
-                            validation_data=(X_val, {'regression_head': y_val}, sample_val_weights),
-                            validation_batch_size=batch_size if batch_size > 0 else len(y_val),
-                            callbacks=[early_stopping_cb, checkpoint_cb])
-
-        # Find the best epoch from early stopping
-        best_epoch = np.argmin(history.history['val_regression_head_loss']) + 1
-
-        # Plot training and validation loss
-        plt.plot(history.history['regression_head_loss'], label='Training Loss')
-        plt.plot(history.history['val_regression_head_loss'], label='Validation Loss')
-        plt.xlabel('Epoch')
-        plt.ylabel('Loss')
-        plt.title('Training and Validation Loss Over Epochs')
-        plt.legend()
-        file_path = f"training_reg_plot_{str(save_tag)}.png"
-        plt.savefig(file_path)
-        plt.close()
+        # Restore the training state of a preempted run (after compile so the optimizer exists)
+        training_state = TrainingState(model, save_tag, save_freq=state_freq)
+        training_state.optimizer = model.optimizer
+        restored = training_state.restore(resume)
+
+        if restored is None or restored['phase'] == 'search':
+            state_cb = TrainingStateCallback(training_state, 'search', early_stopping_cb, restored)
+            # Train the model with a validation set
+            subtrain_inputs, n_subtrain = fit_inputs(X_subtrain, y_subtrain, batch_size, sample_weights,
+                                                     output_name='regression_head')
+            history = model.fit(**subtrain_inputs,
+                                epochs=epochs,
+                                initial_epoch=restored['epoch'] if restored is not None else 0,
+                                **validation_inputs(X_val, y_val, batch_size, sample_val_weights,
+                                                    output_name='regression_head'),
+                                callbacks=[early_stopping_cb, checkpoint_cb, state_cb] + instrumentation_callbacks(
+                                    instrumentation, batch_size if batch_size > 0 else n_subtrain,
+                                    n_subtrain) + profiler_callbacks(profiler))
+            history.history = state_cb.history
+
+            # Find the best epoch from early stopping
+            best_epoch = int(np.argmin(history.history['val_regression_head_loss']) + 1)
+
+            # Plot training and validation loss
+            file_path = f"training_reg_plot_{str(save_tag)}.png"
+            submit_plot('lines', file_path,
+                        series={'Training Loss': history.history['regression_head_loss'],
+                                'Validation Loss': history.history['val_regression_head_loss']},
+                        title='Training and Validation Loss Over Epochs', xlabel='Epoch', ylabel='Loss')
+
+            training_state.save(0, 'retrain', {'search_history': history.history, 'best_epoch': best_epoch,
+                                               'history': {}})
+        else:
+            history = callbacks.History()
+            history.history = restored['search_history']
+            best_epoch = restored['best_epoch']
 
         # Retrain the model to the best epoch using combined data
-        model.fit(X_train, {'regression_head': y_train},
-                  sample_weight=sample_train_weights,
+        retrain_state_cb = TrainingStateCallback(
+            training_state, 'retrain', restored=restored,
+            extra_state={'search_history': history.history, 'best_epoch': best_epoch})
+        train_inputs, n_train = fit_inputs(X_train, y_train, batch_size, sample_train_weights,
+                                           output_name='regression_head')
+        model.fit(**train_inputs,
                   epochs=best_epoch,
-                  batch_size=batch_size if batch_size > 0 else len(y_train),
-                  callbacks=[checkpoint_cb])
+                  initial_epoch=restored['epoch'] if retrain_state_cb.restored is not None else 0,
+                  callbacks=[checkpoint_cb, retrain_state_cb] + instrumentation_callbacks(
+                      instrumentation, batch_size if batch_size > 0 else n_train, n_train)
+                  + profiler_callbacks(profiler))
 
         # save the model weights
         model.save_weights(f"extended_model_weights_{str(save_tag)}.h5")
+        training_state.clear()
 
         return history
 
@@ -1487,7 +1782,11 @@ class ModelBuilder:
                            epochs: int = 100,
                            batch_size: int = 32,
                            patience: int = 9,
-                           save_tag=None) -> callbacks.History:
+                           save_tag=None,
+                           resume: Union[bool, str] = False,
+                           state_freq: int = 1,
+                           instrumentation: Optional[TrainingInstrumentation] = None,
+                           profiler: Optional[ProfilerWindow] = None) -> callbacks.History:
         """
         Train a neural network model focusing on the regression and autoencoder output.
         Includes reweighting for balancing the loss and saves the model weights.
@@ -1504,15 +1803,27 @@ class ModelBuilder:
         :param batch_size: Batch size.
         :param patience: Number of epochs for early stopping.
         :param save_tag: Tag for saving model weights and plots.
+        :param resume: True to resume from the training state of this save_tag, or the path of the
+                       training state directory of a preempted run.
+        :param state_freq: Save the training state every state_freq epochs.
+        :param instrumentation: Optional TrainingInstrumentation reporting step latency, samples/s, pairs/s
+                                and retraces for every training epoch.
+        :param profiler: Optional ProfilerWindow tracing a window of epochs or steps with tf.profiler.
         :return: Training history.
         """
 
         epochs_for_estimation = 5
 
-        lambda_coef = self.estimate_lambda_coef(model, X_subtrain, y_subtrain,
-                                                sample_weights,
-                                                learning_rate, epochs_for_estimation,
-                                                batch_size=batch_size if batch_size > 0 else len(y_subtrain))
+        # The coefficient is stored with the training state, so a resumed run skips the estimation
+        training_state = TrainingState(model, save_tag, save_freq=state_freq)
+        resumed_state = training_state.restore(resume)
+        if resumed_state is not None:
+            lambda_coef = resumed_state['lambda_coef']
+        else:
+            lambda_coef = self.estimate_lambda_coef(model, X_subtrain, y_subtrain,
+                                                    sample_weights,
+                                                    learning_rate, epochs_for_estimation,
+                                                    batch_size=batch_size if batch_size > 0 else len(y_subtrain))
 
         print(f"Lambda coefficient found: {lambda_coef}")
 
@@ -1536,38 +1847,59 @@ class ModelBuilder:
         y_dict = {'regression_head': y_subtrain, 'decoder_head': X_subtrain}
         val_y_dict = {'regression_head': y_val, 'decoder_head': X_val}
 
-        # Train the model
-        history = model.fit(X_subtrain, y_dict,
-                            sample_weight=sample_weights,
-                            epochs=epochs,
-                            batch_size=batch_size if batch_size > 0 else len(y_subtrain),
-                            validation_data=(X_val, val_y_dict, sample_val_weights),
-                            validation_batch_size=batch_size if batch_size > 0 else len(y_val),
-                            callbacks=[early_stopping_cb, checkpoint_cb])
+        # Restore the optimizer slots into the freshly compiled optimizer
+        training_state.optimizer = model.optimizer
+        restored = training_state.restore(training_state.state_dir) if resumed_state is not None else None
 
-        # Find the best epoch from early stopping
-        best_epoch = np.argmin(history.history['val_loss']) + 1
-
-        # Plot training and validation loss
-        plt.plot(history.history['loss'], label='Training Loss')
-        plt.plot(history.history['val_loss'], label='Validation Loss')
-        plt.xlabel('Epoch')
-        plt.ylabel('Loss')
-        plt.title('Training and Validation Loss Over Epochs')
-        plt.legend()
-        file_path = f"training_ae_plot_{str(save_tag)}.png"
-        plt.savefig(file_path)
-        plt.close()
+        if restored is None or restored['phase'] == 'search':
+            state_cb = TrainingStateCallback(training_state, 'search', early_stopping_cb, restored,
+                                             extra_state={'lambda_coef': lambda_coef})
+            # Train the model
+            history = model.fit(X_subtrain, y_dict,
+                                sample_weight=sample_weights,
+                                epochs=epochs,
+                                initial_epoch=restored['epoch'] if restored is not None else 0,
+                                batch_size=batch_size if batch_size > 0 else len(y_subtrain),
+                                validation_data=(X_val, val_y_dict, sample_val_weights),
+                                validation_batch_size=batch_size if batch_size > 0 else len(y_val),
+                                callbacks=[early_stopping_cb, checkpoint_cb, state_cb] + instrumentation_callbacks(
+                                    instrumentation, batch_size if batch_size > 0 else len(y_subtrain),
+                                    len(y_subtrain)) + profiler_callbacks(profiler))
+            history.history = state_cb.history
+
+            # Find the best epoch from early stopping
+            best_epoch = int(np.argmin(history.history['val_loss']) + 1)
+
+            # Plot training and validation loss
+            file_path = f"training_ae_plot_{str(save_tag)}.png"
+            submit_plot('lines', file_path,
+                        series={'Training Loss': history.history['loss'],
+                                'Validation Loss': history.history['val_loss']},
+                        title='Training and Validation Loss Over Epochs', xlabel='Epoch', ylabel='Loss')
+
+            training_state.save(0, 'retrain', {'search_history': history.history, 'best_epoch': best_epoch,
+                                               'lambda_coef': lambda_coef, 'history': {}})
+        else:
+            history = callbacks.History()
+            history.history = restored['search_history']
+            best_epoch = restored['best_epoch']
 
         # Retrain the model to the best epoch using combined data
+        retrain_state_cb = TrainingStateCallback(
+            training_state, 'retrain', restored=restored,
+            extra_state={'search_history': history.history, 'best_epoch': best_epoch, 'lambda_coef': lambda_coef})
         model.fit(X_train, {'regression_head': y_train, 'decoder_head': X_train},
                   sample_weight=sample_train_weights,
                   epochs=best_epoch,
+                  initial_epoch=restored['epoch'] if retrain_state_cb.restored is not None else 0,
                   batch_size=batch_size if batch_size > 0 else len(y_train),
-                  callbacks=[checkpoint_cb])
+                  callbacks=[checkpoint_cb, retrain_state_cb] + instrumentation_callbacks(
+                      instrumentation, batch_size if batch_size > 0 else len(y_train), len(y_train))
+                  + profiler_callbacks(profiler))
 
         # Save the extended model weights
         model.save_weights(f"extended_model_weights_ae_{str(save_tag)}.h5")
+        training_state.clear()
 
         return history
 
@@ -1608,8 +1940,9 @@ class ModelBuilder:
         :return: The weighted average error for all unique combinations of the samples in the batch.
         """
         int_batch_size = tf.shape(z_pred)[0]
-        batch_size = tf.cast(int_batch_size, dtype=tf.float32)
-        total_error = tf.constant(0.0, dtype=tf.float32)
+        dtype = z_pred.dtype
+        batch_size = tf.cast(int_batch_size, dtype=dtype)
+        total_error = tf.constant(0.0, dtype=dtype)
 
         # Initialize counter for sample_weights
         weight_idx = 0
@@ -1629,36 +1962,16 @@ class ModelBuilder:
                 else:
                     weighted_err = err
 
-                total_error += tf.cast(weighted_err, dtype=tf.float32)
+                total_error += tf.cast(weighted_err, dtype=dtype)
 
         if reduction == tf.keras.losses.Reduction.SUM:
             return total_error  # Total loss
         elif reduction == tf.keras.losses.Reduction.NONE:
-            denom = tf.cast(batch_size * (batch_size - 1) / 2 + 1e-9, dtype=tf.float32)
+            denom = batch_size * (batch_size - 1) / 2 + 1e-9
             return total_error / denom  # Average loss
         else:
             raise ValueError(f"Unsupported reduction type: {reduction}.")
 
-    def update_pair_counts(self, label1, label2):
-        label1 = label1[0]
-        label2 = label2[0]
-
-        is_sep_1 = label1 > np.log(10.0)
-        is_sep_2 = label2 > np.log(10.0)
-        is_elevated_1 = (label1 > np.log(10.0 / np.exp(2))) & (label1 <= np.log(10.0))
-        is_elevated_2 = (label2 > np.log(10.0 / np.exp(2))) & (label2 <= np.log(10.0))
-        is_background_1 = label1 <= np.log(10.0 / np.exp(2))
-        is_background_2 = label2 <= np.log(10.0 / np.exp(2))
-
-        self.sep_sep_count.assign_add(tf.cast(is_sep_1 & is_sep_2, tf.int32))
-        self.sep_elevated_count.assign_add(tf.cast((is_sep_1 & is_elevated_2) | (is_elevated_1 & is_sep_2), tf.int32))
-        self.sep_background_count.assign_add(
-            tf.cast((is_sep_1 & is_background_2) | (is_background_1 & is_sep_2), tf.int32))
-        self.elevated_elevated_count.assign_add(tf.cast(is_elevated_1 & is_elevated_2, tf.int32))
-        self.elevated_background_count.assign_add(
-            tf.cast((is_elevated_1 & is_background_2) | (is_background_1 & is_elevated_2), tf.int32))
-        self.background_background_count.assign_add(tf.cast(is_background_1 & is_background_2, tf.int32))
-
     def repr_loss(self, y_true, z_pred, reduction=tf.keras.losses.Reduction.NONE):
         """
         Computes the loss for a batch of predicted features and their labels.
@@ -1670,11 +1983,11 @@ class ModelBuilder:
         :return: The average error for all unique combinations of the samples in the batch.
         """
         int_batch_size = tf.shape(z_pred)[0]
-        batch_size = tf.cast(int_batch_size, dtype=tf.float32)
-        total_error = tf.constant(0.0, dtype=tf.float32)
+        dtype = z_pred.dtype
+        batch_size = tf.cast(int_batch_size, dtype=dtype)
+        total_error = tf.constant(0.0, dtype=dtype)
 
         # tf.print(" received batch size:", int_batch_size)
-        self.number_of_batches += 1
 
         # Loop through all unique pairs of samples in the batch
         for i in tf.range(int_batch_size):
@@ -1682,19 +1995,18 @@ class ModelBuilder:
                 z1, z2 = z_pred[i], z_pred[j]
                 # tf.print(z1, z2, sep=', ', end='\n')
                 label1, label2 = y_true[i], y_true[j]
-                # Update pair counts and check if it's a SEP-SEP pair
-                self.update_pair_counts(label1, label2)
+                # (pair counts are tracked by the pair type metrics, see pair_metrics)
                 # tf.print(label1, label2, sep=', ', end='\n')
                 err = error(z1, z2, label1, label2)
                 # tf.print(err, end='\n\n')
-                total_error += tf.cast(err, dtype=tf.float32)
+                total_error += tf.cast(err, dtype=dtype)
 
         # tf.print(total_error)
 
         if reduction == tf.keras.losses.Reduction.SUM:
             return total_error  # total loss
         elif reduction == tf.keras.losses.Reduction.NONE:
-            denom = tf.cast(batch_size * (batch_size - 1) / 2 + 1e-9, dtype=tf.float32)
+            denom = batch_size * (batch_size - 1) / 2 + 1e-9
             # tf.print(denom)
             return total_error / denom  # average loss
         else:
@@ -1772,6 +2084,10 @@ class NormalizeLayer(layers.Layer):
 class InvestigateCallback(callbacks.Callback):
     """
     Custom callback to evaluate the model on SEP samples at the end of each epoch.
+
+    The index sets are computed once, the SEP-SEP loss is monitored every monitor_freq batches and the pair type
+    losses every epoch_freq epochs, using vectorized pair losses. With background=True the evaluations run in a
+    worker thread on a snapshot of the weights (loaded into a clone of the model) so training is not blocked.
     """
 
     def __init__(self,
@@ -1780,7 +2096,23 @@ class InvestigateCallback(callbacks.Callback):
                  y_train: ndarray,
                  batch_size: int,
                  model_builder: ModelBuilder,
-                 save_tag: Optional[str] = None):
+                 save_tag: Optional[str] = None,
+                 monitor_freq: int = 1,
+                 epoch_freq: int = 1,
+                 background: bool = True,
+                 max_pending: int = 2):
+        """
+        :param model: The model being trained.
+        :param X_train: The training features.
+        :param y_train: The training labels.
+        :param batch_size: The training batch size.
+        :param model_builder: The ModelBuilder the model was built with.
+        :param save_tag: Tag to use for saving the plots.
+        :param monitor_freq: Evaluate the SEP-SEP loss every monitor_freq batches.
+        :param epoch_freq: Evaluate the pair type losses over the training set every epoch_freq epochs.
+        :param background: Whether to run the evaluations in a worker thread on a weight snapshot.
+        :param max_pending: Maximum number of evaluations queued before training waits for the worker.
+        """
         super().__init__()
         self.model = model
         self.X_train = X_train
@@ -1789,6 +2121,19 @@ class InvestigateCallback(callbacks.Callback):
         self.sep_threshold = np.log(10)
         self.threshold = np.log(10.0 / np.exp(2))
         self.save_tag = save_tag
+        self.monitor_freq = max(int(monitor_freq), 1)
+        self.epoch_freq = max(int(epoch_freq), 1)
+        self.background = background
+        self.max_pending = max(int(max_pending), 1)
+        # index sets are fixed for the whole training
+        self.sep_indices, self.elevated_indices, self.background_indices = self.find_sample_indices(y_train)
+        self.X_sep = X_train[self.sep_indices]
+        self.y_sep = y_train[self.sep_indices]
+        self.executor = None
+        self.shadow_model = None
+        self.pending = []  # (kind, epoch, future) in submission order
+        self.loss_epochs = []
+        self.batch_index = 0
         self.sep_sep_losses = []
         # self.losses = []
         # self.epochs_10s = []
@@ -1818,23 +2163,19 @@ class InvestigateCallback(callbacks.Callback):
         :param batch: the index of the batch within the current epoch.
         :param logs: the logs containing the metrics results.
         """
-        sep_indices = self.find_sep_samples(self.y_train)
-        if len(sep_indices) > 0:
-            X_sep = self.X_train[sep_indices]
-            y_sep = self.y_train[sep_indices]
-            # Evaluate the model on SEP samples
-            # sep_sep_loss = self.model.evaluate(X_sep, y_sep, batch_size=len(self.y_train), verbose=0)
-            sep_sep_loss = evaluate(self.model, X_sep, y_sep)
-            self.sep_sep_losses.append(sep_sep_loss)
-
         # Add the SEP-SEP count for the current batch to the cumulative count
-        batch_sep_sep_count = int(self.model_builder.sep_sep_count.numpy())
+        # (the pair count metrics are running totals over the epoch)
+        epoch_sep_sep_count = int((logs or {}).get('sep_sep_count', 0))
+        batch_sep_sep_count = epoch_sep_sep_count - self.sep_sep_count
         print(f'end of batch: {batch}, sep_sep_count: {batch_sep_sep_count} in')
-        self.sep_sep_count += batch_sep_sep_count
+        self.sep_sep_count = epoch_sep_sep_count
         self.cumulative_sep_sep_count += batch_sep_sep_count
-        self.cumulative_sep_sep_counts.append(self.cumulative_sep_sep_count)
-        # Reset for next batch
-        self.model_builder.sep_sep_count.assign(0)
+
+        self.batch_index += 1
+        if len(self.sep_indices) > 0 and self.batch_index % self.monitor_freq == 0:
+            # Evaluate the model on SEP samples (the loss is matched with the cumulative count at this batch)
+            self.cumulative_sep_sep_counts.append(self.cumulative_sep_sep_count)
+            self.submit('sep_sep', None, self.X_sep, self.y_sep)
 
     def on_epoch_begin(self, epoch, logs=None):
         """
@@ -1843,16 +2184,9 @@ class InvestigateCallback(callbacks.Callback):
         :param epoch: the index of the epoch.
         :param logs: the logs containing the metrics results.
         """
-        # Resetting the counts
+        # Resetting the counts (the metrics are reset by fit at the beginning of each epoch)
         self.sep_sep_count = 0
         self.cumulative_sep_sep_count = 0
-        self.model_builder.sep_sep_count.assign(0)
-        self.model_builder.sep_elevated_count.assign(0)
-        self.model_builder.sep_background_count.assign(0)
-        self.model_builder.elevated_elevated_count.assign(0)
-        self.model_builder.elevated_background_count.assign(0)
-        self.model_builder.background_background_count.assign(0)
-        self.model_builder.number_of_batches = 0
 
     def on_epoch_end(self, epoch, logs=None):
         # Find SEP samples
@@ -1868,17 +2202,12 @@ class InvestigateCallback(callbacks.Callback):
         self.collect_losses(epoch)
 
         # Save the current counts
+        logs = logs or {}
+        self.sep_sep_count = int(logs.get('sep_sep_count', self.sep_sep_count))
         self.sep_sep_counts.append(self.sep_sep_count)
-        total_count = (
-                self.sep_sep_count +
-                int(self.model_builder.sep_elevated_count.numpy()) +
-                int(self.model_builder.sep_background_count.numpy()) +
-                int(self.model_builder.elevated_elevated_count.numpy()) +
-                int(self.model_builder.elevated_background_count.numpy()) +
-                int(self.model_builder.background_background_count.numpy())
-        )
+        total_count = int(sum(logs.get(f"{pair_type}_count", 0) for pair_type in PAIR_TYPES))
         self.total_counts.append(total_count)
-        self.batch_counts.append(self.model_builder.number_of_batches)
+        self.batch_counts.append(int(logs.get('number_of_batches', 0)))
 
         # Calculate and save the percentage of SEP-SEP pairs
         if total_count > 0:
@@ -1887,14 +2216,7 @@ class InvestigateCallback(callbacks.Callback):
             self.sep_sep_percentages.append(0)
 
         # Reset the counts for the next epoch
-        # self.model_builder.sep_sep_count.assign(0)
-        self.model_builder.sep_elevated_count.assign(0)
-        self.model_builder.sep_background_count.assign(0)
-        self.model_builder.elevated_elevated_count.assign(0)
-        self.model_builder.elevated_background_count.assign(0)
-        self.model_builder.background_background_count.assign(0)
         self.sep_sep_count = 0
-        self.model_builder.number_of_batches = 0
 
         # if epoch % 10 == 9:  # every 10th epoch (considering the first epoch is 0)
         #     loss = self.model.evaluate(self.X_train, self.y_train, batch_size=len(self.y_train), verbose=0)
@@ -1907,9 +2229,19 @@ class InvestigateCallback(callbacks.Callback):
 
         :param epoch: Current epoch number.
         """
+        if epoch % self.epoch_freq != self.epoch_freq - 1:
+            return
         # Evaluate the model and get losses for each pair type, including overall
-        pair_losses = evaluate(self.model, self.X_train, self.y_train, pairs=True)
+        self.loss_epochs.append(epoch + 1)
+        self.submit('pairs', epoch, self.X_train, self.y_train)
 
+    def store_losses(self, epoch: int, pair_losses: dict) -> None:
+        """
+        Stores and prints the losses for each pair type and overall loss of an epoch.
+
+        :param epoch: The epoch the losses were evaluated at.
+        :param pair_losses: The losses returned by repr_loss_eval_pairs.
+        """
         # Store and print pair type losses
         for pair_type, loss in pair_losses.items():
             if pair_type != 'overall':  # Exclude overall loss here
@@ -1921,7 +2253,67 @@ class InvestigateCallback(callbacks.Callback):
         self.overall_losses.append(overall_loss)
         print(f"Epoch {epoch + 1}, Overall Loss: {overall_loss}")
 
+    def on_train_begin(self, logs=None):
+        if self.background and self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1)
+            self.shadow_model = tf.keras.models.clone_model(self.model)
+
+    def submit(self, kind: str, epoch: Optional[int], X: ndarray, y: ndarray) -> None:
+        """
+        Queues an evaluation of the current weights, in the worker thread if background is set.
+
+        :param kind: 'sep_sep' for the SEP-SEP loss or 'pairs' for the pair type losses.
+        :param epoch: The epoch of a 'pairs' evaluation.
+        :param X: The features to evaluate on.
+        :param y: The labels to evaluate on.
+        """
+        if self.executor is None:
+            self.pending.append((kind, epoch, self.evaluate_snapshot(kind, None, X, y)))
+        else:
+            # Bound the number of queued snapshots so a slow evaluation cannot pile up memory
+            while sum(not future.done() for _, _, future in self.pending) >= self.max_pending:
+                next(future for _, _, future in self.pending if not future.done()).result()
+            weights = self.model.get_weights()
+            self.pending.append((kind, epoch, self.executor.submit(self.evaluate_snapshot, kind, weights, X, y)))
+        self.drain(block=False)
+
+    def evaluate_snapshot(self, kind: str, weights: Optional[List[ndarray]], X: ndarray, y: ndarray):
+        """
+        Evaluates a weight snapshot (or the live model if weights is None).
+
+        :return: The SEP-SEP loss or the dictionary of pair type losses.
+        """
+        model = self.model
+        if weights is not None:
+            self.shadow_model.set_weights(weights)
+            model = self.shadow_model
+        z_pred = model.predict(X, batch_size=len(X), verbose=0)
+        pair_losses = repr_loss_eval_pairs(y, z_pred)
+        return pair_losses['overall'] if kind == 'sep_sep' else pair_losses
+
+    def drain(self, block: bool = True) -> None:
+        """
+        Collects the finished evaluations in submission order.
+
+        :param block: Whether to wait for all the queued evaluations.
+        """
+        while self.pending:
+            kind, epoch, result = self.pending[0]
+            if isinstance(result, Future):
+                if not block and not result.done():
+                    break
+                result = result.result()
+            self.pending.pop(0)
+            if kind == 'sep_sep':
+                self.sep_sep_losses.append(result)
+            else:
+                self.store_losses(epoch, result)
+
     def on_train_end(self, logs=None):
+        self.drain()
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
         # At the end of training, save the loss plot
         # self.save_loss_plot()
         # self._save_plot()
@@ -1987,69 +2379,45 @@ class InvestigateCallback(callbacks.Callback):
         """
         Saves a combined plot of the losses for each pair type and the overall loss as separate subplots.
         """
-        epochs = range(1, len(self.overall_losses) + 1)
+        epochs = self.loss_epochs[:len(self.overall_losses)]
         pair_types = list(self.pair_type_losses.keys()) + ['overall']
-        num_subplots = len(pair_types)
         colors = ['blue', 'green', 'red', 'cyan', 'magenta', 'yellow', 'black']  # Different colors for each subplot
 
-        plt.figure(figsize=(15, 10))  # Adjust the figure size as needed
-        for i, pair_type in enumerate(pair_types):
-            plt.subplot(num_subplots, 1, i + 1)
-            losses = self.pair_type_losses[pair_type] if pair_type != 'overall' else self.overall_losses
-            plt.plot(epochs, losses, '-o', label=f'{pair_type} Loss', color=colors[i], markersize=3)
-            plt.title(f'{pair_type} Loss')
-            plt.xlabel('Epoch')
-            plt.ylabel('Loss')
-            plt.legend()
-            plt.grid(True)
-
-        plt.tight_layout()  # Adjust subplots to fit into the figure area.
+        panels = [{'x': epochs,
+                   'y': self.pair_type_losses[pair_type] if pair_type != 'overall' else self.overall_losses,
+                   'label': f'{pair_type} Loss', 'title': f'{pair_type} Loss', 'color': colors[i]}
+                  for i, pair_type in enumerate(pair_types)]
 
         file_name = f"combined_loss_plot_{self.save_tag}.png" if self.save_tag else "combined_loss_plot.png"
         file_path = f"./investigation/{file_name}"
-        plt.savefig(file_path)
-        plt.close()
+        submit_plot('subplot_lines', file_path, panels=panels, xlabel='Epoch', ylabel='Loss')
         print(f"Saved combined loss plot at {file_path}")
 
     def save_percent_plot(self):
         # Plot the percentage of SEP-SEP pairs per epoch
         epochs = list(range(1, len(self.sep_sep_percentages) + 1))
-        plt.figure()
-        plt.plot(epochs, self.sep_sep_percentages, '-o', label='Percentage of SEP-SEP Pairs', markersize=3)
-        plt.title(f'Percentage of SEP-SEP Pairs Per Epoch, Batch Size {self.batch_size}')
-        plt.xlabel('Epoch')
-        plt.ylabel('Percentage')
-        plt.legend()
-        plt.grid(True)
-        # plt.show()  # or save the figure if preferred
         if self.save_tag:
             file_path = f"./investigation/percent_sep_sep_plot_{str(self.save_tag)}.png"
         else:
             file_path = f"./investigation/percent_sep_sep_plot.png"
-        plt.savefig(file_path)
-        plt.close()
+        submit_plot('lines', file_path,
+                    series={'Percentage of SEP-SEP Pairs': (epochs, self.sep_sep_percentages)},
+                    title=f'Percentage of SEP-SEP Pairs Per Epoch, Batch Size {self.batch_size}',
+                    xlabel='Epoch', ylabel='Percentage', style='-o', grid=True)
         print(f"Saved plot at {file_path}")
 
     def save_sep_sep_loss_vs_frequency(self) -> None:
         """
         Plots the SEP-SEP loss against the SEP-SEP counts at the end of training.
         """
-        plt.figure()
-        plt.scatter(self.cumulative_sep_sep_counts, self.sep_sep_losses, c='blue', label='SEP-SEP Loss vs Frequency',
-                    s=9)
-        plt.title(f'SEP-SEP Loss vs Frequency, Batch Size {self.batch_size}')
-        plt.xlabel('SEP-SEP Frequency')
-        plt.ylabel('SEP-SEP Loss')
-        plt.legend()
-        plt.grid(True)
-
         if self.save_tag:
             file_path = f"./investigation/sep_sep_loss_vs_frequency_{self.save_tag}.png"
         else:
             file_path = "./investigation/sep_sep_loss_vs_frequency.png"
 
-        plt.savefig(file_path)
-        plt.close()
+        submit_plot('scatter', file_path, x=self.cumulative_sep_sep_counts, y=self.sep_sep_losses,
+                    label='SEP-SEP Loss vs Frequency', title=f'SEP-SEP Loss vs Frequency, Batch Size {self.batch_size}',
+                    xlabel='SEP-SEP Frequency', ylabel='SEP-SEP Loss')
         print(f"Saved SEP-SEP Loss vs Counts plot at {file_path}")
 
     def save_slope_of_loss_vs_frequency(self) -> None:
@@ -2070,21 +2438,15 @@ class InvestigateCallback(callbacks.Callback):
         # Prepare the epochs for x-axis, which are one less than the number of losses due to diff operation
         epochs = range(1, len(self.sep_sep_losses))
 
-        plt.figure()
-        plt.plot(epochs, slopes, '-o', label='Slope of SEP-SEP Loss vs Frequency', markersize=3)
-        plt.title(f'Slope of SEP-SEP Loss vs Frequency Change Per Epoch, Batch Size {self.batch_size}')
-        plt.xlabel('Epoch')
-        plt.ylabel('Slope')
-        plt.legend()
-        plt.grid(True)
-
         if self.save_tag:
             file_path = f"./investigation/slope_sep_sep_loss_vs_frequency_{self.save_tag}.png"
         else:
             file_path = "./investigation/slope_sep_sep_loss_vs_frequency.png"
 
-        plt.savefig(file_path)
-        plt.close()
+        submit_plot('lines', file_path,
+                    series={'Slope of SEP-SEP Loss vs Frequency': (epochs, slopes)},
+                    title=f'Slope of SEP-SEP Loss vs Frequency Change Per Epoch, Batch Size {self.batch_size}',
+                    xlabel='Epoch', ylabel='Slope', style='-o', grid=True)
         print(f"Saved Slope of Loss vs Counts plot at {file_path}")
 
     # def _save_plot(self):
@@ -2123,6 +2485,99 @@ class InvestigateCallback(callbacks.Callback):
     #     print(f"Saved SEP loss plot at {file_path}")
 
 
+# pair type index of the code class1 * 3 + class2 (classes 0: SEP, 1: elevated, 2: background)
+PAIR_CODE_TO_TYPE = np.array([0, 1, 2, 1, 3, 4, 2, 4, 5])
+
+
+def label_classes(y: ndarray, sep_threshold: Optional[float] = None,
+                  elevated_threshold: Optional[float] = None) -> ndarray:
+    """
+    Classifies labels as SEP (0), elevated (1) or background (2), with the thresholds of determine_pair_type.
+
+    :param y: The labels.
+    :param sep_threshold: The threshold to classify SEP samples.
+    :param elevated_threshold: The threshold to classify elevated samples.
+    :return: An int8 array of the classes.
+    """
+    if sep_threshold is None:
+        sep_threshold = np.log(10)
+
+    if elevated_threshold is None:
+        elevated_threshold = np.log(10.0 / np.exp(2))
+
+    y = np.asarray(y).reshape(-1)
+    classes = np.full(len(y), 2, dtype=np.int8)
+    classes[y > elevated_threshold] = 1
+    classes[y > sep_threshold] = 0
+    return classes
+
+
+def tile_code_sums(y: ndarray, z: ndarray, squared_norms: ndarray, classes: ndarray,
+                   i: int, j: int, block_size: int) -> Tuple[ndarray, ndarray]:
+    """
+    Sums the pair errors of one tile of pairs (rows of block i, columns of block j) per class-pair code.
+
+    :param y: The labels, shape of [n], float64.
+    :param z: The representations, shape of [n, d], float64.
+    :param squared_norms: The squared norms of the representations.
+    :param classes: The classes of the labels (see label_classes).
+    :param i: The first index of the row block.
+    :param j: The first index of the column block (j >= i).
+    :param block_size: The number of samples per block.
+    :return: The error sums and the pair counts per code class1 * 3 + class2.
+    """
+    z_dist = (squared_norms[i:i + block_size, None] + squared_norms[None, j:j + block_size]
+              - 2 * z[i:i + block_size] @ z[j:j + block_size].T)
+    y_dist = (y[i:i + block_size, None] - y[None, j:j + block_size]) ** 2
+    errors = .5 * (np.maximum(z_dist, 0) - y_dist) ** 2
+    codes = classes[i:i + block_size, None] * 3 + classes[None, j:j + block_size]
+    if i == j:
+        # diagonal block, keep the pairs above the diagonal only
+        upper = np.triu(np.ones(errors.shape, dtype=bool), k=1)
+        errors, codes = errors[upper], codes[upper]
+    return (np.bincount(codes.ravel(), weights=errors.ravel(), minlength=9),
+            np.bincount(codes.ravel(), minlength=9))
+
+
+def pair_error_sums(y: ndarray, z: ndarray, block_size: int = 2048,
+                    n_threads: int = 1) -> Tuple[ndarray, ndarray]:
+    """
+    Sums the pair errors (see error) over all unique pairs, per pair type, without Python loops over pairs.
+    The pairs are streamed in tiles of block_size x block_size to bound the memory, with float64 accumulators.
+
+    :param y: The labels, shape of [n] or [n, 1].
+    :param z: The representations, shape of [n, d].
+    :param block_size: The number of samples per block.
+    :param n_threads: Number of threads processing the tiles (NumPy releases the GIL in the matrix products).
+    :return: The error sums and the pair counts per pair type (in the order of PAIR_TYPES).
+    """
+    y = np.asarray(y, dtype=np.float64).reshape(-1)
+    z = np.asarray(z, dtype=np.float64).reshape(len(y), -1)
+    classes = label_classes(y)
+    squared_norms = np.sum(z ** 2, axis=1)
+    code_sums = np.zeros(9)
+    code_counts = np.zeros(9, dtype=np.int64)
+
+    tiles = [(i, j) for i in range(0, len(y), block_size) for j in range(i, len(y), block_size)]
+
+    def process(tile):
+        return tile_code_sums(y, z, squared_norms, classes, tile[0], tile[1], block_size)
+
+    if n_threads > 1 and len(tiles) > 1:
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            results = list(executor.map(process, tiles))
+    else:
+        results = map(process, tiles)
+
+    for tile_sums, tile_counts in results:
+        code_sums += tile_sums
+        code_counts += tile_counts
+
+    sums = np.bincount(PAIR_CODE_TO_TYPE, weights=code_sums, minlength=len(PAIR_TYPES))
+    counts = np.bincount(PAIR_CODE_TO_TYPE, weights=code_counts, minlength=len(PAIR_TYPES)).astype(np.int64)
+    return sums, counts
+
+
 def repr_loss_eval(y_true, z_pred, reduction='none'):
     """
     Computes the loss for a batch of predicted features and their labels.
@@ -2133,19 +2588,8 @@ def repr_loss_eval(y_true, z_pred, reduction='none'):
     :return: The average error for all unique combinations of the samples in the batch.
     """
     int_batch_size = len(z_pred)
-    total_error = 0.0
-
-    # print("received batch size in custom eval:", int_batch_size)
-
-    # Loop through all unique pairs of samples in the batch
-    for i in range(int_batch_size):
-        for j in range(i + 1, int_batch_size):
-            z1, z2 = z_pred[i], z_pred[j]
-            label1, label2 = y_true[i], y_true[j]
-            # Update pair counts (implement this function as needed)
-            # update_pair_counts(label1, label2)
-            err = error(z1, z2, label1, label2)  # Make sure 'error' function uses NumPy or standard Python
-            total_error += err
+    pair_sums, _ = pair_error_sums(y_true, z_pred)
+    total_error = np.sum(pair_sums)
 
     if reduction == 'sum':
         return total_error  # total loss
@@ -2167,31 +2611,10 @@ def repr_loss_eval_pairs(y_true, z_pred, reduction='none'):
     :return: A dictionary containing the average errors for all pair types and overall.
     """
     int_batch_size = len(z_pred)
-    total_error = 0.0
-    pair_errors = {
-        'sep_sep': 0.0,
-        'sep_elevated': 0.0,
-        'sep_background': 0.0,
-        'elevated_elevated': 0.0,
-        'elevated_background': 0.0,
-        'background_background': 0.0
-    }
-    pair_counts = {key: 0 for key in pair_errors.keys()}
-
-    # print("Received batch size in custom eval:", int_batch_size)
-
-    # Loop through all unique pairs of samples in the batch
-    for i in range(int_batch_size):
-        for j in range(i + 1, int_batch_size):
-            z1, z2 = z_pred[i], z_pred[j]
-            label1, label2 = y_true[i], y_true[j]
-
-            # Determine the pair type
-            pair_type = determine_pair_type(label1, label2)  # Implement this function
-            err = error(z1, z2, label1, label2)  # Make sure 'error' function uses NumPy or standard Python
-            pair_errors[pair_type] += err
-            pair_counts[pair_type] += 1
-            total_error += err
+    pair_sums, pair_counts = pair_error_sums(y_true, z_pred)
+    pair_errors = dict(zip(PAIR_TYPES, pair_sums))
+    pair_counts = dict(zip(PAIR_TYPES, pair_counts))
+    total_error = np.sum(pair_sums)
 
     # Apply reduction
     if reduction == 'sum':
@@ -2212,34 +2635,46 @@ def determine_pair_type(label1, label2, sep_threshold=None, elevated_threshold=N
     """
     Determines the pair type based on the labels.
 
-    :param label1: The label of the first sample.
-    :param label2: The label of the second sample.
+    :param label1: The label of the first sample (or an array of labels).
+    :param label2: The label of the second sample (or an array of labels).
     :param sep_threshold: The threshold to classify SEP samples.
     :param elevated_threshold: The threshold to classify elevated samples.
-    :return: A string representing the pair type.
+    :return: A string representing the pair type (an array of strings for arrays of labels).
     """
+    classes1 = label_classes(np.atleast_1d(label1), sep_threshold, elevated_threshold)
+    classes2 = label_classes(np.atleast_1d(label2), sep_threshold, elevated_threshold)
+    pair_types = np.array(PAIR_TYPES)[PAIR_CODE_TO_TYPE[classes1 * 3 + classes2]]
+    return str(pair_types[0]) if pair_types.size == 1 else pair_types
 
-    if sep_threshold is None:
-        sep_threshold = np.log(10)
 
-    if elevated_threshold is None:
-        elevated_threshold = np.log(10.0 / np.exp(2))
+def evaluate_exact(model, X, y, pairs=False, predict_batch_size=1024, block_size=2048, n_threads=1):
+    """
+    Exact loss over all the pairs of the dataset, independent of any batch size.
+    The representations are predicted once (in chunks), then all the pairs are streamed in tiles with
+    float64 accumulators, so the memory is bounded by the tile size.
 
-    if label1 > sep_threshold and label2 > sep_threshold:
-        return 'sep_sep'
-    elif (label1 > sep_threshold and label2 > elevated_threshold) or (
-            label2 > sep_threshold and label1 > elevated_threshold):
-        return 'sep_elevated'
-    elif (label1 > sep_threshold and label2 <= elevated_threshold) or (
-            label2 > sep_threshold and label1 <= elevated_threshold):
-        return 'sep_background'
-    elif label1 > elevated_threshold and label2 > elevated_threshold:
-        return 'elevated_elevated'
-    elif (label1 > elevated_threshold >= label2) or (
-            label2 > elevated_threshold >= label1):
-        return 'elevated_background'
-    else:
-        return 'background_background'
+    :param model: The trained model.
+    :param X: Input features.
+    :param y: True labels.
+    :param pairs: If True, returns the losses of each pair type along with the overall loss.
+    :param predict_batch_size: Number of samples per prediction chunk.
+    :param block_size: Number of samples per tile side.
+    :param n_threads: Number of threads processing the tiles.
+    :return: The global mean loss, or a dictionary of the mean losses for each pair type and overall.
+    """
+    # representations are the first output of the models with heads
+    z_pred = cached_predict(model, X, head=0, batch_size=predict_batch_size)
+
+    n = len(z_pred)
+    pair_sums, pair_counts = pair_error_sums(y, z_pred, block_size=block_size, n_threads=n_threads)
+    overall = np.sum(pair_sums) / (n * (n - 1) / 2 + 1e-9)
+    if not pairs:
+        return overall
+
+    pair_losses = {pair_type: pair_sums[k] / pair_counts[k] if pair_counts[k] > 0 else 0
+                   for k, pair_type in enumerate(PAIR_TYPES)}
+    pair_losses['overall'] = overall
+    return pair_losses
 
 
 def evaluate(model, X, y, batch_size=-1, pairs=False):
@@ -2249,13 +2684,13 @@ def evaluate(model, X, y, batch_size=-1, pairs=False):
     :param model: The trained model.
     :param X: Input features.
     :param y: True labels.
-    :param batch_size: Size of the batch, use the whole dataset if batch_size <= 0.
+    :param batch_size: Size of the batch, use the whole dataset if batch_size <= 0 (exact loss over all the pairs,
+                       see evaluate_exact). With batch_size > 0, only the pairs within each batch are scored.
     :param pairs: If True, uses repr_loss_eval_pairs to evaluate loss on pairs.
     :return: Calculated loss over the dataset or a dictionary of losses for each pair type.
     """
     if batch_size <= 0:
-        z_pred = model.predict(X)
-        return repr_loss_eval_pairs(y, z_pred) if pairs else repr_loss_eval(y, z_pred)
+        return evaluate_exact(model, X, y, pairs=pairs)
 
     total_loss = 0
     pair_losses = {key: 0.0 for key in
@@ -0,0 +1,196 @@
+##############################################################################################################
+# Description: in-graph streaming pair type accounting (SEP, elevated, background) as Keras metrics.
+# samples are classified once per batch and the pair counts are derived from the class counts, e.g.
+# with (s, e, b) samples per class in a batch, there are s(s-1)/2 SEP-SEP pairs and s*e SEP-elevated pairs.
+##############################################################################################################
+# types for type hinting
+from typing import List, Optional
+
+import numpy as np
+# imports
+import tensorflow as tf
+from tensorflow.keras import metrics
+
+# pair types in the order of the pair type index
+PAIR_TYPES = ['sep_sep', 'sep_elevated', 'sep_background', 'elevated_elevated', 'elevated_background',
+              'background_background']
+# the two classes (0: SEP, 1: elevated, 2: background) of each pair type
+PAIR_TYPE_CLASSES = [(0, 0), (0, 1), (0, 2), (1, 1), (1, 2), (2, 2)]
+
+
+def class_one_hot(y_true: tf.Tensor,
+                  sep_threshold: Optional[float] = None,
+                  elevated_threshold: Optional[float] = None) -> tf.Tensor:
+    """
+    Classifies the labels of a batch as SEP, elevated or background.
+
+    :param y_true: A batch of true label values, shape of [batch_size] or [batch_size, 1].
+    :param sep_threshold: The threshold to classify SEP samples. Default is ln(10).
+    :param elevated_threshold: The threshold to classify elevated samples. Default is ln(10 / e^2).
+    :return: A float32 one-hot tensor of shape [batch_size, 3] (SEP, elevated, background).
+    """
+    if sep_threshold is None:
+        sep_threshold = np.log(10)
+
+    if elevated_threshold is None:
+        elevated_threshold = np.log(10.0 / np.exp(2))
+
+    y = tf.reshape(tf.cast(y_true, tf.float32), [-1])
+    is_sep = y > sep_threshold
+    is_elevated = (y > elevated_threshold) & ~is_sep
+    is_background = ~(is_sep | is_elevated)
+    return tf.cast(tf.stack([is_sep, is_elevated, is_background], axis=1), tf.float32)
+
+
+def pair_counts_from_class_counts(class_counts: tf.Tensor) -> tf.Tensor:
+    """
+    Number of unique pairs of each pair type given the number of samples of each class.
+
+    :param class_counts: A tensor [s, e, b] of the number of SEP, elevated and background samples
+                         (int64 for exact counts).
+    :return: A tensor of the six pair counts, in the order of PAIR_TYPES.
+    """
+    s, e, b = class_counts[0], class_counts[1], class_counts[2]
+    return tf.stack([s * (s - 1) // 2, s * e, s * b, e * (e - 1) // 2, e * b, b * (b - 1) // 2])
+
+
+def class_counts_of(one_hot: tf.Tensor) -> tf.Tensor:
+    """
+    Number of samples of each class of a batch as int64 (the pair counts overflow the float32 integers).
+    """
+    return tf.cast(tf.reduce_sum(one_hot, axis=0), tf.int64)
+
+
+def pair_error_sums(y_true: tf.Tensor, z_pred: tf.Tensor, one_hot: tf.Tensor) -> tf.Tensor:
+    """
+    Sum of the pair errors (see modeling.error) of each pair type with masked reductions:
+    the class-by-class sums are one_hot^T E one_hot for the pairwise error matrix E.
+
+    :param y_true: A batch of true label values, shape of [batch_size, 1].
+    :param z_pred: A batch of predicted Z values, shape of [batch_size, d].
+    :param one_hot: The classes of the batch as returned by class_one_hot.
+    :return: A tensor of the six error sums, in the order of PAIR_TYPES.
+    """
+    y = tf.reshape(tf.cast(y_true, tf.float32), [-1, 1])
+    z = tf.cast(z_pred, tf.float32)
+    squared_norms = tf.reduce_sum(tf.square(z), axis=1, keepdims=True)
+    z_dist = tf.maximum(squared_norms + tf.transpose(squared_norms) - 2 * tf.matmul(z, z, transpose_b=True), 0.)
+    y_dist = tf.square(y - tf.transpose(y))
+    errors = .5 * tf.square(z_dist - y_dist)
+    errors = tf.linalg.set_diag(errors, tf.zeros_like(y[:, 0]))
+    class_sums = tf.matmul(one_hot, tf.matmul(errors, one_hot), transpose_a=True)
+    # the error matrix is symmetric: same class pairs appear twice on the diagonal blocks
+    return tf.stack([class_sums[i, j] / 2 if i == j else class_sums[i, j] for i, j in PAIR_TYPE_CLASSES])
+
+
+class PairTypeCount(metrics.Metric):
+    """
+    Streaming count of the unique in-batch pairs of a pair type, at O(batch_size) cost per batch.
+    """
+
+    def __init__(self, pair_type: str, name: Optional[str] = None, **kwargs):
+        """
+        :param pair_type: One of PAIR_TYPES.
+        :param name: Name of the metric. Default is {pair_type}_count.
+        """
+        super().__init__(name=name or f"{pair_type}_count", **kwargs)
+        self.pair_type = pair_type
+        self.type_index = PAIR_TYPES.index(pair_type)
+        self.count = self.add_weight(name='count', initializer='zeros', dtype=tf.int64)
+
+    def update_state(self, y_true, y_pred, sample_weight=None):
+        class_counts = class_counts_of(class_one_hot(y_true))
+        self.count.assign_add(pair_counts_from_class_counts(class_counts)[self.type_index])
+
+    def result(self):
+        return self.count
+
+    def reset_state(self):
+        self.count.assign(0)
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({'pair_type': self.pair_type})
+        return config
+
+
+class PairTypeLoss(metrics.Metric):
+    """
+    Streaming mean pair error of a pair type over the in-batch pairs.
+    """
+
+    def __init__(self, pair_type: str, name: Optional[str] = None, **kwargs):
+        """
+        :param pair_type: One of PAIR_TYPES.
+        :param name: Name of the metric. Default is {pair_type}_loss.
+        """
+        super().__init__(name=name or f"{pair_type}_loss", **kwargs)
+        self.pair_type = pair_type
+        self.type_index = PAIR_TYPES.index(pair_type)
+        # float64 total and int64 count accumulators (the per batch sums stay in float32)
+        self.total = self.add_weight(name='total', initializer='zeros', dtype=tf.float64)
+        self.count = self.add_weight(name='count', initializer='zeros', dtype=tf.int64)
+
+    def update_state(self, y_true, y_pred, sample_weight=None):
+        one_hot = class_one_hot(y_true)
+        self.total.assign_add(tf.cast(pair_error_sums(y_true, y_pred, one_hot)[self.type_index], tf.float64))
+        self.count.assign_add(pair_counts_from_class_counts(class_counts_of(one_hot))[self.type_index])
+
+    def result(self):
+        return tf.math.divide_no_nan(self.total, tf.cast(self.count, tf.float64))
+
+    def reset_state(self):
+        self.total.assign(0.)
+        self.count.assign(0)
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({'pair_type': self.pair_type})
+        return config
+
+
+class BatchCount(metrics.Metric):
+    """
+    Streaming number of batches seen (replaces the Python counter incremented inside the traced loss).
+    """
+
+    def __init__(self, name: str = 'number_of_batches', **kwargs):
+        super().__init__(name=name, **kwargs)
+        self.count = self.add_weight(name='count', initializer='zeros', dtype=tf.int64)
+
+    def update_state(self, y_true, y_pred, sample_weight=None):
+        self.count.assign_add(1)
+
+    def result(self):
+        return self.count
+
+    def reset_state(self):
+        self.count.assign(0)
+
+
+def pair_type_metrics(counts: bool = True, losses: bool = False) -> List[metrics.Metric]:
+    """
+    The pair type metrics to pass to model.compile.
+
+    :param counts: Whether to include the six pair counts and the number of batches.
+    :param losses: Whether to include the six per type mean losses (O(batch_size^2) like the loss itself).
+    :return: The list of metrics.
+    """
+    metric_list = []
+    if counts:
+        metric_list += [PairTypeCount(pair_type) for pair_type in PAIR_TYPES] + [BatchCount()]
+    if losses:
+        metric_list += [PairTypeLoss(pair_type) for pair_type in PAIR_TYPES]
+    return metric_list
+
+
+def pair_counts_from_history(history: dict) -> dict:
+    """
+    Total pair counts and number of batches over the training epochs of a fit history.
+
+    :param history: The history dictionary (History.history) of a fit compiled with pair_type_metrics.
+    :return: A dictionary mapping sep_sep, ..., background_background and number_of_batches to totals.
+    """
+    totals = {pair_type: int(np.sum(history.get(f"{pair_type}_count", []))) for pair_type in PAIR_TYPES}
+    totals['number_of_batches'] = int(np.sum(history.get('number_of_batches', [])))
+    return totals
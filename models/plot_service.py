@@ -0,0 +1,498 @@
+##############################################################################################################
+# Description: off-critical-path plotting. The training and evaluation code enqueues plain arrays and a
+# plot kind, and a worker process renders them with the Agg backend, reusing one figure per plot kind.
+# The PLOT_MODE environment variable (or set_plot_mode) switches between background, sync, defer and skip.
+##############################################################################################################
+import atexit
+import os
+import pickle
+import subprocess
+import sys
+# types for type hinting
+from typing import Optional, Dict, List, Tuple, Callable, Any, BinaryIO
+
+import mlflow
+import numpy as np
+
+PLOT_MODES = ('background', 'sync', 'defer', 'skip')
+
+# default figure size of each plot kind
+FIGURE_SIZES = {
+    'lines': (6.4, 4.8),
+    'subplot_lines': (15, 10),
+    'scatter': (6.4, 4.8),
+    'bars': (12, 6),
+    'actual_vs_predicted': (10, 10),
+    'intensity_scatter': (12, 8),
+}
+
+
+def render_lines(fig, series: Dict[str, Any], title: str = '', xlabel: str = '', ylabel: str = '',
+                 style: str = '-', markersize: float = 3, grid: bool = False,
+                 vlines: Optional[List[float]] = None) -> None:
+    """
+    Line plot of one or more series.
+
+    :param fig: The figure to draw on.
+    :param series: A dictionary mapping the label to y values, or to a (x, y) tuple.
+    :param title: The title.
+    :param xlabel: The x-axis label.
+    :param ylabel: The y-axis label.
+    :param style: The line style of the series (e.g. '-o').
+    :param markersize: The marker size.
+    :param grid: Whether to draw a grid.
+    :param vlines: x positions of dashed vertical lines (e.g. thresholds).
+    """
+    ax = fig.add_subplot(1, 1, 1)
+    for label, values in series.items():
+        if isinstance(values, tuple):
+            ax.plot(values[0], values[1], style, label=label, markersize=markersize)
+        else:
+            ax.plot(values, style, label=label, markersize=markersize)
+    for x in ([] if vlines is None else vlines):
+        ax.axvline(x, color='gray', linestyle='--', linewidth=0.8)
+    ax.set_title(title)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    ax.legend()
+    ax.grid(grid)
+
+
+def render_subplot_lines(fig, panels: List[Dict[str, Any]], xlabel: str = '', ylabel: str = '') -> None:
+    """
+    One line plot per row of subplots.
+
+    :param fig: The figure to draw on.
+    :param panels: A list of dictionaries with the keys 'x', 'y', 'label', 'title' and 'color'.
+    :param xlabel: The x-axis label of every panel.
+    :param ylabel: The y-axis label of every panel.
+    """
+    for i, panel in enumerate(panels):
+        ax = fig.add_subplot(len(panels), 1, i + 1)
+        ax.plot(panel['x'], panel['y'], '-o', label=panel['label'], color=panel.get('color'), markersize=3)
+        ax.set_title(panel['title'])
+        ax.set_xlabel(xlabel)
+        ax.set_ylabel(ylabel)
+        ax.legend()
+        ax.grid(True)
+    fig.tight_layout()
+
+
+def render_scatter(fig, x: np.ndarray, y: np.ndarray, label: str = '', title: str = '', xlabel: str = '',
+                   ylabel: str = '', color: str = 'blue', size: float = 9, grid: bool = True) -> None:
+    """
+    Scatter plot of y against x.
+    """
+    ax = fig.add_subplot(1, 1, 1)
+    ax.scatter(x, y, c=color, label=label, s=size)
+    ax.set_title(title)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    ax.legend()
+    ax.grid(grid)
+
+
+def render_bars(fig, values: np.ndarray, tick_labels: List[str], title: str = '', xlabel: str = '',
+                ylabel: str = '') -> None:
+    """
+    Bar chart with one labeled bar per value.
+    """
+    ax = fig.add_subplot(1, 1, 1)
+    ax.bar(range(len(values)), values, tick_label=tick_labels)
+    ax.set_title(title)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    ax.tick_params(axis='x', labelrotation=45)
+
+
+def render_actual_vs_predicted(fig, y_true: np.ndarray, y_pred: np.ndarray, threshold: float,
+                               lower_threshold: float, title: str = '') -> None:
+    """
+    Predicted against actual ln peak intensity, colored by event class (background, elevated, SEP).
+    """
+    ax = fig.add_subplot(1, 1, 1)
+    is_sep = y_true > threshold
+    is_background = y_true <= lower_threshold
+    is_elevated = ~(is_sep | is_background)
+    ax.scatter(y_true[is_background], y_pred[is_background], c='b', alpha=0.5, label='Background')
+    ax.scatter(y_true[is_elevated], y_pred[is_elevated], c='g', alpha=0.5, label='Elevated')
+    ax.scatter(y_true[is_sep], y_pred[is_sep], c='r', alpha=0.5, label='SEP')
+    ax.axhline(threshold, color='gray', linestyle='--', linewidth=0.8)
+    ax.axvline(threshold, color='gray', linestyle='--', linewidth=0.8)
+    ax.plot([y_true.min(), y_true.max()], [y_true.min(), y_true.max()], 'gray', linestyle='--', linewidth=0.8)
+    ax.set_xlabel('Actual Ln Peak Intensity')
+    ax.set_ylabel('Predicted Ln Peak Intensity')
+    ax.set_title(title)
+    ax.legend()
+
+
+def render_intensity_scatter(fig, points: np.ndarray, y: np.ndarray, threshold: float, sep_threshold: float,
+                             title: str = '', colorbar_label: str = 'Label Value',
+                             legend_labels: Tuple[str, str, str] = ('Background', 'Elevated Events', 'SEPs')) -> None:
+    """
+    2D embedding (t-SNE or 2D features) with the background in gray, and the elevated (circles) and SEP
+    (diamonds) events colored and sized by their label value.
+    """
+    from matplotlib import cm, colors
+    from matplotlib.lines import Line2D
+
+    ax = fig.add_subplot(1, 1, 1)
+    y = np.asarray(y).reshape(-1)
+    is_sep = y > sep_threshold
+    is_elevated = (y > threshold) & ~is_sep
+    is_background = y <= threshold
+
+    ax.scatter(points[is_background, 0], points[is_background, 1], marker='o', color='gray', alpha=0.6)
+
+    norm = colors.Normalize(y.min(), y.max())
+    # marker sizes grow with the squared normalized label value
+    sizes = 50 * ((y - y.min()) / (y.max() - y.min())) ** 2 + 10
+    ax.scatter(points[is_elevated, 0], points[is_elevated, 1], c=y[is_elevated], cmap='plasma', norm=norm,
+               alpha=0.6, marker='o', s=sizes[is_elevated])
+    ax.scatter(points[is_sep, 0], points[is_sep, 1], c=y[is_sep], cmap='plasma', norm=norm, alpha=0.6,
+               marker='d', s=sizes[is_sep])
+
+    mappable = cm.ScalarMappable(cmap='plasma', norm=norm)
+    mappable.set_array([])
+    fig.colorbar(mappable, ax=ax).set_label(colorbar_label)
+
+    handles = [Line2D([0], [0], marker='o', color='w', markerfacecolor='gray', markersize=10),
+               Line2D([0], [0], marker='o', color='w', markerfacecolor='blue', markersize=10),
+               Line2D([0], [0], marker='d', color='w', markerfacecolor='red', markersize=10)]
+    ax.legend(handles, list(legend_labels), loc='upper left')
+    ax.set_title(title)
+    ax.set_xlabel('Dimension 1')
+    ax.set_ylabel('Dimension 2')
+
+
+RENDERERS: Dict[str, Callable[..., None]] = {
+    'lines': render_lines,
+    'subplot_lines': render_subplot_lines,
+    'scatter': render_scatter,
+    'bars': render_bars,
+    'actual_vs_predicted': render_actual_vs_predicted,
+    'intensity_scatter': render_intensity_scatter,
+}
+
+
+class FigureRenderer:
+    """
+    Renders plot jobs with the Agg canvas (no pyplot state), reusing one cleared figure per plot kind.
+    """
+
+    def __init__(self) -> None:
+        self.figures = {}
+
+    def render(self, kind: str, file_path: str, data: Dict[str, Any]) -> None:
+        """
+        Render a plot job and save it.
+
+        :param kind: The plot kind, a key of RENDERERS.
+        :param file_path: The path of the saved image.
+        :param data: The arguments of the renderer.
+        """
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+
+        fig = self.figures.get(kind)
+        if fig is None:
+            fig = Figure(figsize=FIGURE_SIZES.get(kind, (6.4, 4.8)))
+            FigureCanvasAgg(fig)
+            self.figures[kind] = fig
+        fig.clf()
+        RENDERERS[kind](fig, **data)
+        directory = os.path.dirname(file_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        fig.savefig(file_path)
+
+
+def plot_worker(jobs: BinaryIO, acks: BinaryIO) -> None:
+    """
+    Worker process loop: render the jobs until a None sentinel (or the end of the stream), acknowledging each
+    job with one byte.
+
+    :param jobs: The stream of pickled (kind, file_path, data) jobs.
+    :param acks: The stream of the acknowledgements.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+
+    renderer = FigureRenderer()
+    while True:
+        try:
+            job = pickle.load(jobs)
+        except EOFError:
+            return
+        try:
+            if job is None:
+                return
+            kind, file_path, data = job
+            renderer.render(kind, file_path, data)
+        except Exception as e:
+            print(f"Plot worker failed on {job[1] if job else job}: {e}")
+        finally:
+            acks.write(b'.')
+            acks.flush()
+
+
+class PlotService:
+    """
+    Queue of plot jobs rendered off the critical path. Modes:
+    'background' renders in a worker process, 'sync' renders in the calling process, 'defer' keeps the jobs
+    until flush() (e.g. at the end of a sweep), 'skip' drops them.
+    The worker is a fresh interpreter running this module (python -m models.plot_service), so it neither forks
+    the TensorFlow runtime nor re-imports the launching script (as a multiprocessing spawn would); the jobs
+    are pickled to its stdin and acknowledged on its stdout.
+    """
+
+    def __init__(self, mode: str = 'background', max_pending: int = 64) -> None:
+        """
+        :param mode: One of PLOT_MODES.
+        :param max_pending: Maximum number of jobs queued for the worker (submit blocks when it is full).
+        """
+        self.mode = None
+        self.set_mode(mode)
+        self.max_pending = max_pending
+        self.pending = 0
+        self.worker: Optional[subprocess.Popen] = None
+        self.deferred: List[Tuple[str, str, Dict[str, Any]]] = []
+        self.renderer: Optional[FigureRenderer] = None
+        # plots to log as MLflow artifacts once rendered, with the id of the run they belong to
+        self.artifacts: List[Tuple[str, Optional[str]]] = []
+
+    def set_mode(self, mode: str) -> None:
+        """
+        Switch the plotting mode. Jobs already deferred stay deferred until flush().
+
+        :param mode: One of PLOT_MODES.
+        """
+        if mode not in PLOT_MODES:
+            raise ValueError(f"mode should be one of {PLOT_MODES}, got {mode}")
+        self.mode = mode
+
+    def is_running(self) -> bool:
+        """
+        Whether the worker process is running.
+        """
+        return self.worker is not None and self.worker.poll() is None
+
+    def start(self) -> None:
+        """
+        Start the worker process if it is not running.
+        """
+        if self.is_running():
+            return
+        # the repository root on the path of the worker, whatever the working directory of the caller
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [root, env.get('PYTHONPATH')]))
+        self.worker = subprocess.Popen([sys.executable, '-m', 'models.plot_service'],
+                                       stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+        self.pending = 0
+
+    def acknowledge(self, count: int) -> None:
+        """
+        Wait for the worker to acknowledge count jobs.
+        """
+        received = len(self.worker.stdout.read(count)) if count > 0 and self.worker is not None else 0
+        if received < count:
+            print(f"Plot worker exited with {count - received} jobs pending")
+            self.pending = 0
+            return
+        self.pending -= count
+
+    def send(self, job: Optional[Tuple[str, str, Dict[str, Any]]]) -> None:
+        """
+        Send a job (or the None sentinel) to the worker, blocking while max_pending jobs are pending.
+        If the worker died, the job is rendered in the calling process and the next job starts a new worker.
+        """
+        if self.pending >= self.max_pending:
+            self.acknowledge(1)
+        try:
+            pickle.dump(job, self.worker.stdin, protocol=pickle.HIGHEST_PROTOCOL)
+            self.worker.stdin.flush()
+        except (BrokenPipeError, EOFError, OSError) as e:
+            print(f"Plot worker unavailable ({e}), rendering in this process")
+            self.worker = None
+            self.pending = 0
+            if job is not None:
+                self.render_now(*job)
+            return
+        self.pending += 1
+
+    def render_now(self, kind: str, file_path: str, data: Dict[str, Any]) -> None:
+        """
+        Render a job in the calling process.
+        """
+        if self.renderer is None:
+            self.renderer = FigureRenderer()
+        self.renderer.render(kind, file_path, data)
+
+    def dispatch(self, kind: str, file_path: str, data: Dict[str, Any], mode: str) -> None:
+        """
+        Send a job to the worker ('background') or render it here ('sync').
+        """
+        if mode == 'background':
+            self.start()
+            self.send((kind, file_path, data))
+        else:
+            self.render_now(kind, file_path, data)
+
+    def submit(self, kind: str, file_path: str, **data) -> str:
+        """
+        Enqueue a plot. The arrays are copied into plain NumPy arrays so the caller can keep mutating its state.
+
+        :param kind: The plot kind, a key of RENDERERS.
+        :param file_path: The path of the saved image.
+        :param data: The arguments of the renderer.
+        :return: The path the plot is (or will be) saved to.
+        """
+        if kind not in RENDERERS:
+            raise ValueError(f"Unknown plot kind {kind}, should be one of {list(RENDERERS)}")
+        if self.mode == 'skip':
+            return file_path
+        data = {key: plain(value) for key, value in data.items()}
+        if self.mode == 'defer':
+            self.deferred.append((kind, file_path, data))
+        else:
+            self.dispatch(kind, file_path, data, self.mode)
+        return file_path
+
+    def flush(self, mode: Optional[str] = None) -> None:
+        """
+        Render the deferred jobs.
+
+        :param mode: 'background' or 'sync'. Default is 'sync' in defer mode, the current mode otherwise.
+        """
+        if mode is None:
+            mode = 'sync' if self.mode in ('defer', 'skip') else self.mode
+        deferred, self.deferred = self.deferred, []
+        for kind, file_path, data in deferred:
+            self.dispatch(kind, file_path, data, mode)
+
+    def wait(self) -> None:
+        """
+        Block until the worker has rendered all the queued jobs.
+        """
+        if self.is_running():
+            self.acknowledge(self.pending)
+
+    def log_artifact(self, file_path: str) -> None:
+        """
+        Queue a plot to log to the active MLflow run once rendered. The plots of a run are logged together
+        (after one wait) when a plot of another run is queued, on log_artifacts(), or on close().
+
+        :param file_path: The path returned by the plotting function.
+        """
+        run = mlflow.active_run()
+        run_id = run.info.run_id if run is not None else None
+        if self.artifacts and self.artifacts[-1][1] != run_id:
+            self.log_artifacts()
+        self.artifacts.append((file_path, run_id))
+
+    def log_artifacts(self) -> None:
+        """
+        Wait for the queued plots and log the queued artifacts to their runs (plots that are skipped or still
+        deferred are not logged).
+        """
+        if not self.artifacts:
+            return
+        self.wait()
+        artifacts, self.artifacts = self.artifacts, []
+        for file_path, run_id in artifacts:
+            if not os.path.exists(file_path):
+                print(f"Plot {file_path} not rendered ({self.mode} mode), not logged.")
+            elif run_id is None:
+                mlflow.log_artifact(file_path)
+            else:
+                # the run may have ended since, the client logs to it by id
+                mlflow.tracking.MlflowClient().log_artifact(run_id, file_path)
+
+    def close(self) -> None:
+        """
+        Render the pending jobs, stop the worker and log the queued artifacts. Deferred jobs are dropped in skip
+        mode only.
+        """
+        if self.deferred and self.mode != 'skip':
+            self.flush()
+        if self.is_running():
+            self.send(None)
+            self.acknowledge(self.pending)
+            if self.worker is not None:
+                self.worker.stdin.close()
+                self.worker.wait()
+        self.worker = None
+        self.pending = 0
+        self.log_artifacts()
+
+
+def plain(value: Any) -> Any:
+    """
+    Copy array-likes (lists of numbers, tensors, read-only arrays) into NumPy arrays for pickling,
+    recursing into dictionaries, lists and tuples of arrays.
+    """
+    if isinstance(value, dict):
+        return {key: plain(item) for key, item in value.items()}
+    if isinstance(value, tuple):
+        return tuple(plain(item) for item in value)
+    if isinstance(value, list) and value and isinstance(value[0], (dict, list, tuple, np.ndarray)):
+        return [plain(item) for item in value]
+    if isinstance(value, (list, range)) or hasattr(value, '__array__'):
+        return np.array(value)
+    return value
+
+
+# service shared by the training and evaluation code
+PLOT_SERVICE = PlotService(mode=os.environ.get('PLOT_MODE', 'background'))
+atexit.register(PLOT_SERVICE.close)
+
+
+def submit_plot(kind: str, file_path: str, **data) -> str:
+    """
+    Enqueue a plot on the shared plot service.
+
+    :param kind: The plot kind, a key of RENDERERS.
+    :param file_path: The path of the saved image.
+    :param data: The arguments of the renderer.
+    :return: The path the plot is (or will be) saved to.
+    """
+    return PLOT_SERVICE.submit(kind, file_path, **data)
+
+
+def set_plot_mode(mode: str) -> None:
+    """
+    Switch the mode of the shared plot service ('background', 'sync', 'defer' or 'skip').
+    """
+    PLOT_SERVICE.set_mode(mode)
+
+
+def flush_plots(mode: Optional[str] = None) -> None:
+    """
+    Render the deferred plots of the shared plot service.
+    """
+    PLOT_SERVICE.flush(mode)
+
+
+def log_plot_artifact(file_path: str) -> None:
+    """
+    Log a plot to the active MLflow run once the plot service has rendered it. Does not wait: the plots of a
+    run are logged together at the first plot of the next run, on log_plot_artifacts() or at exit.
+
+    :param file_path: The path returned by the plotting function.
+    """
+    PLOT_SERVICE.log_artifact(file_path)
+
+
+def log_plot_artifacts() -> None:
+    """
+    Wait for the plots and log the queued plot artifacts (e.g. at the end of a run).
+    """
+    PLOT_SERVICE.log_artifacts()
+
+
+if __name__ == '__main__':
+    # worker process of PlotService: the acknowledgements own stdout, prints go to stderr
+    acknowledgements = sys.stdout.buffer
+    sys.stdout = sys.stderr
+    plot_worker(sys.stdin.buffer, acknowledgements)
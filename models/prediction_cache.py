@@ -0,0 +1,115 @@
+##############################################################################################################
+# Description: memoized model.predict shared by the evaluation and plotting helpers, keyed by a fingerprint
+# of the model weights, a hash of the input array and the output head, with a bounded LRU of results.
+##############################################################################################################
+import hashlib
+import threading
+from collections import OrderedDict
+# types for type hinting
+from typing import Optional, Tuple, Any
+
+import numpy as np
+# imports
+from tensorflow.keras import Model
+
+
+class PredictionCache:
+    """
+    Bounded LRU cache of model predictions. A cached prediction is reused as long as the model has the same
+    architecture and weights and the input has the same content, so helpers that predict the same X with the
+    same model (evaluation, t-SNE plots, norm checks, ...) run inference once.
+    """
+
+    def __init__(self, max_entries: int = 16) -> None:
+        """
+        :param max_entries: Maximum number of cached predictions.
+        """
+        self.max_entries = max_entries
+        self.entries: 'OrderedDict[Tuple[str, str], Any]' = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def model_fingerprint(model: Model) -> str:
+        """
+        Fingerprint of the model: its name, output shapes and a hash of its weights.
+
+        :param model: The model.
+        :return: The fingerprint as a hex digest.
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(model.name.encode())
+        digest.update(str([tuple(output.shape) for output in model.outputs]).encode())
+        for weights in model.get_weights():
+            digest.update(np.ascontiguousarray(weights).tobytes())
+        return digest.hexdigest()
+
+    @staticmethod
+    def input_fingerprint(X: np.ndarray) -> str:
+        """
+        Fingerprint of the input array: its shape, dtype and a hash of its content.
+
+        :param X: The input array.
+        :return: The fingerprint as a hex digest.
+        """
+        X = np.ascontiguousarray(X)
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(f"{X.shape}{X.dtype}".encode())
+        digest.update(X.tobytes())
+        return digest.hexdigest()
+
+    def predict(self, model: Model, X: np.ndarray, head: Optional[int] = None, **predict_kwargs) -> Any:
+        """
+        model.predict(X), served from the cache when possible.
+
+        :param model: The model.
+        :param X: The input array.
+        :param head: Index of the output head to return for multi-output models, None for all outputs.
+        :param predict_kwargs: Additional arguments to model.predict on a cache miss (e.g. batch_size).
+        :return: The (read-only) predictions.
+        """
+        key = (self.model_fingerprint(model), self.input_fingerprint(X))
+        with self.lock:
+            outputs = self.entries.get(key)
+            if outputs is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+
+        if outputs is None:
+            outputs = model.predict(X, verbose=0, **predict_kwargs)
+            for output in (outputs if isinstance(outputs, list) else [outputs]):
+                output.flags.writeable = False
+            with self.lock:
+                self.misses += 1
+                self.entries[key] = outputs
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+
+        if head is not None and isinstance(outputs, list):
+            return outputs[head]
+        return outputs
+
+    def clear(self) -> None:
+        """
+        Drop all cached predictions.
+        """
+        with self.lock:
+            self.entries.clear()
+
+
+# cache shared by the evaluation and plotting helpers
+PREDICTION_CACHE = PredictionCache()
+
+
+def cached_predict(model: Model, X: np.ndarray, head: Optional[int] = None, **predict_kwargs) -> Any:
+    """
+    model.predict(X) through the shared prediction cache.
+
+    :param model: The model.
+    :param X: The input array.
+    :param head: Index of the output head to return for multi-output models, None for all outputs.
+    :param predict_kwargs: Additional arguments to model.predict on a cache miss.
+    :return: The (read-only) predictions.
+    """
+    return PREDICTION_CACHE.predict(model, X, head, **predict_kwargs)
@@ -0,0 +1,288 @@
+##############################################################################################################
+# Description: windowed tf.profiler capture for the training loops, the model.fit paths and evaluation,
+# with a run specific log dir and a summary of the top ops by self time read back from the trace.
+##############################################################################################################
+import datetime
+import glob
+import os
+from contextlib import contextmanager, nullcontext
+# types for type hinting
+from typing import Optional, List, Tuple, Dict
+
+# imports
+import tensorflow as tf
+from tensorflow.keras import callbacks
+
+
+class ProfilerWindow:
+    """
+    Starts a tf.profiler trace at the start index and stops it at the stop index of a window of epochs or
+    steps, so a short window of a long run can be profiled without editing the experiment scripts.
+    The trace is written to a run specific log dir (open it with TensorBoard's profile plugin) and the
+    top ops by self time are printed once the window closes.
+    """
+
+    def __init__(self,
+                 start: int = 1,
+                 stop: int = 2,
+                 unit: str = 'epoch',
+                 log_dir: Optional[str] = None,
+                 save_tag: Optional[str] = None,
+                 top_k: int = 20,
+                 verbose: bool = True) -> None:
+        """
+        :param start: Index (0-based) of the first epoch or step to profile.
+        :param stop: Index of the first epoch or step not profiled anymore.
+        :param unit: 'epoch' or 'step' (steps are counted over the whole run).
+        :param log_dir: Directory to write the trace to. Default is logs/profile/{save_tag}_{timestamp}.
+        :param save_tag: Tag of the run, used to name the default log dir.
+        :param top_k: Number of ops in the printed summary.
+        :param verbose: Whether to print the summary when the window closes.
+        """
+        if unit not in ('epoch', 'step'):
+            raise ValueError(f"unit should be 'epoch' or 'step', got {unit}")
+        if stop <= start:
+            raise ValueError("stop should be greater than start.")
+        self.start = start
+        self.stop = stop
+        self.unit = unit
+        if log_dir is None:
+            timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+            log_dir = os.path.join('logs', 'profile', f"{str(save_tag)}_{timestamp}")
+        self.log_dir = log_dir
+        self.top_k = top_k
+        self.verbose = verbose
+        self.active = False
+        self.done = False
+        self.global_step = 0
+
+    def begin(self) -> None:
+        """
+        Start the trace (no-op if a trace is already running or the window was already captured).
+        """
+        if self.active or self.done:
+            return
+        os.makedirs(self.log_dir, exist_ok=True)
+        tf.profiler.experimental.start(self.log_dir)
+        self.active = True
+        print(f"Profiling {self.unit}s [{self.start}, {self.stop}) to {self.log_dir}")
+
+    def end(self) -> None:
+        """
+        Stop the trace and print the top ops by self time.
+        """
+        if not self.active:
+            return
+        tf.profiler.experimental.stop()
+        self.active = False
+        self.done = True
+        if self.verbose:
+            self.print_top_ops()
+
+    def close(self) -> None:
+        """
+        Stop the trace if the run ended inside the window (e.g. early stopping).
+        """
+        self.end()
+
+    def update(self, index: int) -> None:
+        """
+        Start or stop the trace when entering or leaving the window.
+
+        :param index: The index of the epoch or step about to run.
+        """
+        if self.start <= index < self.stop:
+            self.begin()
+        elif index >= self.stop:
+            self.end()
+
+    @contextmanager
+    def epoch(self, epoch: int):
+        """
+        Wrap one epoch. With unit 'epoch', the trace covers the epochs of the window.
+
+        :param epoch: The index of the epoch.
+        """
+        if self.unit == 'epoch':
+            self.update(epoch)
+        yield
+        if self.unit == 'epoch' and epoch + 1 >= self.stop:
+            self.end()
+
+    @contextmanager
+    def step(self):
+        """
+        Wrap one training step. With unit 'step', the trace covers the steps of the window.
+        The step is annotated so the trace viewer groups its ops.
+        """
+        if self.unit == 'step':
+            self.update(self.global_step)
+        with self.annotate('train', step_num=self.global_step, _r=1):
+            yield
+        self.global_step += 1
+        if self.unit == 'step' and self.global_step >= self.stop:
+            self.end()
+
+    def annotate(self, name: str, **kwargs):
+        """
+        Named host annotation (tf.profiler.experimental.Trace) while a trace is running.
+
+        :param name: The name of the annotated region (e.g. 'data_slicing', 'weight_lookup', 'repr_loss').
+        :return: The annotation context, or a no-op context when not tracing.
+        """
+        return tf.profiler.experimental.Trace(name, **kwargs) if self.active else nullcontext()
+
+    @contextmanager
+    def capture(self):
+        """
+        Trace the whole block regardless of the window (used for one-off calls such as evaluation).
+        """
+        self.done = False
+        self.begin()
+        try:
+            yield
+        finally:
+            self.end()
+
+    def top_ops(self, k: Optional[int] = None) -> List[Tuple[str, float, int]]:
+        """
+        Top ops by self time in the latest trace of the log dir.
+
+        :param k: Number of ops to return. Default is top_k.
+        :return: A list of (op name, self time in ms, occurrences), sorted by decreasing self time.
+        """
+        k = k or self.top_k
+        files = glob.glob(os.path.join(self.log_dir, 'plugins', 'profile', '*', '*.xplane.pb'))
+        if not files:
+            return []
+        stats = xplane_self_times(max(files, key=os.path.getmtime))
+        ranked = sorted(stats.items(), key=lambda item: item[1][0], reverse=True)[:k]
+        return [(name, self_ps / 1e9, count) for name, (self_ps, count) in ranked]
+
+    def print_top_ops(self) -> None:
+        """
+        Print the top ops by self time of the latest trace.
+        """
+        ops = self.top_ops()
+        if not ops:
+            print(f"No trace found in {self.log_dir}")
+            return
+        total = sum(ms for _, ms, _ in ops)
+        print(f"Top {len(ops)} ops by self time ({self.log_dir}):")
+        print("Op".ljust(60) + "Self (ms)".ljust(15) + "Share".ljust(10) + "Count")
+        for name, ms, count in ops:
+            share = ms / total if total > 0 else 0.0
+            print(f"{name[:58].ljust(60)}{f'{ms:.3f}'.ljust(15)}{f'{share:.1%}'.ljust(10)}{count}")
+
+    def callback(self) -> 'ProfilerCallback':
+        """
+        Keras callback applying this window to a model.fit call.
+
+        :return: The callback.
+        """
+        return ProfilerCallback(self)
+
+
+class ProfilerCallback(callbacks.Callback):
+    """
+    Keras callback applying a ProfilerWindow to model.fit (epochs or train batches).
+    """
+
+    def __init__(self, profiler: ProfilerWindow):
+        super().__init__()
+        self.profiler = profiler
+
+    def on_epoch_begin(self, epoch, logs=None):
+        if self.profiler.unit == 'epoch':
+            self.profiler.update(epoch)
+
+    def on_epoch_end(self, epoch, logs=None):
+        if self.profiler.unit == 'epoch' and epoch + 1 >= self.profiler.stop:
+            self.profiler.end()
+
+    def on_train_batch_begin(self, batch, logs=None):
+        if self.profiler.unit == 'step':
+            self.profiler.update(self.profiler.global_step)
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.profiler.global_step += 1
+        if self.profiler.unit == 'step' and self.profiler.global_step >= self.profiler.stop:
+            self.profiler.end()
+
+    def on_train_end(self, logs=None):
+        self.profiler.close()
+
+
+def xplane_self_times(path: str) -> Dict[str, Tuple[float, int]]:
+    """
+    Aggregate the self time of the events of an XSpace trace by event name. Events of a line are nested,
+    so the self time of an event is its duration minus the duration of its direct children.
+
+    :param path: Path of the .xplane.pb file.
+    :return: A dictionary mapping the event name to (self time in ps, occurrences).
+    """
+    try:
+        from tensorflow.core.profiler.protobuf import xplane_pb2
+    except ImportError:
+        from tsl.profiler.protobuf import xplane_pb2
+
+    space = xplane_pb2.XSpace()
+    with open(path, 'rb') as f:
+        space.ParseFromString(f.read())
+
+    stats: Dict[str, List[float]] = {}
+    for plane in space.planes:
+        names = {metadata_id: metadata.display_name or metadata.name
+                 for metadata_id, metadata in plane.event_metadata.items()}
+        for line in plane.lines:
+            events = sorted(line.events, key=lambda e: (e.offset_ps, -e.duration_ps))
+            # stack of [end, index] of the open events, self times start as the full durations
+            self_times = [float(e.duration_ps) for e in events]
+            stack = []
+            for i, event in enumerate(events):
+                while stack and stack[-1][0] <= event.offset_ps:
+                    stack.pop()
+                if stack:
+                    self_times[stack[-1][1]] -= event.duration_ps
+                stack.append([event.offset_ps + event.duration_ps, i])
+            for event, self_time in zip(events, self_times):
+                entry = stats.setdefault(names.get(event.metadata_id, str(event.metadata_id)), [0.0, 0])
+                entry[0] += max(self_time, 0.0)
+                entry[1] += 1
+
+    return {name: (entry[0], entry[1]) for name, entry in stats.items()}
+
+
+def maybe_profile_epoch(profiler: Optional[ProfilerWindow], epoch: int):
+    """
+    profiler.epoch(epoch), or a no-op context if profiler is None.
+    """
+    return profiler.epoch(epoch) if profiler is not None else nullcontext()
+
+
+def maybe_profile_step(profiler: Optional[ProfilerWindow]):
+    """
+    profiler.step(), or a no-op context if profiler is None.
+    """
+    return profiler.step() if profiler is not None else nullcontext()
+
+
+def maybe_capture(profiler: Optional[ProfilerWindow]):
+    """
+    profiler.capture(), or a no-op context if profiler is None.
+    """
+    return profiler.capture() if profiler is not None else nullcontext()
+
+
+def maybe_annotate(profiler: Optional[ProfilerWindow], name: str):
+    """
+    profiler.annotate(name), or a no-op context if profiler is None.
+    """
+    return profiler.annotate(name) if profiler is not None else nullcontext()
+
+
+def profiler_callbacks(profiler: Optional[ProfilerWindow]) -> List[callbacks.Callback]:
+    """
+    Callbacks to append to a model.fit call: the profiler callback, or none if profiler is None.
+    """
+    return [profiler.callback()] if profiler is not None else []
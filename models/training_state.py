@@ -0,0 +1,233 @@
+##############################################################################################################
+# Description: preemption-safe training state (weights, optimizer slots, epoch counter, early stopping,
+# RNG state and history) so that long Slurm jobs can resume where they stopped.
+##############################################################################################################
+import json
+import os
+import pickle
+import random
+import shutil
+# types for type hinting
+from typing import Optional, Union, Dict, Any, List
+
+import numpy as np
+# imports
+import tensorflow as tf
+from tensorflow.keras import callbacks, Model
+
+
+class TrainingState:
+    """
+    Periodic checkpoint of everything needed to resume a training run.
+
+    The state lives in a directory holding a TensorFlow checkpoint (model weights, optimizer slots and the global
+    TF generator), a pickle of the Python and NumPy RNG states, an optional npz of early stopping best weights and
+    a state.json describing the phase ('search' or 'retrain'), the epoch counter, the early stopping variables
+    and the history. state.json is replaced atomically and always points to a complete checkpoint.
+    """
+
+    def __init__(self,
+                 model: Model,
+                 save_tag: Optional[str] = None,
+                 save_freq: int = 1,
+                 state_dir: Optional[str] = None) -> None:
+        """
+        Initialize the training state.
+
+        :param model: The model whose weights are checkpointed.
+        :param save_tag: Tag of the run, used to name the default state directory.
+        :param save_freq: Save the state every save_freq epochs (phase transitions are always saved).
+        :param state_dir: Directory to write the state to. Default is training_state_{save_tag}.
+        """
+        self.model = model
+        self.optimizer = None
+        self.save_freq = max(int(save_freq), 1)
+        self.state_dir = state_dir if state_dir is not None else f"training_state_{str(save_tag)}"
+
+    def should_save(self, epoch: int) -> bool:
+        """
+        Whether the state should be saved after the given (1-based) epoch counter.
+
+        :param epoch: Number of epochs completed in the current phase.
+        :return: True if a checkpoint is due.
+        """
+        return epoch % self.save_freq == 0
+
+    def _checkpoint(self) -> tf.train.Checkpoint:
+        """
+        Build the TensorFlow checkpoint object for the tracked model, optimizer and global generator.
+        """
+        trackables = {'model': self.model, 'rng': tf.random.get_global_generator()}
+        if self.optimizer is not None:
+            trackables['optimizer'] = self.optimizer
+        return tf.train.Checkpoint(**trackables)
+
+    def save(self,
+             epoch: int,
+             phase: str,
+             state: Dict[str, Any],
+             best_weights: Optional[List[np.ndarray]] = None) -> None:
+        """
+        Save the full training state.
+
+        :param epoch: Number of epochs completed in the current phase.
+        :param phase: The phase of training, 'search' (with validation) or 'retrain' (to the best epoch).
+        :param state: JSON serializable dictionary with the early stopping variables, history, etc.
+        :param best_weights: Optional list of weight arrays kept by early stopping.
+        :return: None
+        """
+        os.makedirs(self.state_dir, exist_ok=True)
+        previous = self._read_json()
+
+        # Write the checkpoint under a new prefix so the previous one stays valid until state.json is replaced
+        prefix = os.path.join(self.state_dir, f"ckpt_{phase}_{epoch}")
+        self._checkpoint().write(prefix)
+
+        with open(os.path.join(self.state_dir, 'rng.pkl'), 'wb') as f:
+            pickle.dump({'random': random.getstate(), 'numpy': np.random.get_state()}, f)
+
+        weights_file = None
+        if best_weights is not None:
+            weights_file = f"best_weights_{phase}_{epoch}.npz"
+            np.savez(os.path.join(self.state_dir, weights_file), *best_weights)
+
+        content = dict(state)
+        content.update({'epoch': epoch, 'phase': phase, 'checkpoint': os.path.basename(prefix),
+                        'best_weights': weights_file})
+        tmp_file = os.path.join(self.state_dir, 'state.json.tmp')
+        with open(tmp_file, 'w') as f:
+            json.dump(content, f, default=_to_builtin)
+        os.replace(tmp_file, os.path.join(self.state_dir, 'state.json'))
+
+        # Remove the files of the previous checkpoint
+        if previous is not None:
+            self._remove_files(previous, keep=content)
+
+    def restore(self, resume: Union[bool, str] = True) -> Optional[Dict[str, Any]]:
+        """
+        Restore the model, optimizer and RNG states from a previous run.
+
+        :param resume: True to resume from this run's state directory, or the path of a state directory
+                       written by a previous (preempted) job. False disables resuming.
+        :return: The saved state dictionary (with 'best_weights' loaded as a list of arrays),
+                 or None when there is nothing to resume from.
+        """
+        if not resume:
+            return None
+        if isinstance(resume, str):
+            self.state_dir = resume
+
+        state = self._read_json()
+        if state is None:
+            print(f"No training state found in {self.state_dir}, starting from scratch.")
+            return None
+
+        self._checkpoint().read(os.path.join(self.state_dir, state['checkpoint'])).expect_partial()
+
+        rng_file = os.path.join(self.state_dir, 'rng.pkl')
+        if os.path.exists(rng_file):
+            with open(rng_file, 'rb') as f:
+                rng_state = pickle.load(f)
+            random.setstate(rng_state['random'])
+            np.random.set_state(rng_state['numpy'])
+
+        if state.get('best_weights') is not None:
+            with np.load(os.path.join(self.state_dir, state['best_weights'])) as data:
+                state['best_weights'] = [data[f"arr_{i}"] for i in range(len(data.files))]
+
+        print(f"Resuming {state['phase']} phase after epoch {state['epoch']} from {self.state_dir}")
+
+        return state
+
+    def clear(self) -> None:
+        """
+        Delete the state directory once training is complete.
+        """
+        shutil.rmtree(self.state_dir, ignore_errors=True)
+
+    def _read_json(self) -> Optional[Dict[str, Any]]:
+        state_file = os.path.join(self.state_dir, 'state.json')
+        if not os.path.exists(state_file):
+            return None
+        with open(state_file) as f:
+            return json.load(f)
+
+    def _remove_files(self, previous: Dict[str, Any], keep: Dict[str, Any]) -> None:
+        if previous.get('checkpoint') and previous['checkpoint'] != keep['checkpoint']:
+            for file_name in os.listdir(self.state_dir):
+                if file_name.startswith(previous['checkpoint'] + '.'):
+                    os.remove(os.path.join(self.state_dir, file_name))
+        if previous.get('best_weights') and previous['best_weights'] != keep['best_weights']:
+            weights_path = os.path.join(self.state_dir, previous['best_weights'])
+            if os.path.exists(weights_path):
+                os.remove(weights_path)
+
+
+class TrainingStateCallback(callbacks.Callback):
+    """
+    Keras callback saving a TrainingState at the end of epochs during model.fit and restoring
+    the early stopping variables when resuming.
+    """
+
+    def __init__(self,
+                 training_state: TrainingState,
+                 phase: str,
+                 early_stopping: Optional[callbacks.EarlyStopping] = None,
+                 restored: Optional[Dict[str, Any]] = None,
+                 extra_state: Optional[Dict[str, Any]] = None):
+        """
+        :param training_state: The TrainingState to save to.
+        :param phase: The phase of training this fit call belongs to ('search' or 'retrain').
+        :param early_stopping: The early stopping callback of this fit call, if any.
+        :param restored: The state returned by TrainingState.restore, if resuming.
+        :param extra_state: Additional values to store along with the state (e.g. best_epoch).
+        """
+        super().__init__()
+        self.training_state = training_state
+        self.phase = phase
+        self.early_stopping = early_stopping
+        self.extra_state = extra_state or {}
+        self.restored = restored if restored is not None and restored['phase'] == phase else None
+        self.history = dict(self.restored.get('history', {})) if self.restored is not None else {}
+
+    def on_train_begin(self, logs=None):
+        self.training_state.optimizer = self.model.optimizer
+        # EarlyStopping resets its variables in on_train_begin, so this callback must come after it
+        if self.restored is not None and self.early_stopping is not None:
+            self.early_stopping.wait = self.restored['wait']
+            self.early_stopping.best = self.restored['best']
+            if hasattr(self.early_stopping, 'best_epoch'):
+                self.early_stopping.best_epoch = self.restored['best_epoch']
+            self.early_stopping.best_weights = self.restored.get('best_weights')
+
+    def on_epoch_end(self, epoch, logs=None):
+        for key, value in (logs or {}).items():
+            self.history.setdefault(key, []).append(float(value))
+
+        if self.training_state.should_save(epoch + 1):
+            self.save(epoch + 1)
+
+    def save(self, epoch: int) -> None:
+        """
+        Save the state after the given number of epochs of this phase.
+
+        :param epoch: Number of epochs completed in this phase.
+        """
+        state = dict(self.extra_state)
+        state['history'] = self.history
+        best_weights = None
+        if self.early_stopping is not None:
+            state['wait'] = self.early_stopping.wait
+            state['best'] = self.early_stopping.best
+            state['best_epoch'] = getattr(self.early_stopping, 'best_epoch', 0)
+            best_weights = self.early_stopping.best_weights
+        self.training_state.save(epoch, self.phase, state, best_weights)
+
+
+def _to_builtin(obj):
+    """
+    JSON fallback for NumPy scalars and arrays.
+    """
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    return str(obj)
@@ -8,8 +8,10 @@ import tensorflow as tf
 
 from dataload import DenseReweights as dr
 from dataload import seploader as sepl
+from dataload.dataset_view import DatasetView
 from evaluate.utils import count_above_threshold, plot_tsne_pds, split_combined_joint_weights_indices
 from models import modeling
+from models.plot_service import log_plot_artifact
 
 # SEEDING
 SEED = 42  # seed number
@@ -41,8 +43,12 @@ def main():
         './cme_and_electron/fold/fold_1')
 
     # combine training and validation
-    combined_train_x, combined_train_y = loader.combine(
-        shuffled_train_x, shuffled_train_y, shuffled_val_x, shuffled_val_y)
+    data = DatasetView.from_splits(shuffled_train_x, shuffled_train_y, shuffled_val_x, shuffled_val_y,
+                                   shuffled_test_x, shuffled_test_y)
+    shuffled_train_x, shuffled_train_y = data['subtrain']
+    shuffled_val_x, shuffled_val_y = data['val']
+    shuffled_test_x, shuffled_test_y = data['test']
+    combined_train_x, combined_train_y = data['train']
 
     # print(f'len combined: {len(combined_train_y)}')
     min_norm_weight = 0.01 / len(combined_train_y)
@@ -117,11 +123,11 @@ def main():
         file_path = plot_tsne_pds(feature_extractor,
                                   combined_train_x, combined_train_y, title, 'training',
                                   save_tag=timestamp)
-        mlflow.log_artifact(file_path)
+        log_plot_artifact(file_path)
         file_path = plot_tsne_pds(feature_extractor,
                                   shuffled_test_x, shuffled_test_y, title, 'testing',
                                   save_tag=timestamp)
-        mlflow.log_artifact(file_path)
+        log_plot_artifact(file_path)
 
 
 if __name__ == '__main__':
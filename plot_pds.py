@@ -4,6 +4,7 @@ import random
 from evaluate.utils import load_and_plot_tsne
 import mlflow
 import mlflow.tensorflow
+from models.plot_service import log_plot_artifact
 
 # Set the tracking URI to a local directory
 mlflow.set_tracking_uri("http://127.0.0.1:5000/")
@@ -47,8 +48,8 @@ def main():
         mlflow.tensorflow.autolog()
         test_plot_path, training_plot_path = load_and_plot_tsne(
             model_path, model_type, title, data_dir, with_head=False)
-        mlflow.log_artifact(test_plot_path)
-        mlflow.log_artifact(training_plot_path)
+        log_plot_artifact(test_plot_path)
+        log_plot_artifact(training_plot_path)
 
 
 if __name__ == '__main__':